@@ -0,0 +1,109 @@
+"""
+Сравнение бэкендов энкодера (ENCODER_BACKEND) на одной машине.
+
+Запуск из корня репозитория:
+
+    python benchmarks/encoders.py search
+    python benchmarks/encoders.py qdrant_search --backends eager,int8,onnx --batch 16
+
+Для каждого бэкенда печатается JSON: время подготовки (квантизация, trace,
+экспорт), задержка на одну картинку, пропускная способность на батче и
+дрейф эмбеддингов — косинус с эталонной fp32-моделью на тех же картинках.
+Бэкенд, который не собрался (например, нет onnxruntime), попадает в вывод
+с полем error.
+"""
+
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from preprocess import IMAGE_EXTENSIONS, load_service, synthetic_images
+
+BACKENDS = ["eager", "int8", "bf16", "torchscript", "onnx"]
+
+
+def service_model(app):
+    if hasattr(app, "clip_model"):
+        return app.clip_model, app.device
+    return app.model, app.DEVICE
+
+
+def normalized(features: torch.Tensor) -> np.ndarray:
+    features = features.float()
+    return (features / features.norm(dim=-1, keepdim=True)).cpu().numpy()
+
+
+def measure(encode, inputs: torch.Tensor, batch: int, runs: int) -> dict:
+    with torch.no_grad():
+        for _ in range(2):  # прогрев: аллокации, JIT-оптимизации графа
+            encode(inputs[:1])
+        single = []
+        for i in range(runs):
+            started = time.perf_counter()
+            encode(inputs[i % len(inputs)][None])
+            single.append((time.perf_counter() - started) * 1000)
+        batched = inputs[np.arange(batch) % len(inputs)]
+        encode(batched)
+        started = time.perf_counter()
+        for _ in range(max(runs // 4, 1)):
+            encode(batched)
+        elapsed = time.perf_counter() - started
+    return {
+        "latency_ms_p50": float(np.percentile(single, 50)),
+        "latency_ms_p95": float(np.percentile(single, 95)),
+        "throughput_img_s": batch * max(runs // 4, 1) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("service", choices=["search", "qdrant_search"])
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--images", type=Path, help="папка с картинками")
+    parser.add_argument("--n", type=int, default=32, help="картинок для дрейфа")
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    app = load_service(args.service)
+    model, device = service_model(app)
+
+    workdir = tempfile.TemporaryDirectory()
+    if args.images:
+        paths = sorted(
+            p for p in args.images.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS
+        )[: args.n]
+    else:
+        paths = synthetic_images(Path(workdir.name), args.n, (640, 480))
+    inputs = torch.stack([app.load_image(p) for p in paths]).to(device)
+
+    reference = app.ImageTower(model).eval()
+    with torch.no_grad():
+        expected = normalized(reference(inputs))
+
+    report = {"service": args.service, "images": len(paths), "backends": {}}
+    for backend in args.backends.split(","):
+        started = time.perf_counter()
+        try:
+            encode = app.make_encoder(app.ImageTower(model), backend)
+        except Exception as e:
+            report["backends"][backend] = {"error": str(e)}
+            continue
+        result = {"setup_s": time.perf_counter() - started}
+        result.update(measure(encode, inputs, args.batch, args.runs))
+        with torch.no_grad():
+            cosine = (normalized(encode(inputs)) * expected).sum(axis=1)
+        result["cosine_min"] = float(cosine.min())
+        result["cosine_mean"] = float(cosine.mean())
+        report["backends"][backend] = result
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Сверка и замер быстрого препроцессинга против штатного процессора модели.
+
+Запуск из корня репозитория (модель сервиса загружается как при старте API):
+
+    python benchmarks/preprocess.py search
+    python benchmarks/preprocess.py qdrant_search --images ./products --n 200
+
+Без --images генерируются синтетические JPEG размера --size (по умолчанию
+как у фото с телефона). Результат — JSON в stdout:
+  parity      — расхождение тензоров на полностью декодированной картинке
+                (должно быть на уровне округления float32, это же проверяет
+                tests/test_preprocess.py);
+  draft       — расхождение тензоров и косинус эмбеддингов при draft-декодировании
+                JPEG (приближение, поэтому сравниваем и по эмбеддингам);
+  reference_ms / fast_ms — время декодирования + препроцессинга на картинку.
+"""
+
+import argparse
+import importlib.util
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parent.parent
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+
+def load_service(name: str, with_model: bool = True):
+    path = ROOT / name / "application.py"
+    if str(ROOT) not in sys.path:
+        sys.path.insert(0, str(ROOT))  # сервисы импортируют общий пакет common
+    spec = importlib.util.spec_from_file_location(f"{name}_application", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if with_model:
+        module.load_model()  # сервис грузит веса в фоне после старта, здесь — сразу
+    return module
+
+
+def reference_transform(app):
+    """Штатный путь сервиса до быстрого препроцессинга."""
+    if hasattr(app, "clip_processor"):
+        return lambda image: app.clip_processor(images=image, return_tensors="pt")[
+            "pixel_values"
+        ][0]
+    return app.preprocess
+
+
+def synthetic_images(directory: Path, n: int, size: tuple[int, int]) -> list[Path]:
+    # плавный градиент с шумом: JPEG с ним ведёт себя как с фото, а не как с шумом
+    rng = np.random.default_rng(0)
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width]
+    paths = []
+    for i in range(n):
+        base = np.stack(
+            [(x * (i + 1)) % 256, (y * 3) % 256, ((x + y) // (i + 2)) % 256], axis=-1
+        )
+        noise = rng.integers(-12, 12, base.shape)
+        pixels = np.clip(base + noise, 0, 255).astype("uint8")
+        path = directory / f"synthetic_{i}.jpg"
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def timed(fn, paths: list[Path]) -> tuple[list[torch.Tensor], np.ndarray]:
+    tensors, times = [], []
+    for path in paths:
+        started = time.perf_counter()
+        tensors.append(fn(path))
+        times.append((time.perf_counter() - started) * 1000)
+    return tensors, np.array(times)
+
+
+def summary(times: np.ndarray) -> dict:
+    return {
+        "mean": float(times.mean()),
+        "p50": float(np.percentile(times, 50)),
+        "p95": float(np.percentile(times, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("service", choices=["search", "qdrant_search"])
+    parser.add_argument("--images", type=Path, help="папка с картинками")
+    parser.add_argument("--n", type=int, default=50)
+    parser.add_argument("--size", default="4032x3024", help="размер синтетики WxH")
+    args = parser.parse_args()
+
+    app = load_service(args.service)
+    reference = reference_transform(app)
+
+    workdir = tempfile.TemporaryDirectory()
+    if args.images:
+        paths = sorted(
+            p for p in args.images.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS
+        )[: args.n]
+    else:
+        size = tuple(int(v) for v in args.size.split("x"))
+        paths = synthetic_images(Path(workdir.name), args.n, size)
+    if not paths:
+        sys.exit("Нет картинок для замера")
+
+    # прогрев: первые вызовы PIL и torch заметно медленнее
+    reference(Image.open(paths[0]).convert("RGB"))
+    app.load_image(paths[0])
+
+    ref_tensors, ref_times = timed(
+        lambda p: reference(Image.open(p).convert("RGB")), paths
+    )
+    fast_tensors, fast_times = timed(app.load_image, paths)
+
+    # без draft-декодирования быстрый путь должен совпадать с эталоном
+    exact = [app.preprocess_image(Image.open(p).convert("RGB")) for p in paths]
+    parity = max(float((a - b).abs().max()) for a, b in zip(ref_tensors, exact))
+
+    draft_diff = max(
+        float((a - b).abs().max()) for a, b in zip(ref_tensors, fast_tensors)
+    )
+    ref_vectors = app.embed_batch(torch.stack(ref_tensors))
+    fast_vectors = app.embed_batch(torch.stack(fast_tensors))
+    cosine = (ref_vectors * fast_vectors).sum(axis=1)
+
+    print(
+        json.dumps(
+            {
+                "service": args.service,
+                "images": len(paths),
+                "source": str(args.images) if args.images else f"synthetic {args.size}",
+                "parity": {"max_abs_diff": parity},
+                "draft": {
+                    "max_abs_diff": draft_diff,
+                    "embedding_cosine_min": float(cosine.min()),
+                    "embedding_cosine_mean": float(cosine.mean()),
+                },
+                "reference_ms": summary(ref_times),
+                "fast_ms": summary(fast_times),
+                "speedup": float(ref_times.mean() / fast_times.mean()),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
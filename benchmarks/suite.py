@@ -0,0 +1,385 @@
+"""
+Сквозной бенчмарк сервиса: индексация с нуля, задержка и пропускная
+способность /search/, память и recall относительно точного поиска.
+
+Запуск из корня репозитория:
+
+    python benchmarks/suite.py search
+    python benchmarks/suite.py qdrant_search --products 500 --photos 4
+    python benchmarks/suite.py search --out before.json
+    python benchmarks/suite.py search --baseline before.json
+
+Каталог products/ генерируется синтетически (сеть не нужна) во временной
+папке, туда же пишутся кэш эмбеддингов и снапшоты — каждый запуск начинается
+с холодного старта. Qdrant по умолчанию работает в памяти процесса
+(QDRANT_LOCATION=:memory:). Запросы идут в FastAPI-приложение через
+in-process ASGI-клиент, без сети и uvicorn.
+
+Результат — JSON в stdout (и в --out): коммит, параметры, настройки из
+окружения и метрики:
+  indexing   — загрузка модели, индексация каталога с холодным кэшем
+               эмбеддингов (и картинок в секунду), повторная — с тёплым;
+  latency_ms — последовательные /search/ с разными картинками;
+  throughput — --concurrency одновременных клиентов, запросов в секунду;
+  memory_mb  — RSS после каждого этапа и пик;
+  recall     — доля товаров из точного перебора в выдаче /search/ (max по
+               фото товара) и доля запросов, где нашёлся исходный товар.
+С --baseline к отчёту добавляется delta — относительное изменение каждой
+числовой метрики против прошлого отчёта.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+import numpy as np
+from PIL import Image
+
+from preprocess import ROOT, load_service
+
+ENV_PREFIXES = (
+    "FAISS_",
+    "QDRANT_",
+    "SEARCH_",
+    "INDEX_",
+    "ENCODER_",
+    "QUERY_CACHE",
+    "RESULT_CACHE",
+    "INFERENCE_",
+    "TORCH_",
+)
+METRIC_SECTIONS = ("indexing", "latency_ms", "throughput", "memory_mb", "recall")
+
+
+def product_pattern(rng: np.random.Generator, size: tuple[int, int]) -> np.ndarray:
+    # крупные цветные пятна поверх градиента: у каждого товара свой «рисунок»
+    width, height = size
+    blocks = rng.integers(0, 256, (6, 8, 3)).astype("uint8")
+    pattern = np.asarray(
+        Image.fromarray(blocks).resize((width + 64, height + 64), Image.BILINEAR),
+        dtype="int16",
+    )
+    y, x = np.mgrid[0 : height + 64, 0 : width + 64]
+    return pattern + ((x + y) * rng.integers(1, 4) // 16 % 32)[..., None]
+
+
+def photo_variant(
+    pattern: np.ndarray, rng: np.random.Generator, size: tuple[int, int]
+) -> bytes:
+    # ракурс — сдвиг кадра, освещение — яркость, плюс шум сенсора
+    width, height = size
+    dx, dy = rng.integers(0, 64, 2)
+    crop = pattern[dy : dy + height, dx : dx + width]
+    pixels = crop + rng.integers(-20, 20) + rng.integers(-10, 10, crop.shape)
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype("uint8")).save(
+        buffer, "JPEG", quality=90
+    )
+    return buffer.getvalue()
+
+
+def make_catalog(
+    data_dir: Path, products: int, photos: int, size: tuple[int, int], seed: int
+) -> dict[str, np.ndarray]:
+    patterns = {}
+    for p in range(products):
+        rng = np.random.default_rng([seed, p])
+        product_id = f"{100000000000 + p}"
+        patterns[product_id] = product_pattern(rng, size)
+        product_dir = data_dir / product_id
+        product_dir.mkdir(parents=True)
+        for i in range(photos):
+            (product_dir / f"photo{i}.jpg").write_bytes(
+                photo_variant(patterns[product_id], rng, size)
+            )
+    return patterns
+
+
+def make_queries(
+    patterns: dict[str, np.ndarray], n: int, size: tuple[int, int], seed: int
+) -> list[tuple[str, bytes]]:
+    # новые ракурсы существующих товаров: в каталоге таких байт нет
+    rng = np.random.default_rng([seed, len(patterns)])
+    product_ids = sorted(patterns)
+    queries = []
+    for _ in range(n):
+        product_id = product_ids[rng.integers(len(product_ids))]
+        queries.append((product_id, photo_variant(patterns[product_id], rng, size)))
+    return queries
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # КБ в Linux
+
+
+def percentiles(times: list[float]) -> dict:
+    times = np.array(times)
+    return {
+        "mean": float(times.mean()),
+        "p50": float(np.percentile(times, 50)),
+        "p95": float(np.percentile(times, 95)),
+        "p99": float(np.percentile(times, 99)),
+        "max": float(times.max()),
+    }
+
+
+def timed(stats: dict, key: str, fn):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stats[key] = stats.get(key, 0) + time.perf_counter() - started
+
+    return wrapper
+
+
+def git_revision() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(
+                ["git", *args], cwd=ROOT, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    status = git("status", "--porcelain")
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(status) if status is not None else None,
+    }
+
+
+async def search(client: httpx.AsyncClient, contents: bytes, k: int) -> tuple:
+    started = time.perf_counter()
+    response = await client.post(
+        "/search/",
+        params={"k": k, "aggregation": "max"},
+        files={"file": ("query.jpg", contents)},
+    )
+    elapsed = (time.perf_counter() - started) * 1000
+    response.raise_for_status()
+    return elapsed, [m["product_id"] for m in response.json()["matches"]]
+
+
+async def run_queries(app, sequential, concurrent, k: int, concurrency: int) -> dict:
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        await search(client, sequential[0][1], k)  # прогрев: первый forward медленнее
+
+        latencies, found = [], []
+        for _, contents in sequential:
+            elapsed, product_ids = await search(client, contents, k)
+            latencies.append(elapsed)
+            found.append(product_ids)
+
+        limit = asyncio.Semaphore(concurrency)
+
+        async def limited(contents):
+            async with limit:
+                return await search(client, contents, k)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(limited(contents) for _, contents in concurrent)
+        )
+        wall = time.perf_counter() - started
+
+    return {
+        "latency_ms": percentiles(latencies),
+        "throughput": {
+            "concurrency": concurrency,
+            "requests": len(concurrent),
+            "wall_s": wall,
+            "requests_per_s": len(concurrent) / wall,
+            "latency_ms": percentiles([elapsed for elapsed, _ in results]),
+        },
+        "found": found,
+    }
+
+
+def exact_products(app, queries, k: int) -> list[list[str]]:
+    """Точный перебор: близость товара — лучшее из его фото, как aggregation=max."""
+    paths, owners = [], []
+    data_dir = Path(app.DATA_DIR)
+    for product_dir in sorted(data_dir.iterdir()):
+        for photo in sorted(product_dir.iterdir()):
+            paths.append(str(photo))
+            owners.append(product_dir.name)
+    catalog = np.vstack([app.file_embedding(path) for path in paths])
+    product_ids, positions = np.unique(owners, return_inverse=True)
+
+    query_vectors = np.concatenate(
+        [app.embed_pixels(app.decode_query(contents)[0]) for _, contents in queries]
+    )
+    truth = []
+    for similarities in query_vectors @ catalog.T:
+        best = np.full(len(product_ids), -np.inf, dtype="float32")
+        np.maximum.at(best, positions, similarities)
+        truth.append([str(product_ids[i]) for i in np.argsort(-best)[:k]])
+    return truth
+
+
+def flatten(report: dict, prefix: str = "") -> dict:
+    values = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{key}"] = value
+    return values
+
+
+def delta(report: dict, baseline: dict) -> dict:
+    """Относительное изменение метрик: +0.1 — на 10% больше, чем в baseline."""
+    before = flatten({key: baseline.get(key, {}) for key in METRIC_SECTIONS})
+    after = flatten({key: report[key] for key in METRIC_SECTIONS})
+    return {
+        key: (after[key] - before[key]) / before[key]
+        for key in after
+        if key in before and before[key]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("service", choices=["search", "qdrant_search"])
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--photos", type=int, default=3, help="фото на товар")
+    parser.add_argument("--size", default="640x480", help="размер фото WxH")
+    parser.add_argument(
+        "--queries", type=int, default=100, help="для задержки и recall"
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--requests", type=int, default=200, help="для пропускной способности"
+    )
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", type=Path, help="вместо временной папки")
+    parser.add_argument("--out", type=Path, help="куда сохранить JSON")
+    parser.add_argument("--baseline", type=Path, help="прошлый отчёт для сравнения")
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.size.split("x"))
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+    out = args.out.resolve() if args.out else None
+
+    workdir = tempfile.TemporaryDirectory()
+    root = args.workdir or Path(workdir.name)
+    root.mkdir(parents=True, exist_ok=True)
+    os.chdir(root)  # DATA_DIR, кэш эмбеддингов и снапшоты сервиса — относительные
+    os.environ["STARTUP_MODE"] = "blocking"
+    if args.service == "qdrant_search":
+        os.environ.setdefault("QDRANT_LOCATION", ":memory:")
+
+    memory = {"start": rss_mb()}
+    started = time.perf_counter()
+    patterns = make_catalog(
+        Path("products"), args.products, args.photos, size, args.seed
+    )
+    queries = make_queries(patterns, args.queries + args.requests, size, args.seed)
+    catalog_s = time.perf_counter() - started
+
+    app = load_service(args.service, with_model=False)
+    memory["imported"] = rss_mb()
+
+    stages = {}
+    app.load_model = timed(stages, "model_load_s", app.load_model)
+    app.build_index_from_folder = timed(
+        stages, "indexing_s", app.build_index_from_folder
+    )
+    app.warm_up()
+    if app.startup_error:
+        sys.exit(f"Сервис не поднялся: {app.startup_error}")
+    memory["indexed"] = rss_mb()
+    images = args.products * args.photos
+    indexing = {
+        "images": images,
+        "catalog_s": catalog_s,
+        "model_load_s": stages["model_load_s"],
+        "indexing_s": stages["indexing_s"],
+        "images_per_s": images / stages["indexing_s"],
+    }
+    started = time.perf_counter()
+    app.build_index_from_folder()  # эмбеддинги уже в кэше на диске
+    indexing["reindex_cached_s"] = time.perf_counter() - started
+
+    sequential, concurrent = queries[: args.queries], queries[args.queries :]
+    measured = asyncio.run(
+        run_queries(app, sequential, concurrent, args.k, args.concurrency)
+    )
+    memory["served"] = rss_mb()
+    memory["peak"] = peak_rss_mb()
+
+    truth = exact_products(app, sequential, args.k)
+    found = measured.pop("found")
+    recall = {
+        "k": args.k,
+        "recall_vs_exact": float(
+            np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+        ),
+        "source_product_hit": float(
+            np.mean([product_id in f for (product_id, _), f in zip(sequential, found)])
+        ),
+    }
+
+    report = {
+        "service": args.service,
+        **git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "device": getattr(app, "device", None) or getattr(app, "DEVICE", None),
+        },
+        "params": {
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in vars(args).items()
+            if key not in ("out", "baseline", "workdir")
+        },
+        "env": {
+            key: value
+            for key, value in sorted(os.environ.items())
+            if key.startswith(ENV_PREFIXES)
+        },
+        "indexing": indexing,
+        **measured,
+        "memory_mb": memory,
+        "recall": recall,
+    }
+    if baseline:
+        report["baseline"] = {
+            "commit": baseline.get("commit"),
+            "timestamp": baseline.get("timestamp"),
+        }
+        report["delta"] = delta(report, baseline)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if out:
+        out.write_text(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Общая инфраструктура сервисов поиска (FAISS и Qdrant)."""
@@ -0,0 +1,65 @@
+"""Кэш в памяти с TTL и бюджетом по байтам."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    LRU с TTL и бюджетом по байтам: при переполнении вытесняются самые
+    давно использованные записи. Размер записи передаёт вызывающий.
+    Трогается и из event loop, и из потоков индексации — под блокировкой.
+    """
+
+    def __init__(self, max_mb: float, ttl_s: float):
+        self.max_bytes = int(max_mb * 2**20)
+        self.ttl = ttl_s
+        self.items = OrderedDict()  # key -> (истекает, размер, значение)
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self.items.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[2]
+
+    def put(self, key, value, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self.items:
+                self._drop(key)
+            self.items[key] = (time.monotonic() + self.ttl, size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self.items)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        self.bytes -= self.items.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.items),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,150 @@
+"""Кэш эмбеддингов на диске."""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+class EmbeddingStore:
+    """
+    Контентно-адресуемое хранилище эмбеддингов.
+
+    Ключ — sha256 содержимого файла, модель и версия препроцессинга задают
+    отдельный каталог. Векторы лежат одной float32-матрицей (memmap),
+    digests.txt хранит digest строки i в строке i, files.json — stat-кэш
+    path -> [mtime_ns, size, digest], чтобы не перечитывать неизменённые файлы.
+    """
+
+    def __init__(self, root: str, model_name: str, dim: int, version: int):
+        self.dir = Path(root) / f"{model_name.replace('/', '--')}-v{version}"
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        self.matrix_path = self.dir / "vectors.f32"
+        self.digests_path = self.dir / "digests.txt"
+        self.files_path = self.dir / "files.json"
+        self._matrix = None
+        # rows и files трогают пул потоков, индексация и наблюдение за папкой
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        digests = []
+        stored = self.matrix_path.stat().st_size if self.matrix_path.exists() else 0
+        if self.digests_path.exists():
+            # после последнего \n — оборванная строка; digest'ы без пары в
+            # матрице тоже отбрасываем. Файл обрезаем по последней целой
+            # строке, иначе put_many допишет следующую к обрывку
+            digests = self.digests_path.read_text().split("\n")[:-1]
+            digests = digests[: stored // (dim * 4)]
+            os.truncate(self.digests_path, sum(len(d) + 1 for d in digests))
+        self.rows: dict[str, int] = {d: i for i, d in enumerate(digests)}
+        self.files: dict[str, list] = {}
+        if self.files_path.exists():
+            self.files = json.loads(self.files_path.read_text())
+
+    def digest(self, path: str) -> str:
+        st = os.stat(path)
+        with self._lock:
+            cached = self.files.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2]
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        with self._lock:
+            self.files[path] = [st.st_mtime_ns, st.st_size, digest]
+        return digest
+
+    def get(self, digest: str) -> np.ndarray | None:
+        found, vectors = self.get_many([digest])
+        return vectors if found[0] else None
+
+    def get_many(self, digests: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Возвращает маску найденных digest'ов и их векторы (только найденные).
+        """
+        rows = np.fromiter((self.rows.get(d, -1) for d in digests), np.int64)
+        found = rows >= 0
+        return found, self.vectors(rows[found])
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        """Векторы по номерам строк; с диска читаются только нужные страницы."""
+        if not len(rows):
+            return np.empty((0, self.dim), dtype="float32")
+        with self._lock:
+            if self._matrix is None or len(self._matrix) <= rows.max():
+                self._matrix = np.memmap(
+                    self.matrix_path,
+                    dtype="float32",
+                    mode="r",
+                    shape=(len(self.rows), self.dim),
+                )
+            matrix = self._matrix
+        return np.asarray(matrix[rows])
+
+    def rows_for(self, paths: list[str]) -> np.ndarray:
+        """Строки матрицы с векторами уже закэшированных файлов, -1 — нет."""
+        rows = []
+        for path in paths:
+            try:
+                rows.append(self.rows.get(self.digest(path), -1))
+            except OSError:
+                rows.append(-1)
+        return np.array(rows, dtype="int64")
+
+    def put(self, digest: str, vector: np.ndarray):
+        self.put_many([digest], vector)
+
+    def put_many(self, digests: list[str], vectors: np.ndarray):
+        with self._lock:
+            fresh = {}
+            for digest, vector in zip(digests, vectors):
+                if digest not in self.rows:
+                    fresh[digest] = vector
+            if not fresh:
+                return
+            row = len(self.rows)
+            # сначала векторы, потом digest'ы: строки без вектора не бывает,
+            # fsync не даёт диску сохранить digest'ы раньше векторов
+            fd = os.open(self.matrix_path, os.O_RDWR | os.O_CREAT)
+            try:
+                os.pwrite(
+                    fd,
+                    np.ascontiguousarray(
+                        list(fresh.values()), dtype="float32"
+                    ).tobytes(),
+                    row * self.dim * 4,
+                )
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with open(self.digests_path, "a") as f:
+                f.write("".join(d + "\n" for d in fresh))
+            for i, digest in enumerate(fresh):
+                self.rows[digest] = row + i
+
+    def is_fresh(self, path: str) -> bool:
+        """
+        Файл не менялся с момента, когда мы его хешировали.
+        """
+        with self._lock:
+            cached = self.files.get(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return bool(cached) and (cached[0], cached[1]) == (st.st_mtime_ns, st.st_size)
+
+    def retain_files(self, paths):
+        with self._lock:
+            self.files = {p: self.files[p] for p in paths if p in self.files}
+
+    def flush(self):
+        with self._lock:
+            files = dict(self.files)
+        with self._flush_lock:  # общий tmp-файл: две записи сразу не пускаем
+            tmp = self.files_path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(files))
+            os.replace(tmp, self.files_path)
@@ -0,0 +1,86 @@
+"""Бэкенды картиночного энкодера: общее у сервисов FAISS и Qdrant."""
+
+import os
+from pathlib import Path
+
+import torch
+
+# eager | int8 | bf16 | torchscript | onnx, см. make_encoder
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "eager")
+ENCODER_CACHE_DIR = Path(os.getenv("ENCODER_CACHE_DIR", "./encoders"))
+
+
+def autocast_encoder(tower: torch.nn.Module, dtype: torch.dtype, device: str):
+    def encode(pixel_values: torch.Tensor) -> torch.Tensor:
+        with torch.autocast(device, dtype=dtype):
+            return tower(pixel_values).float()
+
+    return encode
+
+
+def onnx_encoder(tower: torch.nn.Module, example: torch.Tensor, name: str):
+    """Экспорт в ONNX (один раз, в ENCODER_CACHE_DIR) и запуск в onnxruntime."""
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise RuntimeError("ENCODER_BACKEND=onnx требует пакет onnxruntime") from e
+    path = ENCODER_CACHE_DIR / f"{name.replace('/', '--')}.onnx"
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        torch.onnx.export(
+            tower,
+            (example,),
+            str(tmp),
+            input_names=["pixel_values"],
+            output_names=["features"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "features": {0: "batch"}},
+            opset_version=17,
+            dynamo=False,
+        )
+        os.replace(tmp, path)
+    session = onnxruntime.InferenceSession(
+        str(path), providers=["CPUExecutionProvider"]
+    )
+
+    def encode(pixel_values: torch.Tensor) -> torch.Tensor:
+        [features] = session.run(None, {"pixel_values": pixel_values.cpu().numpy()})
+        return torch.from_numpy(features)
+
+    return encode
+
+
+def make_encoder(
+    tower: torch.nn.Module, backend: str, name: str, device: str, crop_size: int
+):
+    """
+    Возвращает функцию pixel_values -> признаки float32:
+    eager       — как есть (fp32 на CPU, fp16 autocast на GPU);
+    int8        — динамическая int8-квантизация Linear-слоёв, только CPU;
+    bf16        — autocast в bfloat16 (на CPU быстро при AVX512-BF16/AMX);
+    torchscript — trace + freeze графа;
+    onnx        — экспорт в ONNX и onnxruntime (опциональная зависимость).
+    name различает ONNX-экспорты разных моделей в ENCODER_CACHE_DIR.
+    """
+    tower.eval()
+    example = torch.zeros(1, 3, crop_size, crop_size, device=device)
+    if backend == "eager":
+        if device == "cuda":
+            return autocast_encoder(tower, torch.float16, device)
+        return tower
+    if backend == "bf16":
+        if device == "cpu" and not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            print("CPU без bf16-инструкций: bf16 будет медленнее fp32")
+        return autocast_encoder(tower, torch.bfloat16, device)
+    if backend == "int8":
+        if device != "cpu":
+            raise ValueError("ENCODER_BACKEND=int8 поддерживается только на CPU")
+        return torch.ao.quantization.quantize_dynamic(
+            tower, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    if backend == "torchscript":
+        with torch.no_grad():
+            return torch.jit.freeze(torch.jit.trace(tower, example))
+    if backend == "onnx":
+        return onnx_encoder(tower, example, name)
+    raise ValueError(f"Неизвестный ENCODER_BACKEND: {backend}")
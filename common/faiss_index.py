@@ -0,0 +1,90 @@
+"""Сборка и настройка FAISS-индексов: общее у сервиса FAISS и его шардов."""
+
+import os
+from typing import BinaryIO
+
+import faiss
+import numpy as np
+
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+
+
+def configure_index(index: faiss.Index):
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = FAISS_NPROBE
+    inner = faiss.downcast_index(getattr(index, "index", index))
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = FAISS_EF_SEARCH
+
+
+def make_index(spec: str, dim: int) -> faiss.Index:
+    # IVF хранит id сам; IDMap2 поверх IVF после remove_ids путает id векторов
+    index = faiss.index_factory(dim, spec, faiss.METRIC_INNER_PRODUCT)
+    if faiss.try_extract_index_ivf(index) is None:
+        index = faiss.index_factory(dim, f"IDMap2,{spec}", faiss.METRIC_INNER_PRODUCT)
+    configure_index(index)
+    return index
+
+
+def remove_vectors(target: faiss.Index, ids: np.ndarray, spec: str) -> faiss.Index:
+    """
+    Убирает векторы из индекса и возвращает его. HNSW удалять не умеет:
+    тогда индекс типа spec пересобирается из оставшихся векторов.
+    """
+    try:
+        target.remove_ids(ids)
+        return target
+    except RuntimeError:
+        kept = faiss.vector_to_array(target.id_map)
+        kept = kept[~np.isin(kept, ids)]
+        rebuilt = make_index(spec, target.d)
+        rebuilt.add_with_ids(target.reconstruct_batch(kept), kept)
+        return rebuilt
+
+
+def mmap_flags(spec: str) -> int:
+    """
+    IVF-списки faiss читает через mmap по IO_FLAG_MMAP. Плоские коды и HNSW —
+    по IO_FLAG_MMAP_IFC, если версия его знает; с IVF этот флаг не сочетается:
+    read_index падает с "mmap only supported for File objects".
+    """
+    if "IVF" in spec:
+        return faiss.IO_FLAG_MMAP
+    return faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+
+def open_mapped(path: str, spec: str) -> tuple[faiss.Index, BinaryIO]:
+    """
+    Открывает индекс типа spec через mmap вместе с его файлом. Снапшот может
+    удалить другой воркер, пишущий в тот же каталог, поэтому перечитывать и
+    копировать индекс дальше надо через открытый файл, а не по пути.
+    """
+    file = open(path, "rb")
+    index = faiss.read_index(str(path), mmap_flags(spec))
+    configure_index(index)
+    return index, file
+
+
+def read_mapped(file: BinaryIO) -> faiss.Index:
+    """Читает индекс из файла open_mapped целиком в память."""
+    offset = 0
+
+    def read(size: int) -> bytes:
+        nonlocal offset
+        # pread не двигает позицию файла: копия для снапшота может идти параллельно
+        chunk = os.pread(file.fileno(), size, offset)
+        offset += len(chunk)
+        return chunk
+
+    return faiss.read_index(faiss.PyCallbackIOReader(read))
+
+
+def copy_mapped(file: BinaryIO, path: str):
+    """Копирует файл open_mapped в path."""
+    offset = 0
+    with open(path, "wb") as out:
+        while chunk := os.pread(file.fileno(), 1 << 20, offset):
+            out.write(chunk)
+            offset += len(chunk)
@@ -0,0 +1,79 @@
+"""Группировка попаданий по товарам: общее у сервисов FAISS и Qdrant."""
+
+import os
+from typing import Callable, Literal
+
+import numpy as np
+
+Aggregation = Literal["max", "mean_top_m", "sum"]
+SEARCH_AGGREGATION = os.getenv("SEARCH_AGGREGATION", "max")
+SEARCH_TOP_M = int(os.getenv("SEARCH_TOP_M", "3"))
+SEARCH_OVERFETCH = int(os.getenv("SEARCH_OVERFETCH", "4"))  # векторов на товар
+PHOTOS_PER_PRODUCT = 5
+
+
+def group_hits(
+    similarities: np.ndarray,
+    positions: np.ndarray,
+    k: int,
+    aggregation: Aggregation = "max",
+    top_m: int = SEARCH_TOP_M,
+):
+    """
+    Группирует попадания по товарам целиком в numpy.
+    Возвращает [(товар, оценка, индексы попаданий по убыванию близости)]
+    для top-k товаров. Оценка товара: max — лучшее фото, mean_top_m —
+    среднее m лучших, sum — сумма близостей всех найденных фото.
+    """
+    if not len(positions):
+        return []
+    # по товару, внутри товара — по убыванию близости
+    order = np.lexsort((-similarities, positions))
+    ranked = similarities[order]
+    starts = np.flatnonzero(np.r_[True, np.diff(positions[order]) != 0])
+    counts = np.diff(np.r_[starts, len(order)])
+
+    if aggregation == "max":
+        scores = ranked[starts]
+    elif aggregation == "sum":
+        scores = np.add.reduceat(ranked, starts)
+    else:
+        top_m = max(top_m, 1)
+        rank = np.arange(len(order)) - np.repeat(starts, counts)
+        top = np.where(rank < top_m, ranked, 0)
+        scores = np.add.reduceat(top, starts) / np.minimum(counts, top_m)
+
+    best = np.argsort(-scores, kind="stable")[:k]
+    return [
+        (
+            int(positions[order[starts[g]]]),
+            float(scores[g]),
+            order[starts[g] : starts[g] + min(counts[g], PHOTOS_PER_PRODUCT)],
+        )
+        for g in best
+    ]
+
+
+def match_products(
+    similarities: np.ndarray,
+    positions: np.ndarray,
+    k: int,
+    aggregation: Aggregation,
+    top_m: int,
+    product_id: Callable[[int], str],
+    photo: Callable[[int], str],
+) -> list[dict]:
+    """
+    Выдача group_hits в ответ API; product_id(номер товара) и photo(индекс
+    попадания) дают строки, пути собираются только для вошедших в выдачу.
+    """
+    return [
+        {
+            "product_id": product_id(position),
+            "score": score,
+            "photos": [photo(hit) for hit in hits],
+        }
+        for position, score, hits in group_hits(
+            similarities, positions, k, aggregation, top_m
+        )
+    ]
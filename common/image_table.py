@@ -0,0 +1,182 @@
+"""Метаданные векторов FAISS: товары и фото в numpy-массивах."""
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+class ImageTable:
+    """
+    Метаданные векторов FAISS в numpy-массивах, id вектора = номер строки.
+    product[i] — номер товара в product_ids (-1 у удалённых), имя файла —
+    blob[ends[i - 1]:ends[i]]; путь фото — "<product_id>/<имя>" от data_dir;
+    vector_row[i] — строка float32-вектора в кэше эмбеддингов (для точного
+    пересчёта близостей, -1 — нет). На вектор уходит 16 байт плюс имя файла
+    и ещё 12 на порядок строк по товару: его строит первый rows или find,
+    строки, дописанные после сортировки, просматриваются подряд.
+    Массивы растут удвоением, загруженные из снапшота остаются read-only
+    memmap до первой записи. Потокобезопасности нет: сервис зовёт всё, включая
+    чтение (rows и find пересортировывают порядок), под своим index_lock.
+    """
+
+    def __init__(
+        self,
+        data_dir: str,
+        product_ids=None,
+        product=None,
+        ends=None,
+        blob=None,
+        vector_row=None,
+    ):
+        self.data_dir = data_dir
+        self.product_ids: list[str | None] = product_ids or []
+        self.product_pos = {
+            pid: i for i, pid in enumerate(self.product_ids) if pid is not None
+        }
+        self.product = np.empty(0, "int32") if product is None else product
+        self.ends = np.empty(0, "int64") if ends is None else ends
+        self.blob = np.empty(0, "uint8") if blob is None else blob
+        self.vector_row = np.empty(0, "int32") if vector_row is None else vector_row
+        self.n = len(self.product)
+        self.blob_size = int(self.ends[-1]) if self.n else 0
+        # первые sorted_n строк, упорядоченные по товару: order — номера строк,
+        # sorted_product — их товары на момент сортировки
+        self.order = np.empty(0, "int64")
+        self.sorted_product = np.empty(0, "int32")
+        self.sorted_n = 0
+
+    def __len__(self):
+        return self.n
+
+    @staticmethod
+    def _reserve(array: np.ndarray, size: int) -> np.ndarray:
+        if size <= len(array) and array.flags.writeable:
+            return array
+        grown = np.empty(max(size, 2 * len(array), 1024), dtype=array.dtype)
+        grown[: len(array)] = array
+        return grown
+
+    def add_product(self, product_id: str):
+        if product_id not in self.product_pos:
+            self.product_pos[product_id] = len(self.product_ids)
+            self.product_ids.append(product_id)
+
+    def has_product(self, product_id: str) -> bool:
+        return product_id in self.product_pos
+
+    def products(self) -> list[str]:
+        return list(self.product_pos)
+
+    def append(
+        self, batch: list[tuple[str, str]], vector_rows: np.ndarray
+    ) -> np.ndarray:
+        names = [os.path.basename(image_path).encode() for _, image_path in batch]
+        data = b"".join(names)
+        start, end = self.n, self.n + len(batch)
+        self.product = self._reserve(self.product, end)
+        self.ends = self._reserve(self.ends, end)
+        self.vector_row = self._reserve(self.vector_row, end)
+        self.blob = self._reserve(self.blob, self.blob_size + len(data))
+        self.product[start:end] = [self.product_pos[pid] for pid, _ in batch]
+        self.vector_row[start:end] = vector_rows
+        self.ends[start:end] = self.blob_size + np.cumsum([len(n) for n in names])
+        self.blob[self.blob_size : self.blob_size + len(data)] = np.frombuffer(
+            data, dtype="uint8"
+        )
+        self.blob_size += len(data)
+        self.n = end
+        return np.arange(start, end)
+
+    def remove(self, ids: np.ndarray):
+        self.product = self._reserve(self.product, self.n)
+        self.product[ids] = -1
+
+    def _sort_by_product(self):
+        self.order = np.argsort(self.product[: self.n], kind="stable")
+        self.sorted_product = self.product[self.order]
+        self.sorted_n = self.n
+
+    def rows(self, product_id: str) -> np.ndarray:
+        position = self.product_pos.get(product_id)
+        if position is None:
+            return np.empty(0, dtype="int64")
+        if self.n - self.sorted_n > max(4096, self.sorted_n // 16):
+            self._sort_by_product()
+        lo, hi = np.searchsorted(self.sorted_product, [position, position + 1])
+        # remove только гасит строки, поэтому старый порядок не врёт,
+        # а лишь содержит удалённые: отсеиваем их по текущему product
+        rows = self.order[lo:hi]
+        rows = rows[self.product[rows] == position]
+        tail = np.flatnonzero(self.product[self.sorted_n : self.n] == position)
+        return np.concatenate([rows, tail + self.sorted_n])
+
+    def drop_product(self, product_id: str) -> np.ndarray:
+        ids = self.rows(product_id)
+        self.remove(ids)
+        position = self.product_pos.pop(product_id, None)
+        if position is not None:
+            self.product_ids[position] = None
+        return ids
+
+    def name(self, i: int) -> str:
+        start = self.ends[i - 1] if i else 0
+        return bytes(self.blob[start : self.ends[i]]).decode()
+
+    def rel_path(self, i: int) -> str:
+        return f"{self.product_ids[self.product[i]]}/{self.name(i)}"
+
+    def path(self, i: int) -> str:
+        return os.path.join(self.data_dir, self.rel_path(i))
+
+    def find(self, product_id: str, filename: str) -> int | None:
+        for i in self.rows(product_id):
+            if self.name(i) == filename:
+                return int(i)
+        return None
+
+    def live_ids(self) -> np.ndarray:
+        return np.flatnonzero(self.product[: self.n] >= 0)
+
+    def is_live(self, ids: np.ndarray) -> np.ndarray:
+        live = ids >= 0
+        live[live] = self.product[ids[live]] >= 0
+        return live
+
+    def paths(self) -> list[str]:
+        return [self.path(i) for i in self.live_ids()]
+
+    def saver(self):
+        """
+        Снимает срез таблицы (под index_lock) и возвращает save(directory),
+        который пишет его уже без блокировки. ends, vector_row и blob только
+        дописываются, поэтому их срезы не копируем; product меняет remove.
+        """
+        product = self.product[: self.n].copy()
+        ends, vector_row = self.ends[: self.n], self.vector_row[: self.n]
+        blob, product_ids = self.blob[: self.blob_size], json.dumps(self.product_ids)
+
+        def save(directory: Path):
+            np.save(directory / "product_index.npy", product)
+            np.save(directory / "name_ends.npy", ends)
+            np.save(directory / "vector_rows.npy", vector_row)
+            blob.tofile(directory / "names.bin")
+            (directory / "products.json").write_text(product_ids)
+
+        return save
+
+    @classmethod
+    def load(cls, directory: Path, data_dir: str) -> "ImageTable":
+        product = np.load(directory / "product_index.npy", mmap_mode="r")
+        product_ids = json.loads((directory / "products.json").read_text())
+        if not len(product):
+            return cls(data_dir, product_ids)
+        return cls(
+            data_dir,
+            product_ids,
+            product,
+            np.load(directory / "name_ends.npy", mmap_mode="r"),
+            np.memmap(directory / "names.bin", dtype="uint8", mode="r"),
+            np.load(directory / "vector_rows.npy", mmap_mode="r"),
+        )
@@ -0,0 +1,143 @@
+"""Массовый импорт каталога из tar/zip: общее у сервисов FAISS и Qdrant."""
+
+import os
+import shutil
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Callable
+
+IMPORT_CHUNK = int(os.getenv("IMPORT_CHUNK", "2048"))  # фото на порцию индексации
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"}
+
+
+def archive_entries(archive_path: str):
+    """Генератор (имя в архиве, file-объект) по файлам tar/zip."""
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as f:
+                        yield info.filename, f
+        return
+    with tarfile.open(archive_path, "r:*") as archive:
+        for member in archive:
+            if member.isfile():
+                yield member.name, archive.extractfile(member)
+
+
+def import_target(name: str) -> tuple[str, str] | None:
+    """
+    Раскладка архива как в products/: <product_id>/<файл>, допускается общая
+    папка сверху. Возвращает (product_id, имя файла) или None, если пропускаем.
+    """
+    parts = PurePosixPath(name).parts
+    if len(parts) < 2 or any(p.startswith(".") or p == "__MACOSX" for p in parts):
+        return None
+    if Path(parts[-1]).suffix.lower() not in IMAGE_EXTENSIONS:
+        return None
+    return parts[-2], parts[-1]
+
+
+class CatalogImport:
+    """
+    Импорты архивов в data_dir, по одному в фоне. Архив распаковывается прямо
+    в каталог и индексируется порциями по chunk_size через index_chunk(job,
+    [(product_id, путь), …]). Хуки сервиса зовутся под catalog_lock:
+    add_product(product_id) — True, если товар новый; replace(product_id,
+    имя файла) — убрать из индекса вектор перезаписываемого фото. finish()
+    зовётся после последней порции. Распакованные, но ещё не
+    проиндексированные пути лежат в importing: наблюдатель за папкой их
+    не трогает, а index_chunk убирает оттуда свою порцию сам.
+    """
+
+    def __init__(
+        self,
+        data_dir: str,
+        catalog_lock: threading.Lock,
+        importing: set[str],
+        add_product: Callable[[str], bool],
+        index_chunk: Callable[[dict, list[tuple[str, str]]], None],
+        finish: Callable[[], None],
+        replace: Callable[[str, str], None] | None = None,
+        chunk_size: int = IMPORT_CHUNK,
+    ):
+        self.data_dir = data_dir
+        self.catalog_lock = catalog_lock
+        self.importing = importing
+        self.add_product = add_product
+        self.index_chunk = index_chunk
+        self.finish = finish
+        self.replace = replace
+        self.chunk_size = chunk_size
+        self.jobs: dict[str, dict] = {}  # job_id -> статус, живёт до рестарта
+        self.pool = ThreadPoolExecutor(1, thread_name_prefix="import")
+
+    def start(self, archive_path: str) -> dict:
+        job_id = uuid.uuid4().hex
+        self.jobs[job_id] = job = {
+            "job_id": job_id,
+            "status": "queued",
+            "products": 0,  # новых товаров
+            "extracted": 0,
+            "indexed": 0,
+            "skipped": 0,  # не фото или лишние файлы
+            "duplicates": 0,  # путь повторился в архиве: остаётся последний файл
+            "failed": 0,  # не удалось прочитать картинку
+            "error": None,
+            "created_at": time.time(),
+            "finished_at": None,
+        }
+        self.pool.submit(self.run, job, archive_path)
+        return job
+
+    def run(self, job: dict, archive_path: str):
+        """Повторный импорт того же файла заменяет фото и его вектор."""
+        job["status"] = "running"
+        chunk = []
+        queued = set()  # пути текущей порции: повтор в архиве не индексируем дважды
+        try:
+            for name, f in archive_entries(archive_path):
+                target = import_target(name)
+                if target is None:
+                    job["skipped"] += 1
+                    continue
+                product_id, filename = target
+                product_dir = os.path.join(self.data_dir, product_id)
+                image_path = os.path.join(product_dir, filename)
+                with self.catalog_lock:
+                    os.makedirs(product_dir, exist_ok=True)
+                    if self.add_product(product_id):
+                        job["products"] += 1
+                    if image_path in queued:
+                        # ещё не проиндексирован: достаточно перезаписать файл
+                        job["duplicates"] += 1
+                    else:
+                        if self.replace is not None:
+                            self.replace(product_id, filename)
+                        self.importing.add(image_path)
+                        chunk.append((product_id, image_path))
+                        queued.add(image_path)
+                    with open(image_path, "wb") as out:
+                        shutil.copyfileobj(f, out)
+                job["extracted"] += 1
+                if len(chunk) >= self.chunk_size:
+                    self.index_chunk(job, chunk)
+                    chunk = []
+                    queued.clear()
+            if chunk:
+                self.index_chunk(job, chunk)
+            self.finish()
+            job["status"] = "done"
+        except Exception as e:
+            print(f"Импорт {job['job_id']} упал: {e}")
+            job["status"] = "failed"
+            job["error"] = str(e)
+            self.importing.difference_update(image_path for _, image_path in chunk)
+        finally:
+            job["finished_at"] = time.time()
+            os.remove(archive_path)
@@ -0,0 +1,141 @@
+"""Микробатчинг онлайн-запросов к модели и пул для CPU-работы вне event loop."""
+
+import asyncio
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
+
+import numpy as np
+import torch
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from common.metrics import StageTimers
+
+
+class BatchScheduler:
+    """
+    Микробатчинг онлайн-запросов к модели. Запрос кладёт препроцессированный
+    тензор в очередь; фоновый поток берёт первый, добирает до max_batch штук,
+    но ждёт не дольше max_wait_ms, делает один forward и разрешает future
+    каждого запроса его строкой эмбеддинга.
+    """
+
+    def __init__(
+        self, embed_fn, max_batch: int, max_wait_ms: float, timers: StageTimers
+    ):
+        self.embed_fn = embed_fn
+        self.timers = timers
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.batch_sizes = Counter()  # размер батча -> сколько раз был
+        threading.Thread(target=self._run, name="batcher", daemon=True).start()
+
+    def submit(self, tensor: torch.Tensor) -> Future:
+        future = Future()
+        self.queue.put((tensor, future, time.perf_counter()))
+        return future
+
+    async def embed(self, tensor: torch.Tensor) -> np.ndarray:
+        return await asyncio.wrap_future(self.submit(tensor))
+
+    def _collect(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # запрос, который уже отменили (клиент отключился, таймаут), в
+            # forward не берём; остальные после этого отменить нельзя
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            tensors, futures, submitted = zip(*batch)
+            try:
+                self.batch_sizes[len(batch)] += 1
+                collected = time.perf_counter()
+                for started in submitted:
+                    self.timers.observe("batch_wait", collected - started)
+                vectors = self.embed_fn(torch.stack(tensors))
+                for future, vector in zip(futures, vectors):
+                    future.set_result(vector[None])
+            except Exception as e:
+                # поток один на процесс: если он умрёт, поиск встанет навсегда
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+        }
+
+
+class InferenceExecutor:
+    """
+    Выносит CPU-работу (хеширование, декодирование, препроцессинг) с event
+    loop в отдельный пул потоков и ограничивает число запросов в обработке:
+    сверх max_pending сразу отвечаем 503, а не копим очередь.
+    Счётчик трогается только из event loop, поэтому без блокировок.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="inference")
+        self.max_pending = max_pending
+        self.pending = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.pending >= self.max_pending:
+            raise HTTPException(
+                status_code=503,
+                detail="Inference queue is full",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    def stats(self) -> dict:
+        return {"pending": self.pending, "max_pending": self.max_pending}
+
+
+class SlotStreamingResponse(StreamingResponse):
+    """
+    Потоковый ответ, который держит слот InferenceExecutor (и всё, что взято
+    в stack) до конца отдачи. Слот занимают до ответа, чтобы 503 пришёл
+    статусом, а отпускают здесь, а не в генераторе: если клиент отключился
+    до начала тела, генератор не запустится и его finally не выполнится.
+    """
+
+    def __init__(self, content, stack: AsyncExitStack, **kwargs):
+        super().__init__(content, **kwargs)
+        self.stack = stack
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.stack.aclose()
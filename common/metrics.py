@@ -0,0 +1,160 @@
+"""Метрики горячего пути в формате Prometheus и сэмплирующий профайлер."""
+
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+
+STAGE_BUCKETS_S = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+class StageTimers:
+    """
+    Гистограммы длительности этапов запроса (чтение, декодирование,
+    препроцессинг, forward, поиск, группировка) с корзинами Prometheus.
+    Этапы идут из разных потоков, поэтому наблюдения — под блокировкой.
+    """
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = {}  # этап -> счётчики по корзинам, последняя — +Inf
+        self.sums = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            counts = self.counts.setdefault(stage, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.sums[stage] += seconds
+
+    def samples(self, labels: dict) -> list[tuple[str, dict, float]]:
+        """Строки гистограммы stage_seconds: _bucket (накопленные), _sum, _count."""
+        with self._lock:
+            counts = {stage: list(c) for stage, c in self.counts.items()}
+            sums = dict(self.sums)
+        samples = []
+        for stage, stage_counts in sorted(counts.items()):
+            stage_labels = {**labels, "stage": stage}
+            total = 0
+            for le, count in zip((*self.buckets, "+Inf"), stage_counts):
+                total += count
+                samples.append(("_bucket", {**stage_labels, "le": str(le)}, total))
+            samples.append(("_sum", stage_labels, sums[stage]))
+            samples.append(("_count", stage_labels, total))
+        return samples
+
+
+def render_metrics(families: list[tuple]) -> str:
+    """
+    Текстовый формат Prometheus из [(имя, тип, описание, [(суффикс, метки,
+    значение)])]; семейства с одним именем (владелец и воркер) сливаются.
+    """
+    merged = {}
+    for name, kind, help_text, samples in families:
+        merged.setdefault(name, (kind, help_text, []))[2].extend(samples)
+    lines = []
+    for name, (kind, help_text, samples) in merged.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{suffix}{{{label_text}}} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профайлер живого процесса: фоновый поток раз в interval
+    снимает стеки всех потоков (sys._current_frames) и считает одинаковые.
+    Результат — collapsed stacks («поток;функция (файл:строка);… N»), их
+    принимают flamegraph.pl и speedscope. Сам останавливается через max_s.
+    """
+
+    def __init__(self):
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval_ms: float, max_s: float):
+        if self.running:
+            raise HTTPException(409, "Profiler is already running")
+        self.stacks.clear()
+        self.samples = 0
+        self.started = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval_ms / 1000, max_s),
+            name="profiler",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+    def _run(self, interval: float, max_s: float):
+        me = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + max_s
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            names.update((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                        f":{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+            "started": self.started,
+        }
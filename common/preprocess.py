@@ -0,0 +1,126 @@
+"""Быстрый препроцессинг CLIP: шаги процессора модели на PIL и numpy."""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+# JPEG декодируется сразу уменьшенным (DCT-масштаб 1/2…1/8), но не меньше,
+# чем в JPEG_DRAFT_OVERSAMPLE раз крупнее кадра модели — дальше бикубик
+JPEG_DRAFT_OVERSAMPLE = 2
+# сколько батчей индексации декодируется впрок, пока модель считает текущий
+DECODE_PREFETCH_BATCHES = 2
+
+
+class FastPreprocess:
+    """
+    resize по короткой стороне -> center crop -> rescale + normalize,
+    с теми же размерами, округлениями и ресэмплингом, что у процессора модели.
+    Центр кропа CLIPProcessor округляет вниз, torchvision (open_clip) — до
+    ближайшего, это задаёт round_crop.
+    """
+
+    def __init__(
+        self,
+        resize_to: int,
+        crop_size: int,
+        resample: Image.Resampling,
+        mean,
+        std,
+        round_crop: bool = False,
+    ):
+        self.resize_to = resize_to
+        self.crop_size = crop_size
+        self.resample = resample
+        self.round_crop = round_crop
+        std = np.array(std, "float32")
+        self.scale = np.float32(1 / 255) / std
+        self.shift = np.array(mean, "float32") / std
+
+    @classmethod
+    def from_clip_processor(cls, processor) -> "FastPreprocess":
+        """Параметры CLIPImageProcessor из transformers."""
+        return cls(
+            processor.size["shortest_edge"],
+            processor.crop_size["height"],
+            Image.Resampling(processor.resample),
+            processor.image_mean,
+            processor.image_std,
+        )
+
+    @classmethod
+    def from_open_clip(cls, cfg: dict) -> "FastPreprocess":
+        """Параметры из merge_preprocess_dict open_clip (resize_mode shortest)."""
+        size = cfg["size"] if isinstance(cfg["size"], int) else cfg["size"][0]
+        return cls(
+            size,
+            size,
+            Image.Resampling[cfg["interpolation"].upper()],
+            cfg["mean"],
+            cfg["std"],
+            round_crop=True,
+        )
+
+    def open(self, source) -> Image.Image:
+        image = Image.open(source)
+        if image.format == "JPEG":
+            side = self.resize_to * JPEG_DRAFT_OVERSAMPLE
+            image.draft("RGB", (side, side))
+        image.load()  # декодируем здесь, а не лениво внутри resize
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return image
+
+    def __call__(self, image: Image.Image) -> torch.Tensor:
+        width, height = image.size
+        if width <= height:
+            size = (self.resize_to, int(self.resize_to * height / width))
+        else:
+            size = (int(self.resize_to * width / height), self.resize_to)
+        if image.size != size:
+            image = image.resize(size, self.resample)
+        crop = self.crop_size
+        if self.round_crop:
+            left = int(round((size[0] - crop) / 2.0))
+            top = int(round((size[1] - crop) / 2.0))
+        else:
+            left = (size[0] - crop) // 2
+            top = (size[1] - crop) // 2
+        pixels = np.asarray(image.crop((left, top, left + crop, top + crop)))
+        normalized = pixels * self.scale - self.shift  # (x / 255 - mean) / std
+        return torch.from_numpy(normalized.transpose(2, 0, 1).copy())
+
+
+def decode_batches(paths: list[str], load, batch_size: int, workers: int):
+    """
+    Генератор (позиции в paths, тензор батча) для индексации. load(path)
+    возвращает тензор картинки или None, если файл битый; зовётся в пуле
+    потоков, а не процессов: fork многопоточного сервиса может унести в
+    ребёнка чужую захваченную блокировку, а PIL на декодировании и resize
+    отпускает GIL, так что потоки и без того идут параллельно.
+    """
+    pool = ThreadPoolExecutor(max(workers, 1), thread_name_prefix="decode")
+    pending = deque()
+
+    def collect(futures) -> tuple[list[int], torch.Tensor] | None:
+        items = [(i, f.result()) for i, f in futures]
+        items = [(i, tensor) for i, tensor in items if tensor is not None]
+        if not items:
+            return None
+        positions, tensors = zip(*items)
+        return list(positions), torch.stack(tensors)
+
+    try:
+        for start in range(0, len(paths), batch_size):
+            batch = range(start, min(start + batch_size, len(paths)))
+            pending.append([(i, pool.submit(load, paths[i])) for i in batch])
+            if len(pending) > DECODE_PREFETCH_BATCHES:
+                if (ready := collect(pending.popleft())) is not None:
+                    yield ready
+        while pending:
+            if (ready := collect(pending.popleft())) is not None:
+                yield ready
+    finally:
+        pool.shutdown(cancel_futures=True)
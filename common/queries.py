@@ -0,0 +1,79 @@
+"""Эмбеддинги картинок-запросов: общее у сервисов FAISS и Qdrant."""
+
+import hashlib
+from io import BytesIO
+from typing import Awaitable, Callable
+
+import numpy as np
+import torch
+from PIL import Image
+
+from common.caching import LRUCache
+from common.inference import InferenceExecutor
+from common.metrics import StageTimers
+from common.preprocess import FastPreprocess
+
+
+def dhash(image: Image.Image) -> str:
+    """Перцептивный хеш: знаки разностей соседних пикселей 9x8 в оттенках серого."""
+    gray = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), "int16")
+    return np.packbits(gray[:, 1:] > gray[:, :-1]).tobytes().hex()
+
+
+class QueryEmbedder:
+    """
+    Байты запроса -> тензор -> эмбеддинг. Декодирование идёт в пуле inference
+    и пишется в стадии decode/preprocess, сам forward делает embed.
+    """
+
+    def __init__(
+        self,
+        preprocess: FastPreprocess,
+        timers: StageTimers,
+        inference: InferenceExecutor,
+        cache: LRUCache,
+        embed: Callable[[torch.Tensor], Awaitable[np.ndarray]],
+        phash: bool = False,
+    ):
+        self.preprocess = preprocess
+        self.timers = timers
+        self.inference = inference
+        self.cache = cache
+        self.embed_tensor = embed
+        self.phash = phash
+
+    def decode(self, contents: bytes) -> tuple[torch.Tensor, str | None]:
+        with self.timers.time("decode"):
+            image = self.preprocess.open(BytesIO(contents))
+        with self.timers.time("preprocess"):
+            tensor = self.preprocess(image)
+        return tensor, dhash(image) if self.phash else None
+
+    def try_decode(self, contents: bytes) -> torch.Tensor | None:
+        try:
+            with self.timers.time("decode"):
+                image = self.preprocess.open(BytesIO(contents))
+        except OSError:  # не картинка или битый файл
+            return None
+        with self.timers.time("preprocess"):
+            return self.preprocess(image)
+
+    async def embed(self, contents: bytes) -> np.ndarray:
+        """
+        Эмбеддинг запроса через кэш: ключ — sha256 байт, с phash=True
+        ещё и dHash картинки, чтобы совпадали перекодированные копии.
+        """
+        key = hashlib.sha256(contents).hexdigest()
+        embedding = self.cache.get(key)
+        if embedding is not None:
+            return embedding
+        async with self.inference.slot():
+            tensor, phash = await self.inference.run(self.decode, contents)
+            embedding = self.cache.get(f"dhash:{phash}") if phash else None
+            if embedding is None:
+                embedding = await self.embed_tensor(tensor)
+            size = embedding.nbytes + len(key)
+            self.cache.put(key, embedding, size)
+            if phash:
+                self.cache.put(f"dhash:{phash}", embedding, size)
+            return embedding
@@ -0,0 +1,111 @@
+"""Связь воркеров с процессом-владельцем по unix-сокету."""
+
+import os
+import secrets
+import stat
+import tempfile
+import threading
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+from fastapi import HTTPException
+
+
+def private_dir(path: str) -> str:
+    """
+    Папка сокетов и ключа: только для текущего пользователя (0700). По
+    сокету ходит pickle, поэтому чужой процесс не должен до него дотянуться.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise RuntimeError(f"{path} is not a directory owned by the current user")
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    return path
+
+
+def deployment_authkey(directory: str) -> bytes:
+    """
+    Случайный ключ развёртывания в файле directory/authkey (0600). Воркеры
+    стартуют одновременно, а шарды поднимаются из пула потоков, поэтому файл
+    появляется через link уже записанным: кто не успел, читает ключ победителя.
+    """
+    path = os.path.join(directory, "authkey")
+    if not os.path.exists(path):
+        fd, draft = tempfile.mkstemp(dir=directory)  # 0600, своё имя у потока
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(draft, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(draft)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def listen(address: str, authkey: bytes) -> Listener:
+    """Listener на unix-сокете, доступном только владельцу процесса."""
+    listener = Listener(address, "AF_UNIX", authkey=authkey)
+    os.chmod(address, 0o600)
+    return listener
+
+
+class OwnerClient:
+    """
+    Клиент воркера к владельцу: по соединению на поток, чтобы вызовы из пула
+    потоков шли параллельно. HTTPException владельца воссоздаётся у воркера,
+    прочие ошибки приходят как RuntimeError, обрыв соединения — OSError/EOFError.
+    """
+
+    def __init__(self, address: str, authkey: bytes, peer: str = "Index owner"):
+        self.address = address
+        self.authkey = authkey
+        self.peer = peer
+        self.local = threading.local()
+
+    def call(self, name: str, *args):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = Client(self.address, authkey=self.authkey)
+        try:
+            conn.send((name, args))
+            kind, result = conn.recv()
+        except (OSError, EOFError):
+            self.local.conn = None
+            conn.close()
+            raise
+        if kind == "http":
+            raise HTTPException(*result)
+        if kind == "error":
+            raise RuntimeError(f"{self.peer} failed: {result}")
+        return result
+
+
+def serve_connection(conn, operations: dict):
+    with conn:
+        while True:
+            try:
+                name, args = conn.recv()
+            except (OSError, EOFError):
+                return
+            # исключения не всегда переживают pickle, шлём их данными
+            try:
+                reply = ("ok", operations[name](*args))
+            except HTTPException as e:
+                reply = ("http", (e.status_code, e.detail, e.headers))
+            except Exception as e:
+                reply = ("error", repr(e))
+            conn.send(reply)
+
+
+def serve_owner(listener: Listener, operations: dict):
+    while True:
+        try:
+            conn = listener.accept()
+        except (OSError, AuthenticationError):
+            continue
+        threading.Thread(
+            target=serve_connection, args=(conn, operations), daemon=True
+        ).start()
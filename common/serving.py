@@ -0,0 +1,170 @@
+"""
+Старт сервиса и режим обслуживания: общее у сервисов FAISS и Qdrant.
+
+single — каждый процесс сам держит модель и данные; shared — под
+`uvicorn --workers N` их держит один воркер-владелец (кто первым взял
+блокировку), остальные делают HTTP и декодирование, а эмбеддинги, поиск
+и изменения каталога отправляют владельцу через unix-сокет.
+"""
+
+import fcntl
+import os
+import threading
+import time
+from typing import Callable
+
+from fastapi import HTTPException
+
+from common.rpc import OwnerClient, deployment_authkey, listen, private_dir, serve_owner
+
+STARTUP_MODE = os.getenv("STARTUP_MODE", "background")  # background | blocking
+SERVING_MODE = os.getenv("SERVING_MODE", "single")  # single | shared
+# пусто — случайный ключ развёртывания в SERVING_DIR/authkey, общий для воркеров
+SERVING_AUTHKEY = os.getenv("SERVING_AUTHKEY", "").encode()
+OWNER_POLL_S = float(os.getenv("OWNER_POLL_S", "1"))
+
+
+class Readiness:
+    """
+    Ворота старта: model — модель загружена, index — есть данные, по которым
+    можно искать, reconciled — они сверены с папкой и каталог можно менять.
+    error — причина, по которой старт не дошёл до конца.
+    """
+
+    def __init__(self):
+        self.model = threading.Event()
+        self.index = threading.Event()
+        self.reconciled = threading.Event()
+        self.error: str | None = None
+
+    def state(self) -> dict:
+        return {
+            "model": self.model.is_set(),
+            "index": self.index.is_set(),
+            "reconciled": self.reconciled.is_set(),
+            "error": self.error,
+        }
+
+    def reset(self):
+        for event in (self.model, self.index, self.reconciled):
+            event.clear()
+        self.error = None
+
+    def mirror(self, state: dict):
+        for event, ready in (
+            (self.model, state["model"]),
+            (self.index, state["index"]),
+            (self.reconciled, state["reconciled"]),
+        ):
+            event.set() if ready else event.clear()
+        self.error = state["error"]
+
+    def require_search(self):
+        if not (self.model.is_set() and self.index.is_set()):
+            raise HTTPException(
+                status_code=503,
+                detail=self.error or "Index is not ready yet",
+                headers={"Retry-After": "5"},
+            )
+
+    def require_reconciled(self):
+        if not self.reconciled.is_set():
+            raise HTTPException(
+                status_code=503,
+                detail=self.error or "Index is being reconciled with the catalog",
+                headers={"Retry-After": "5"},
+            )
+
+
+class Serving:
+    """
+    Владелец или клиент. Владелец отвечает на operations по сокету и готовит
+    модель и данные в warm_up (в фоне либо сразу, см. STARTUP_MODE), вместе
+    с потоками background. Клиент держит owner и зеркалит готовность
+    владельца через его операцию startup_state; если владелец пропал, его
+    блокировку забирает первый заметивший воркер и становится владельцем сам.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        socket: str,
+        operations: dict,
+        readiness: Readiness,
+        warm_up: Callable[[], None],
+        role: str,
+        background: tuple[Callable[[], None], ...] = (),
+    ):
+        self.directory = directory
+        self.socket = socket
+        self.operations = operations
+        self.readiness = readiness
+        self.warm_up = warm_up
+        self.role = role  # что держит владелец, для лога
+        self.background = background
+        self.owner: OwnerClient | None = None  # у клиента; у владельца — None
+        self.lock = None  # flock владельца, ядро отпустит его вместе с процессом
+
+    def authkey(self) -> bytes:
+        return SERVING_AUTHKEY or deployment_authkey(private_dir(self.directory))
+
+    def claim(self) -> bool:
+        private_dir(self.directory)
+        lock = open(f"{self.socket}.lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return False
+        self.lock = lock
+        return True
+
+    def start_owner(self):
+        if SERVING_MODE == "shared":
+            if os.path.exists(self.socket):
+                os.remove(self.socket)  # остался от упавшего владельца
+            listener = listen(self.socket, self.authkey())
+            threading.Thread(
+                target=serve_owner,
+                args=(listener, self.operations),
+                name="owner",
+                daemon=True,
+            ).start()
+            print(f"Воркер {os.getpid()} — владелец {self.role}")
+        if STARTUP_MODE == "blocking":
+            self.warm_up()
+        else:
+            threading.Thread(target=self.warm_up, name="warm-up", daemon=True).start()
+        for target in self.background:
+            threading.Thread(target=target, name=target.__name__, daemon=True).start()
+
+    def follow(self):
+        while True:
+            try:
+                state = self.owner.call("startup_state")
+            except (OSError, EOFError):
+                if self.claim():
+                    print(f"Владелец пропал, его место занимает воркер {os.getpid()}")
+                    self.owner = None
+                    # готовность зеркалила старого владельца: модель и данные
+                    # здесь ещё не подняты, поэтому до warm_up ворота закрыты
+                    self.readiness.reset()
+                    self.start_owner()
+                    return
+                state = {
+                    "model": False,
+                    "index": False,
+                    "reconciled": False,
+                    "error": "Index owner is unavailable",
+                }
+            self.readiness.mirror(state)
+            time.sleep(OWNER_POLL_S)
+
+    def start(self):
+        if SERVING_MODE == "shared" and not self.claim():
+            self.owner = OwnerClient(self.socket, self.authkey())
+            threading.Thread(
+                target=self.follow, name="owner-state", daemon=True
+            ).start()
+            return
+        self.start_owner()
@@ -0,0 +1,150 @@
+"""
+Процесс-шард FAISS-индекса (INDEX_SHARDS сервиса FAISS). Держит часть
+векторов и отвечает владельцу по unix-сокету. Импортирует только faiss,
+numpy и RPC — не сервис с моделью, поэтому стартует за доли секунды:
+
+    python -m common.shard N сокет потоки pid-владельца
+
+Ключ сокета приходит в SERVING_AUTHKEY: в argv его видят все пользователи.
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+
+import faiss
+import numpy as np
+
+from common.faiss_index import (
+    configure_index,
+    copy_mapped,
+    open_mapped,
+    read_mapped,
+    remove_vectors,
+)
+from common.rpc import listen, serve_owner
+
+index = None  # индекс шарда, приходит с shard_init или shard_load
+index_spec = None
+index_mmapped = None  # открытый файл снапшота, если index — его mmap (только чтение)
+index_lock = threading.Lock()
+frozen = None  # байты индекса или его mmap-файл между shard_freeze и shard_save
+shard_operations = {}  # имя -> функция
+
+
+def shard_operation(fn):
+    shard_operations[fn.__name__] = fn
+    return fn
+
+
+def ensure_writable():
+    """Под index_lock перед мутацией: mmap-индекс сначала читается в память."""
+    global index, index_mmapped
+    if index_mmapped is not None:
+        index = read_mapped(index_mmapped)
+        index_mmapped = None
+
+
+@shard_operation
+def shard_ping() -> int:
+    return os.getpid()
+
+
+@shard_operation
+def shard_init(spec: str, data: np.ndarray):
+    global index, index_spec, index_mmapped
+    with index_lock:
+        index = faiss.deserialize_index(data)
+        configure_index(index)
+        index_spec, index_mmapped = spec, None
+
+
+@shard_operation
+def shard_add(vectors: np.ndarray, ids: np.ndarray):
+    with index_lock:
+        ensure_writable()
+        index.add_with_ids(vectors, ids)
+
+
+@shard_operation
+def shard_remove(ids: np.ndarray) -> int:
+    global index
+    with index_lock:
+        ensure_writable()
+        before = index.ntotal
+        index = remove_vectors(index, ids, index_spec)
+        return before - index.ntotal
+
+
+@shard_operation
+def shard_search(queries: np.ndarray, k: int, nprobe, ef_search):
+    # параметры уже проверил владелец по типу индекса
+    params = None
+    if nprobe is not None:
+        params = faiss.SearchParametersIVF(nprobe=nprobe)
+    elif ef_search is not None:
+        params = faiss.SearchParametersHNSW(efSearch=ef_search)
+    with index_lock:
+        return index.search(queries, k, params=params)
+
+
+@shard_operation
+def shard_freeze():
+    """Копия индекса в память для снапшота: владелец держит index_lock."""
+    global frozen
+    with index_lock:
+        # у не менявшегося mmap-индекса копия — его файл: serialize_index
+        # записал бы IVF-списки ссылкой на этот файл, а старый снапшот удалят
+        if index_mmapped is not None:
+            frozen = index_mmapped
+        else:
+            frozen = faiss.serialize_index(index)
+
+
+@shard_operation
+def shard_save(path: str):
+    """Пишет копию из shard_freeze; поиск и мутации шарда в это время идут."""
+    global frozen
+    data, frozen = frozen, None
+    if isinstance(data, np.ndarray):
+        data.tofile(path)
+    else:
+        copy_mapped(data, path)
+
+
+@shard_operation
+def shard_load(path: str, spec: str) -> int:
+    global index, index_spec, index_mmapped
+    loaded, mapped = open_mapped(path, spec)
+    with index_lock:
+        index, index_spec, index_mmapped = loaded, spec, mapped
+    return index.ntotal
+
+
+def serve_shard(number: int, address: str, threads: int, parent: int, authkey: bytes):
+    """Живёт, пока жив породивший шард владелец."""
+    faiss.omp_set_num_threads(threads)
+    # по SIGTERM выходим штатно: Listener при выходе сам удаляет файл сокета
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    listener = listen(address, authkey)
+    threading.Thread(
+        target=serve_owner, args=(listener, shard_operations), daemon=True
+    ).start()
+    print(f"Шард {number} (pid {os.getpid()}) слушает {address}")
+    while os.getppid() == parent:
+        time.sleep(1)
+
+
+if __name__ == "__main__":
+    # pid владельца передаётся явно: он мог умереть, пока шард стартовал,
+    # и тогда getppid() уже вернёт чужой pid
+    number, address, threads, parent = sys.argv[1:5]
+    serve_shard(
+        int(number),
+        address,
+        int(threads),
+        int(parent),
+        os.environ["SERVING_AUTHKEY"].encode(),
+    )
@@ -0,0 +1,45 @@
+"""Раскладка товаров по шардам и слияние их выдач."""
+
+import hashlib
+
+import numpy as np
+
+
+def jump_hash(product_id: str, buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping, Veach): при переходе от n к n + 1 шарду
+    переезжает только 1/(n + 1) товаров, и все — в новый шард.
+    """
+    key = int.from_bytes(
+        hashlib.blake2b(product_id.encode(), digest_size=8).digest(), "little"
+    )
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) % 2**64
+        jump = int((bucket + 1) * (2**31 / ((key >> 33) + 1)))
+    return bucket
+
+
+def merge_top_k(
+    parts: list[tuple[np.ndarray, np.ndarray]], k: int, dedupe: bool = False
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Сливает top-k шардов (близости, id) в общий top-k по убыванию близости.
+    dedupe — пока идёт перебалансировка, вектор бывает в двух шардах сразу:
+    оставляем одну копию. Пустые места, как у faiss, — id -1.
+    """
+    similarities = np.hstack([s for s, _ in parts])
+    ids = np.hstack([i for _, i in parts])
+    if dedupe:
+        for row in range(len(ids)):
+            _, first = np.unique(ids[row], return_index=True)
+            duplicate = np.ones(ids.shape[1], dtype=bool)
+            duplicate[first] = False
+            similarities[row, duplicate] = -np.inf
+            ids[row, duplicate] = -1
+    order = np.argsort(-similarities, axis=1, kind="stable")[:, :k]
+    return (
+        np.take_along_axis(similarities, order, axis=1),
+        np.take_along_axis(ids, order, axis=1),
+    )
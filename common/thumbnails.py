@@ -0,0 +1,70 @@
+"""Миниатюры фото для UI: общее у сервисов FAISS и Qdrant."""
+
+import os
+import uuid
+from typing import Callable
+
+from PIL import Image
+
+THUMBNAILS_DIR = os.getenv("THUMBNAILS_DIR", "./thumbnails")
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "320"))  # по длинной стороне
+THUMBNAIL_MAX_AGE_S = int(os.getenv("THUMBNAIL_MAX_AGE_S", "3600"))  # кэш браузера
+
+
+class Thumbnails:
+    """
+    Миниатюры фото из data_dir: <root>/<product_id>/<имя фото>.jpg, раскладка
+    как в data_dir. Миниатюра свежая, если она не старше своего фото.
+    """
+
+    def __init__(
+        self,
+        data_dir: str,
+        root: str,
+        size: int,
+        open_image: Callable[[str], Image.Image],
+    ):
+        self.data_dir = data_dir
+        self.root = root
+        self.size = size
+        self.open_image = open_image
+
+    def path(self, image_path: str) -> str:
+        relative = os.path.relpath(image_path, self.data_dir)
+        return os.path.join(self.root, relative + ".jpg")
+
+    def fresh(self, image_path: str) -> bool:
+        try:
+            return (
+                os.stat(self.path(image_path)).st_mtime_ns
+                >= os.stat(image_path).st_mtime_ns
+            )
+        except FileNotFoundError:
+            return False
+
+    def save(self, image_path: str, image: Image.Image | None = None) -> str:
+        """
+        Пишет миниатюру через временный файл, чтобы параллельный /thumb не отдал
+        недописанную. image — уже декодированное фото, если оно есть под рукой.
+        """
+        target = self.path(image_path)
+        if image is None:
+            image = self.open_image(image_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = f"{target}.{uuid.uuid4().hex}.tmp"
+        thumb = image.copy()  # thumbnail() меняет картинку на месте и не увеличивает
+        thumb.thumbnail((self.size, self.size), Image.BICUBIC)
+        thumb.save(tmp, "JPEG", quality=85)
+        os.replace(tmp, target)
+        return target
+
+    def ensure(self, image_path: str) -> str:
+        if self.fresh(image_path):
+            return self.path(image_path)
+        return self.save(image_path)
+
+    def remove(self, image_path: str):
+        try:
+            os.remove(self.path(image_path))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,190 @@
+"""Наблюдение за папкой каталога: её пишут и другие процессы (общий том)."""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+WATCH_MODE = os.getenv("WATCH_MODE", "inotify")  # inotify | poll | off
+WATCH_DEBOUNCE_S = float(os.getenv("WATCH_DEBOUNCE_S", "2"))
+WATCH_MAX_DELAY_S = float(os.getenv("WATCH_MAX_DELAY_S", "10"))
+WATCH_SCAN_S = float(os.getenv("WATCH_SCAN_S", "300"))  # обход-подстраховка
+WATCH_POLL_S = float(os.getenv("WATCH_POLL_S", "5"))  # обход, если inotify нет
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+WATCH_EVENTS = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+)
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len; дальше имя
+
+
+class Inotify:
+    """
+    inotify(7) через ctypes, без зависимостей. read() отдаёт [(папка, имя)];
+    папка None — очередь ядра переполнилась, события потеряны.
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}  # wd -> папка
+
+    def add(self, directory: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_EVENTS)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch {directory}")
+        self.watches[wd] = directory
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self, timeout: float) -> list[tuple[str | None, str]]:
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, size = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset : offset + size].rstrip(b"\0"))
+                offset += size
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, ""))
+                elif mask & IN_IGNORED:
+                    self.watches.pop(wd, None)  # папку удалили
+                elif wd in self.watches:
+                    events.append((self.watches[wd], name))
+
+
+def scan_catalog(root: str) -> dict[str, frozenset]:
+    """product_id -> {(имя, mtime, размер)}: для обхода без inotify."""
+    catalog = {}
+    for product in os.scandir(root):
+        if not product.is_dir():
+            continue
+        files = set()
+        try:
+            for f in os.scandir(product.path):
+                st = f.stat()
+                files.add((f.name, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:  # удалили во время обхода — заметим в следующий раз
+            pass
+        catalog[product.name] = frozenset(files)
+    return catalog
+
+
+def watch_catalog(
+    root: str,
+    reconciled: threading.Event,
+    reconcile,
+    stop: threading.Event | None = None,
+):
+    """
+    Собирает изменённые товары из inotify и периодических обходов папки root,
+    ждёт, пока поток изменений стихнет на WATCH_DEBOUNCE_S (но не дольше
+    WATCH_MAX_DELAY_S), и отдаёт их reconcile одной пачкой.
+    Запускается до стартовой сверки, чтобы не пропустить изменения во время
+    неё, а применяет их только после reconciled. Работает, пока не выставят
+    stop (сервис его не передаёт: поток-демон живёт до конца процесса).
+    """
+    inotify = None
+    if WATCH_MODE == "inotify":
+        try:
+            inotify = Inotify()
+            inotify.add(root)
+            for product in os.scandir(root):
+                if product.is_dir():
+                    inotify.add(product.path)
+        except OSError as e:
+            print(f"inotify недоступен ({e}), папка каталога проверяется обходом")
+            inotify = None
+    scan_every = WATCH_SCAN_S if inotify else WATCH_POLL_S
+
+    known = scan_catalog(root)
+    next_scan = time.monotonic() + scan_every
+    dirty, first_change, last_change = set(), None, None
+    while stop is None or not stop.is_set():
+        now = time.monotonic()
+        if dirty and reconciled.is_set():
+            deadline = min(
+                last_change + WATCH_DEBOUNCE_S, first_change + WATCH_MAX_DELAY_S
+            )
+        elif dirty:
+            deadline = now + 1  # ждём конца стартовой сверки
+        else:
+            deadline = next_scan
+        timeout = max(min(deadline, next_scan) - now, 0)
+
+        changed = set()
+        if inotify:
+            for directory, name in inotify.read(timeout):
+                if directory is None:
+                    next_scan = 0  # события потеряны — сверяемся обходом
+                elif name.startswith("."):  # временные файлы rsync и т.п.
+                    continue
+                elif directory == root:
+                    # новый товар: файлы, успевшие появиться до подписки,
+                    # всё равно попадут в сверку товара целиком
+                    product_dir = os.path.join(root, name)
+                    if os.path.isdir(product_dir):
+                        try:
+                            inotify.add(product_dir)  # повторная подписка безвредна
+                        except OSError as e:
+                            print(f"Не удалось следить за {product_dir}: {e}")
+                    changed.add(name)
+                else:
+                    changed.add(os.path.basename(directory))
+        else:
+            time.sleep(timeout)
+
+        now = time.monotonic()
+        if now >= next_scan:
+            current = scan_catalog(root)
+            changed.update(
+                product_id
+                for product_id in current.keys() | known.keys()
+                if current.get(product_id) != known.get(product_id)
+            )
+            known = current
+            next_scan = now + scan_every
+        if changed:
+            dirty |= changed
+            first_change = first_change or now
+            last_change = now
+        if (dirty and reconciled.is_set()) and (
+            now - last_change >= WATCH_DEBOUNCE_S
+            or now - first_change >= WATCH_MAX_DELAY_S
+        ):
+            try:
+                reconcile(dirty)
+            except Exception as e:
+                print(f"Ошибка синхронизации с папкой: {e}")
+            dirty, first_change, last_change = set(), None, None
+    if inotify:
+        inotify.close()
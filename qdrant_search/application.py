@@ -1,153 +1,810 @@
+import asyncio
+import hashlib
+import json
 import os
 import shutil
+import tarfile
+import tempfile
+import threading
+import time
 import uuid
+import zipfile
 from pathlib import Path
-from collections import defaultdict
-from io import BytesIO
+from contextlib import AsyncExitStack
 
 import numpy as np
 import torch
 import open_clip
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import Depends, FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+)
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from PIL import Image
 from tqdm import tqdm
 from qdrant_client import QdrantClient
 from qdrant_client.http import models as qdrant
 
+from common.caching import LRUCache
+from common import encoders
+from common.embeddings import EmbeddingStore
+from common.encoders import ENCODER_BACKEND
+from common.grouping import (
+    SEARCH_AGGREGATION,
+    SEARCH_OVERFETCH,
+    SEARCH_TOP_M,
+    Aggregation,
+    match_products,
+)
+from common.importer import CatalogImport
+from common.inference import BatchScheduler, InferenceExecutor, SlotStreamingResponse
+from common.metrics import (
+    STAGE_BUCKETS_S,
+    SamplingProfiler,
+    StageTimers,
+    render_metrics,
+)
+from common.preprocess import FastPreprocess, decode_batches
+from common.queries import QueryEmbedder
+from common.serving import SERVING_MODE, Readiness, Serving
+from common.thumbnails import (
+    THUMBNAIL_MAX_AGE_S,
+    THUMBNAIL_SIZE,
+    THUMBNAILS_DIR,
+    Thumbnails,
+)
+from common.watch import WATCH_MODE, watch_catalog
+
 
+MODEL_NAME = "ViT-H-14"
+PRETRAINED = "laion2b_s32b_b79k"
+PREPROCESS_VERSION = 2  # увеличить при любом изменении препроцессинга
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-model, _, preprocess = open_clip.create_model_and_transforms(
-    model_name="ViT-H-14", pretrained="laion2b_s32b_b79k", device=DEVICE
-)
-model.eval()
+# веса (несколько ГБ) грузит load_model(), при старте — в фоне
+model = None
+preprocess = None  # эталонный open_clip preprocess, нужен бенчмаркам
+# векторы разных бэкендов чуть расходятся: у каждого свой кэш, а точки
+# коллекции, посчитанные другим бэкендом, при старте пересчитываются
+ENCODER_ID = f"{MODEL_NAME}-{PRETRAINED}"
+if ENCODER_BACKEND != "eager":
+    ENCODER_ID += f"+{ENCODER_BACKEND}"
 
 
 DATA_DIR = "./products"
 os.makedirs(DATA_DIR, exist_ok=True)
-products: dict[str, list[str]] = {}  # product_id -> [image_path, …]
+# product_id -> [image_path, …]; меняется только под catalog_lock (см. ниже):
+# его правят API, импорт и поток наблюдения за папкой
+products: dict[str, list[str]] = {}
 
 
 VECTOR_SIZE = 1024
 COLLECTION = "products_clip"
-client = QdrantClient(  # если контейнер крутится на других хосте/порте, поправьте
-    host="qdrant",
-    port=6334,
-    prefer_grpc=True,  # быстрее
+# QDRANT_LOCATION — ":memory:" или URL; без него — host/port ниже по gRPC
+QDRANT_LOCATION = os.getenv("QDRANT_LOCATION")
+QDRANT_HOST = os.getenv("QDRANT_HOST", "qdrant")
+QDRANT_PORT = int(os.getenv("QDRANT_PORT", "6334"))
+client = None  # подключается connect() при старте, а не при импорте
+# Сжатие векторов: float16 вдвое, int8 вчетверо, PQ в 64 раза меньше float32.
+# Квантованные векторы живут в RAM, а оригиналы с QDRANT_ON_DISK=1 лежат на
+# диске (mmap): по ним пересчитываются QDRANT_OVERSAMPLING * limit кандидатов.
+QDRANT_DATATYPE = os.getenv("QDRANT_DATATYPE", "float32")  # float32 | float16
+QDRANT_QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "none")  # none | int8 | pq
+QDRANT_ON_DISK = os.getenv("QDRANT_ON_DISK", "0") == "1"
+QDRANT_OVERSAMPLING = float(os.getenv("QDRANT_OVERSAMPLING", "2"))
+
+
+def connect():
+    global client
+    if QDRANT_LOCATION:
+        client = QdrantClient(location=QDRANT_LOCATION)
+    else:
+        client = QdrantClient(
+            host=QDRANT_HOST,
+            port=QDRANT_PORT,
+            prefer_grpc=True,  # быстрее
+        )
+    ensure_collection()
+
+
+def quantization_config(quantization: str):
+    if quantization == "none":
+        return None
+    if quantization == "int8":
+        return qdrant.ScalarQuantization(
+            scalar=qdrant.ScalarQuantizationConfig(
+                type=qdrant.ScalarType.INT8, quantile=0.99, always_ram=True
+            )
+        )
+    if quantization == "pq":
+        return qdrant.ProductQuantization(
+            product=qdrant.ProductQuantizationConfig(
+                compression=qdrant.CompressionRatio.X64, always_ram=True
+            )
+        )
+    raise ValueError(f"Неизвестный QDRANT_QUANTIZATION: {quantization}")
+
+
+def search_params(quantization: str = QDRANT_QUANTIZATION):
+    if quantization == "none":
+        return None
+    return qdrant.SearchParams(
+        quantization=qdrant.QuantizationSearchParams(
+            rescore=True, oversampling=QDRANT_OVERSAMPLING
+        )
+    )
+
+
+def ensure_collection(
+    datatype: str = QDRANT_DATATYPE,
+    quantization: str = QDRANT_QUANTIZATION,
+    on_disk: bool = QDRANT_ON_DISK,
+):
+    """
+    Создаёт коллекцию с заданным сжатием, у существующей — меняет
+    квантизацию и место хранения оригиналов (Qdrant перестроит сегменты сам).
+    Тип хранения (float16) у готовой коллекции не меняется — только пересозданием.
+    """
+    config = quantization_config(quantization)
+    if COLLECTION not in {c.name for c in client.get_collections().collections}:
+        client.create_collection(
+            COLLECTION,
+            vectors_config=qdrant.VectorParams(
+                size=VECTOR_SIZE,
+                distance=qdrant.Distance.COSINE,
+                datatype=qdrant.Datatype(datatype),
+                on_disk=on_disk,
+            ),
+            quantization_config=config,
+        )
+    info = client.get_collection(COLLECTION).config
+    vectors = info.params.vectors
+    if (vectors.datatype or qdrant.Datatype.FLOAT32) != qdrant.Datatype(datatype):
+        print(f"Коллекция хранит {vectors.datatype}, а не {datatype}: нужна пересборка")
+    if info.quantization_config != config or bool(vectors.on_disk) != on_disk:
+        client.update_collection(
+            COLLECTION,
+            vectors_config={"": qdrant.VectorParamsDiff(on_disk=on_disk)},
+            quantization_config=config or qdrant.Disabled.DISABLED,
+        )
+    # индекс по product_id: удаление товара фильтром не сканирует коллекцию
+    if "product_id" not in client.get_collection(COLLECTION).payload_schema:
+        client.create_payload_index(
+            COLLECTION, "product_id", qdrant.PayloadSchemaType.KEYWORD
+        )
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Кэш эмбеддингов на диске
+# ──────────────────────────────────────────────────────────────────────────────
+EMBEDDINGS_DIR = os.getenv("EMBEDDINGS_DIR", "./embeddings")
+embedding_store = EmbeddingStore(
+    EMBEDDINGS_DIR, ENCODER_ID, VECTOR_SIZE, PREPROCESS_VERSION
 )
 
 
-def ensure_collection():
-    if COLLECTION in {c.name for c in client.get_collections().collections}:
-        return
-    client.create_collection(
-        COLLECTION,
-        vectors_config=qdrant.VectorParams(
-            size=VECTOR_SIZE,
-            distance=qdrant.Distance.COSINE,
-        ),
+# ──────────────────────────────────────────────────────────────────────────────
+# Быстрый препроцессинг: шаги open_clip preprocess без torchvision-обвязки
+# ──────────────────────────────────────────────────────────────────────────────
+# параметры препроцессинга берём из конфигов open_clip, веса для этого не нужны
+preprocess_cfg = open_clip.transform.merge_preprocess_dict(
+    open_clip.transform.PreprocessCfg(
+        size=open_clip.get_model_config(MODEL_NAME)["vision_cfg"]["image_size"]
+    ),
+    open_clip.get_pretrained_cfg(MODEL_NAME, PRETRAINED),
+)
+fast_preprocess = FastPreprocess.from_open_clip(preprocess_cfg)
+open_image = fast_preprocess.open
+preprocess_image = fast_preprocess
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Операции над моделью и каталогом. В режиме shared (SERVING_MODE, см. common.serving)
+# их выполняет один процесс-владелец, остальные воркеры зовут его по сокету.
+# ──────────────────────────────────────────────────────────────────────────────
+owner_operations = {}  # имя -> функция
+
+
+def owner_operation(fn):
+    owner_operations[fn.__name__] = fn
+    return fn
+
+
+async def on_owner(fn, *args):
+    """Выполняет операцию в пуле потоков: у себя или у владельца, если он не мы."""
+    if serving.owner is None:
+        return await run_in_threadpool(fn, *args)
+    try:
+        return await run_in_threadpool(serving.owner.call, fn.__name__, *args)
+    except (OSError, EOFError) as e:  # владелец перезапускается
+        raise HTTPException(
+            503, "Index owner is unavailable", {"Retry-After": "1"}
+        ) from e
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Метрики горячего пути и сэмплирующий профайлер
+# ──────────────────────────────────────────────────────────────────────────────
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "10"))
+PROFILER_MAX_S = float(os.getenv("PROFILER_MAX_S", "300"))
+
+timers = StageTimers(STAGE_BUCKETS_S)
+profiler = SamplingProfiler()
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Бэкенд энкодера
+# ──────────────────────────────────────────────────────────────────────────────
+class ImageTower(torch.nn.Module):
+    """Картиночная часть open_clip: тензор -> признаки, без нормировки."""
+
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tensor: torch.Tensor) -> torch.Tensor:
+        return self.model.encode_image(tensor)
+
+
+def make_encoder(tower: torch.nn.Module, backend: str):
+    return encoders.make_encoder(
+        tower, backend, f"{MODEL_NAME}-{PRETRAINED}", DEVICE, fast_preprocess.crop_size
     )
 
 
-ensure_collection()
+image_encoder = None  # см. load_model
+
+
+def load_model():
+    global model, preprocess, image_encoder
+    started = time.perf_counter()
+    model, _, preprocess = open_clip.create_model_and_transforms(
+        model_name=MODEL_NAME, pretrained=PRETRAINED, device=DEVICE
+    )
+    model.eval()
+    image_encoder = make_encoder(ImageTower(model), ENCODER_BACKEND)
+    print(f"Модель {ENCODER_ID} загружена за {time.perf_counter() - started:.1f} с")
+
+
+@owner_operation
+def embed_batch(tensor: torch.Tensor) -> np.ndarray:
+    """
+    Батч препроцессированных картинок (N, 3, H, W) -> L2‑нормированные (N, 1024).
+    """
+    with timers.time("forward"), torch.no_grad():
+        emb = image_encoder(tensor.to(DEVICE)).float()
+        emb = emb / emb.norm(dim=-1, keepdim=True)  # L2
+        return emb.cpu().numpy().astype("float32")
 
 
 def embed_image(image: Image.Image) -> np.ndarray:
     """
     Принимает PIL‑картинку, возвращает L2‑нормированный вектор float32 (1, 1024).
     """
-    tensor = preprocess(image).unsqueeze(0).to(DEVICE)
-    with torch.no_grad(), torch.amp.autocast("cuda"):
-        emb = model.encode_image(tensor)
-    emb = emb / emb.norm(dim=-1, keepdim=True)  # L2
-    return emb.cpu().numpy().astype("float32")
+    return embed_batch(preprocess_image(image).unsqueeze(0))
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Микробатчинг онлайн-запросов
+# ──────────────────────────────────────────────────────────────────────────────
+SEARCH_MAX_BATCH = int(os.getenv("SEARCH_MAX_BATCH", "16"))
+SEARCH_MAX_WAIT_MS = float(os.getenv("SEARCH_MAX_WAIT_MS", "5"))
+
+batcher = BatchScheduler(embed_batch, SEARCH_MAX_BATCH, SEARCH_MAX_WAIT_MS, timers)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Инференс вне event loop
+# ──────────────────────────────────────────────────────────────────────────────
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", "4"))
+INFERENCE_MAX_PENDING = int(os.getenv("INFERENCE_MAX_PENDING", "64"))
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", "0"))  # 0 — решает torch
+if TORCH_THREADS:
+    torch.set_num_threads(TORCH_THREADS)
+
+inference = InferenceExecutor(INFERENCE_THREADS, INFERENCE_MAX_PENDING)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Кэши эмбеддингов запросов и готовых выдач
+# ──────────────────────────────────────────────────────────────────────────────
+QUERY_CACHE_MB = float(os.getenv("QUERY_CACHE_MB", "64"))
+QUERY_CACHE_TTL_S = float(os.getenv("QUERY_CACHE_TTL_S", "3600"))
+QUERY_CACHE_PHASH = os.getenv("QUERY_CACHE_PHASH", "0") == "1"
+RESULT_CACHE_MB = float(os.getenv("RESULT_CACHE_MB", "32"))
+# коллекцию могут менять и другие инстансы, поэтому TTL выдачи короткий
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", "60"))
+
+query_cache = LRUCache(QUERY_CACHE_MB, QUERY_CACHE_TTL_S)  # sha256 байт -> вектор
+result_cache = LRUCache(RESULT_CACHE_MB, RESULT_CACHE_TTL_S)  # запрос -> выдача
+collection_version = 0  # растёт при каждой записи в коллекцию, входит в ключ
+
+
+def collection_changed():
+    global collection_version
+    collection_version += 1
+    result_cache.clear()
+
+
+def load_image(source) -> torch.Tensor:
+    return preprocess_image(open_image(source))
+
+
+@owner_operation
+def embed_pixels(tensor: torch.Tensor) -> np.ndarray:
+    return batcher.submit(tensor).result()
+
+
+async def embed_online(tensor: torch.Tensor) -> np.ndarray:
+    """Через микробатчер; в режиме shared в батч попадают запросы всех воркеров."""
+    if serving.owner is None:
+        return await batcher.embed(tensor)
+    return await on_owner(embed_pixels, tensor)
+
+
+query_embedder = QueryEmbedder(
+    fast_preprocess, timers, inference, query_cache, embed_online, QUERY_CACHE_PHASH
+)
+decode_query = query_embedder.decode
+try_load_image = query_embedder.try_decode
+embed_query = query_embedder.embed
+
+
+async def embed_queries(contents: list[bytes]) -> tuple[list[int], np.ndarray]:
+    """
+    Пачка запросов: декодирование параллельно в пуле, эмбеддинги одним
+    forward'ом. Возвращает номера удачно декодированных и их эмбеддинги.
+    """
+    tensors = await asyncio.gather(
+        *(inference.run(try_load_image, c) for c in contents)
+    )
+    ok = [i for i, tensor in enumerate(tensors) if tensor is not None]
+    if not ok:
+        return ok, np.empty((0, VECTOR_SIZE), dtype="float32")
+    tensor = torch.stack([tensors[i] for i in ok])
+    if serving.owner is None:
+        return ok, await inference.run(embed_batch, tensor)
+    return ok, await on_owner(embed_batch, tensor)
+
+
+@owner_operation
+def file_embedding(img_path: str) -> np.ndarray:
+    """
+    Эмбеддинг файла из кэша; при промахе считаем моделью и докладываем в кэш.
+    """
+    digest = embedding_store.digest(img_path)
+    vec = embedding_store.get(digest)
+    if vec is None:
+        vec = embed_pixels(load_image(img_path))
+        embedding_store.put(digest, vec)
+    return vec
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Миниатюры для UI: генерируются при индексации, иначе — при первом запросе
+# ──────────────────────────────────────────────────────────────────────────────
+thumbnails = Thumbnails(DATA_DIR, THUMBNAILS_DIR, THUMBNAIL_SIZE, open_image)
+thumbnail_fresh = thumbnails.fresh
+save_thumbnail = thumbnails.save
+ensure_thumbnail = thumbnails.ensure
+remove_thumbnail = thumbnails.remove
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Пайплайн индексации: декодирование в пуле потоков, инференс батчами
+# ──────────────────────────────────────────────────────────────────────────────
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "64"))
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", str(os.cpu_count() or 1)))
+
+
+def load_for_index(img_path: str) -> torch.Tensor | None:
+    try:
+        image = open_image(img_path)
+        if not thumbnail_fresh(img_path):
+            save_thumbnail(img_path, image)  # фото уже декодировано
+        return preprocess_image(image)
+    except Exception as e:
+        print(f"Ошибка {img_path}: {e}")
+        return None
+
+
+def embed_files(paths: list[str]):
+    """
+    Генератор (позиции в paths, эмбеддинги) по мере готовности батчей.
+    Пул из INDEX_WORKERS потоков декодирует и препроцессит картинки
+    параллельно и на пару батчей вперёд, модель видит батчи INDEX_BATCH_SIZE.
+    """
+    for positions, tensor in decode_batches(
+        paths, load_for_index, INDEX_BATCH_SIZE, INDEX_WORKERS
+    ):
+        yield positions, embed_batch(tensor)
+
+
+def index_images(items: list[tuple[str, str]], sink) -> int:
+    """
+    Индексирует пары (product_id, img_path) и отдаёт их в sink(batch, vectors)
+    по мере готовности батчей. Векторы из кэша уходят сразу, промахи
+    считаются через embed_files и докладываются в кэш.
+    """
+    started = time.perf_counter()
+    progress = tqdm(total=len(items), unit="img", desc="Indexing")
+
+    hashed, digests = [], []
+    for product_id, img_path in items:
+        try:
+            digests.append(embedding_store.digest(img_path))
+            hashed.append((product_id, img_path))
+        except OSError as e:
+            print(f"Ошибка {img_path}: {e}")
 
+    found, cached = embedding_store.get_many(digests)
+    hits = [item for item, hit in zip(hashed, found) if hit]
+    for start in range(0, len(hits), INDEX_BATCH_SIZE):
+        batch = hits[start : start + INDEX_BATCH_SIZE]
+        sink(batch, cached[start : start + INDEX_BATCH_SIZE])
+        progress.update(len(batch))
 
-def point_id() -> str:
-    # Qdrant может принимать int или str. Берём str‑uuid для простоты.
-    return str(uuid.uuid4())
+    misses = [(item, d) for item, d, hit in zip(hashed, digests, found) if not hit]
+    done = len(hits)
+    for positions, vectors in embed_files([path for (_, path), _ in misses]):
+        embedding_store.put_many([misses[i][1] for i in positions], vectors)
+        sink([misses[i][0] for i in positions], vectors)
+        progress.update(len(positions))
+        done += len(positions)
+
+    progress.close()
+    elapsed = time.perf_counter() - started
+    print(
+        f"Проиндексировано {done} изображений за {elapsed:.1f} с "
+        f"({done / max(elapsed, 1e-9):.1f} img/s)"
+    )
+    return done
+
+
+# Пространство имён для uuid5: id точки однозначно задаётся путём к фото
+POINT_NAMESPACE = uuid.UUID("6f1c2a52-7d0e-4b8a-9a55-0c3f4f1e2b7d")
+DELETE_BATCH = 1000
+
+
+def point_id(img_path: str) -> str:
+    """
+    Детерминированный id точки: uuid5 от пути относительно DATA_DIR.
+    Повторная индексация того же файла перезаписывает точку, а не дублирует.
+    """
+    return str(
+        uuid.uuid5(POINT_NAMESPACE, Path(img_path).relative_to(DATA_DIR).as_posix())
+    )
+
+
+def upsert_images(batch: list[tuple[str, str]], vectors: np.ndarray):
+    """Вызывается под catalog_lock: заодно дописывает фото в products."""
+    client.upsert(
+        COLLECTION,
+        [
+            qdrant.PointStruct(
+                id=point_id(img_path),
+                vector=vec,
+                payload={
+                    "product_id": product_id,
+                    "image_path": img_path,
+                    "digest": embedding_store.digest(img_path),
+                    "encoder": ENCODER_ID,
+                },
+            )
+            for (product_id, img_path), vec in zip(batch, vectors)
+        ],
+    )
+    for product_id, img_path in batch:
+        paths = products.setdefault(product_id, [])
+        if img_path not in paths:  # повторный upsert того же фото
+            paths.append(img_path)
+    collection_changed()
+
+
+def indexed_points() -> dict[str, str]:
+    """
+    point_id -> digest для всех точек коллекции (без векторов).
+    Точки чужого энкодера получают digest None и будут пересчитаны.
+    """
+    points, offset = {}, None
+    while True:
+        batch, offset = client.scroll(
+            COLLECTION,
+            limit=DELETE_BATCH,
+            offset=offset,
+            with_payload=["digest", "encoder"],
+            with_vectors=False,
+        )
+        for p in batch:
+            payload = p.payload or {}
+            # точки без поля encoder записаны до его появления — eager-моделью
+            encoder = payload.get("encoder", f"{MODEL_NAME}-{PRETRAINED}")
+            points[str(p.id)] = payload.get("digest") if encoder == ENCODER_ID else None
+        if offset is None:
+            return points
 
 
 def build_index_from_folder():
     """
-    1) Чистим/пересоздаём коллекцию.
-    2) Проходимся по каталогу и шлем батчами по 64 изображения.
+    Синхронизирует коллекцию с каталогом вместо полной пересборки:
+    1) сканируем папку и считаем digest'ы (через stat-кэш — без чтения файлов);
+    2) точки без файла удаляем по id;
+    3) новые и изменённые фото считаем батчами в index_images и upsert'им,
+       нетронутые фото коллекцию не трогают вовсе.
     """
-    ensure_collection()
-    client.delete_collection(COLLECTION)
-    ensure_collection()
+    # поток наблюдения уже запущен, а products правит и он
+    with catalog_lock:
+        ensure_collection()
+        products.clear()
 
-    products.clear()
+        # point_id -> (product_id, img_path, digest)
+        wanted: dict[str, tuple[str, str, str]] = {}
+        for product_id in os.listdir(DATA_DIR):
+            product_dir = os.path.join(DATA_DIR, product_id)
+            if not os.path.isdir(product_dir):
+                continue
+            products[product_id] = []
+            for img_file in os.listdir(product_dir):
+                img_path = os.path.join(product_dir, img_file)
+                try:
+                    digest = embedding_store.digest(img_path)
+                except OSError as e:
+                    print(f"Ошибка {img_path}: {e}")
+                    continue
+                wanted[point_id(img_path)] = (product_id, img_path, digest)
 
-    batch_vectors, batch_ids, batch_payloads = [], [], []
-    BATCH = 64
+        indexed = indexed_points()
+        stale = [pid for pid in indexed if pid not in wanted]
+        for start in range(0, len(stale), DELETE_BATCH):
+            client.delete(
+                COLLECTION,
+                points_selector=qdrant.PointIdsList(
+                    points=stale[start : start + DELETE_BATCH]
+                ),
+            )
+        collection_changed()
 
-    for product_id in tqdm(os.listdir(DATA_DIR), desc="Scanning folder"):
-        product_dir = os.path.join(DATA_DIR, product_id)
-        if not os.path.isdir(product_dir):
-            continue
-        products[product_id] = []
-        for img_file in os.listdir(product_dir):
-            img_path = os.path.join(product_dir, img_file)
-            try:
-                image = Image.open(img_path).convert("RGB")
-                vec = embed_image(image)[0]  # (1024,)
-                pid = point_id()
-
-                batch_vectors.append(vec)
-                batch_ids.append(pid)
-                batch_payloads.append(
-                    {
-                        "product_id": product_id,
-                        "image_path": img_path,
-                    }
-                )
+        changed = []
+        for pid, (product_id, img_path, digest) in wanted.items():
+            if indexed.get(pid) == digest:
                 products[product_id].append(img_path)
-            except Exception as e:
-                print(f"Ошибка {img_path}: {e}")
-
-            # batched upsert
-            if len(batch_ids) >= BATCH:
-                client.upsert(
-                    COLLECTION,
-                    [
-                        qdrant.PointStruct(id=i, vector=v, payload=p)
-                        for i, v, p in zip(batch_ids, batch_vectors, batch_payloads)
-                    ],
-                )
-                batch_vectors, batch_ids, batch_payloads = [], [], []
+            else:
+                changed.append((product_id, img_path))
+        print(f"Синхронизация: удалено {len(stale)}, к индексации {len(changed)}")
+        index_images(changed, upsert_images)
+
+        embedding_store.retain_files(p for paths in products.values() for p in paths)
+    embedding_store.flush()
 
-    # хвост
-    if batch_ids:
-        client.upsert(
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Наблюдение за папкой каталога: её пишут и другие процессы (общий том)
+# ──────────────────────────────────────────────────────────────────────────────
+WATCH_BATCH = int(os.getenv("WATCH_BATCH", "256"))  # фото на порцию индексации
+
+catalog_lock = threading.Lock()  # сверка с папкой против правок каталога через API
+importing: set[str] = set()  # распакованы импортом, но ещё не проиндексированы
+
+
+def product_points(product_id: str) -> dict[str, tuple[str, str | None]]:
+    """point_id -> (img_path, digest) для точек товара; чужой энкодер — digest None."""
+    points, offset = {}, None
+    product = qdrant.Filter(
+        must=[
+            qdrant.FieldCondition(
+                key="product_id", match=qdrant.MatchValue(value=product_id)
+            )
+        ]
+    )
+    while True:
+        batch, offset = client.scroll(
             COLLECTION,
-            [
-                qdrant.PointStruct(id=i, vector=v, payload=p)
-                for i, v, p in zip(batch_ids, batch_vectors, batch_payloads)
-            ],
+            scroll_filter=product,
+            limit=DELETE_BATCH,
+            offset=offset,
+            with_payload=["image_path", "digest", "encoder"],
+            with_vectors=False,
         )
+        for p in batch:
+            payload = p.payload or {}
+            encoder = payload.get("encoder", f"{MODEL_NAME}-{PRETRAINED}")
+            points[str(p.id)] = (
+                payload.get("image_path"),
+                payload.get("digest") if encoder == ENCODER_ID else None,
+            )
+        if offset is None:
+            return points
+
+
+def reconcile_products(product_ids: set[str]):
+    """
+    Доводит коллекцию до папки для перечисленных товаров: точки пропавших фото
+    удаляет, новые и изменённые фото индексирует порциями по WATCH_BATCH.
+    Между порциями catalog_lock отпускается, чтобы не держать API; upsert по
+    id идемпотентен, так что фото, уже добавленное ручкой, просто перезапишется.
+    """
+    with catalog_lock:
+        stale, changed, dropped = [], [], 0
+        for product_id in sorted(product_ids):
+            product_dir = os.path.join(DATA_DIR, product_id)
+            if not os.path.isdir(product_dir):
+                if product_id in products:
+                    dropped += len(products.pop(product_id))
+                    client.delete(
+                        COLLECTION,
+                        points_selector=qdrant.FilterSelector(
+                            filter=qdrant.Filter(
+                                must=[
+                                    qdrant.FieldCondition(
+                                        key="product_id",
+                                        match=qdrant.MatchValue(value=product_id),
+                                    )
+                                ]
+                            )
+                        ),
+                    )
+                    shutil.rmtree(
+                        os.path.join(THUMBNAILS_DIR, product_id), ignore_errors=True
+                    )
+                continue
+            on_disk = {}
+            for img_file in os.listdir(product_dir):
+                img_path = os.path.join(product_dir, img_file)
+                if img_file.startswith(".") or img_path in importing:
+                    continue
+                try:
+                    on_disk[img_path] = embedding_store.digest(img_path)
+                except OSError as e:
+                    print(f"Ошибка {img_path}: {e}")
+            indexed = set()
+            for pid, (img_path, digest) in product_points(product_id).items():
+                if img_path in importing:
+                    continue
+                if img_path not in on_disk:
+                    stale.append(pid)
+                    remove_thumbnail(img_path)
+                elif on_disk[img_path] == digest:
+                    indexed.add(img_path)
+            changed.extend(
+                (product_id, img_path) for img_path in sorted(on_disk.keys() - indexed)
+            )
+            products[product_id] = sorted(indexed)
+        for start in range(0, len(stale), DELETE_BATCH):
+            client.delete(
+                COLLECTION,
+                points_selector=qdrant.PointIdsList(
+                    points=stale[start : start + DELETE_BATCH]
+                ),
+            )
+        collection_changed()
+
+    added = 0
+    for start in range(0, len(changed), WATCH_BATCH):
+        with catalog_lock:
+            batch = [
+                (product_id, img_path)
+                for product_id, img_path in changed[start : start + WATCH_BATCH]
+                if img_path not in importing
+                and product_id in products
+                and os.path.isfile(img_path)
+            ]
+            if batch:
+                added += index_images(batch, upsert_images)
+    embedding_store.flush()
+    print(
+        f"Сверка с папкой: товаров {len(product_ids)}, "
+        f"удалено {dropped + len(stale)}, проиндексировано {added}"
+    )
 
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory=DATA_DIR), name="static")
 
 
+# ──────────────────────────────────────────────────────────────────────────────
+# Старт: HTTP поднимается сразу, Qdrant и модель — в фоне
+# ──────────────────────────────────────────────────────────────────────────────
+readiness = Readiness()
+model_ready = readiness.model
+index_ready = readiness.index  # коллекция доступна для поиска
+reconciled = readiness.reconciled  # коллекция сверена с папкой, каталог можно менять
+require_search = readiness.require_search
+require_reconciled = readiness.require_reconciled
+
+
+def warm_up():
+    """
+    Коллекция хранится в Qdrant, поэтому искать можно сразу после подключения
+    и загрузки модели; сверка с папкой идёт следом, уже под нагрузкой.
+    """
+    if WATCH_MODE != "off":
+        threading.Thread(
+            target=watch_catalog,
+            args=(DATA_DIR, reconciled, reconcile_products),
+            name="catalog-watcher",
+            daemon=True,
+        ).start()
+    try:
+        connect()
+        index_ready.set()
+        load_model()
+        model_ready.set()
+        build_index_from_folder()
+        reconciled.set()
+    except Exception as e:
+        readiness.error = repr(e)
+        print(f"Ошибка запуска: {e}")
+
+
+@owner_operation
+def startup_state() -> dict:
+    return readiness.state()
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Режим обслуживания (SERVING_MODE): см. common.serving
+# ──────────────────────────────────────────────────────────────────────────────
+# сокеты, их блокировка и ключ лежат в папке, доступной только этому пользователю
+SERVING_DIR = os.getenv("SERVING_DIR", f"/tmp/image-search-qdrant-{os.getuid()}")
+SERVING_SOCKET = os.getenv("SERVING_SOCKET", os.path.join(SERVING_DIR, "owner.sock"))
+serving = Serving(
+    SERVING_DIR,
+    SERVING_SOCKET,
+    owner_operations,
+    readiness,
+    warm_up,
+    "модели и каталога",
+)
+
+
 @app.on_event("startup")
-def _startup():
-    build_index_from_folder()
+def on_startup():
+    serving.start()
+
 
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
 
-@app.post("/add_product/")
-def add_product():
+
+@app.get("/readyz")
+def readyz():
+    state = startup_state()
+    ready = state["model"] and state["index"]
+    return JSONResponse(state, status_code=200 if ready else 503)
+
+
+@owner_operation
+def create_product() -> str:
     product_id = str(uuid.uuid4())
     os.makedirs(os.path.join(DATA_DIR, product_id), exist_ok=True)
-    products[product_id] = []
-    return {"product_id": product_id}
+    with catalog_lock:
+        products[product_id] = []
+    return product_id
 
 
-@app.post("/add_image/{product_id}")
+@app.post("/add_product/", dependencies=[Depends(require_reconciled)])
+async def add_product():
+    return {"product_id": await on_owner(create_product)}
+
+
+@owner_operation
+def has_product(product_id: str) -> bool:
+    return product_id in products
+
+
+@owner_operation
+def index_image(product_id: str, img_path: str):
+    with catalog_lock:
+        upsert_images([(product_id, img_path)], file_embedding(img_path))
+
+
+@app.post("/add_image/{product_id}", dependencies=[Depends(require_reconciled)])
 async def add_image(product_id: str, file: UploadFile = File(...)):
-    if product_id not in products:
+    if not await on_owner(has_product, product_id):
         raise HTTPException(404, "Product not found")
 
     product_dir = os.path.join(DATA_DIR, product_id)
@@ -156,93 +813,602 @@ async def add_image(product_id: str, file: UploadFile = File(...)):
     fname = f"{uuid.uuid4().hex}_{file.filename}"
     img_path = os.path.join(product_dir, fname)
 
-    with open(img_path, "wb") as f:
-        f.write(await file.read())
-
-    image = Image.open(img_path).convert("RGB")
-    vec = embed_image(image)[0]
+    contents = await file.read()
+    await run_in_threadpool(Path(img_path).write_bytes, contents)
 
-    client.upsert(
-        COLLECTION,
-        [
-            qdrant.PointStruct(
-                id=point_id(),
-                vector=vec,
-                payload={
-                    "product_id": product_id,
-                    "image_path": img_path,
-                },
-            )
-        ],
-    )
-    products[product_id].append(img_path)
+    async with inference.slot():
+        await inference.run(save_thumbnail, img_path)
+        await on_owner(index_image, product_id, img_path)
     return {"message": "Image added", "path": img_path}
 
 
-@app.delete("/delete_image/{product_id}")
-def delete_image(product_id: str, filename: str):
+@owner_operation
+def drop_image(product_id: str, filename: str):
     """
-    Простейшая реализация: удаляем файл, затем строим коллекцию заново.
-    Можно оптимизировать через фильтр payload'ов и точечный delete_points.
+    Удаляем файл и ровно одну точку: её id однозначно задаётся путём.
     """
-    if product_id not in products:
-        raise HTTPException(404, "Product not found")
-
     img_path = os.path.join(DATA_DIR, product_id, filename)
-    if not os.path.exists(img_path):
-        raise HTTPException(404, "Image not found")
+    with catalog_lock:
+        if product_id not in products:
+            raise HTTPException(404, "Product not found")
+        if not os.path.exists(img_path):
+            raise HTTPException(404, "Image not found")
+
+        os.remove(img_path)
+        remove_thumbnail(img_path)
+        client.delete(
+            COLLECTION,
+            points_selector=qdrant.PointIdsList(points=[point_id(img_path)]),
+        )
+        collection_changed()
+        if img_path in products.get(product_id, []):
+            products[product_id].remove(img_path)
+
 
-    os.remove(img_path)
-    build_index_from_folder()
+@app.delete("/delete_image/{product_id}", dependencies=[Depends(require_reconciled)])
+async def delete_image(product_id: str, filename: str):
+    await on_owner(drop_image, product_id, filename)
     return {"message": "Image deleted"}
 
 
-@app.delete("/delete_product/{product_id}")
-def delete_product(product_id: str):
-    if product_id not in products:
-        raise HTTPException(404, "Product not found")
-    shutil.rmtree(os.path.join(DATA_DIR, product_id))
-    build_index_from_folder()
+@owner_operation
+def drop_product(product_id: str):
+    with catalog_lock:
+        if product_id not in products:
+            raise HTTPException(404, "Product not found")
+        shutil.rmtree(os.path.join(DATA_DIR, product_id), ignore_errors=True)
+        shutil.rmtree(os.path.join(THUMBNAILS_DIR, product_id), ignore_errors=True)
+        client.delete(
+            COLLECTION,
+            points_selector=qdrant.FilterSelector(
+                filter=qdrant.Filter(
+                    must=[
+                        qdrant.FieldCondition(
+                            key="product_id", match=qdrant.MatchValue(value=product_id)
+                        )
+                    ]
+                )
+            ),
+        )
+        products.pop(product_id, None)
+        collection_changed()
+
+
+@app.delete("/delete_product/{product_id}", dependencies=[Depends(require_reconciled)])
+async def delete_product(product_id: str):
+    await on_owner(drop_product, product_id)
     return {"message": "Product deleted"}
 
 
+@app.get("/thumb/{photo:path}")
+async def thumb(photo: str):
+    """
+    photo — путь из выдачи поиска ("<product_id>/<имя>"). Миниатюры нет или
+    фото с тех пор изменилось — строим её сейчас и кладём к остальным.
+    """
+    img_path = os.path.normpath(os.path.join(DATA_DIR, photo))
+    inside = img_path.startswith(os.path.normpath(DATA_DIR) + os.sep)
+    if not inside or not os.path.isfile(img_path):
+        raise HTTPException(404, "Image not found")
+    try:
+        target = await inference.run(ensure_thumbnail, img_path)
+    except OSError:
+        raise HTTPException(415, "Invalid image")
+    return FileResponse(
+        target,
+        media_type="image/jpeg",
+        headers={"Cache-Control": f"public, max-age={THUMBNAIL_MAX_AGE_S}"},
+    )
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 6.1  Массовый импорт каталога из tar/zip
+# ──────────────────────────────────────────────────────────────────────────────
+def index_import_chunk(job: dict, chunk: list[tuple[str, str]]):
+    indexed = set()
+
+    def sink(batch, vectors):
+        with catalog_lock:
+            upsert_images(batch, vectors)
+        indexed.update(img_path for _, img_path in batch)
+        job["indexed"] += len(batch)
+
+    try:
+        index_images(chunk, sink)
+        # нечитаемые картинки убираем из каталога вместе со старой точкой
+        failed = [img_path for _, img_path in chunk if img_path not in indexed]
+        for img_path in failed:
+            os.remove(img_path)
+        if failed:
+            # фильтр, а не PointIdsList: точки может и не быть
+            client.delete(
+                COLLECTION,
+                points_selector=qdrant.FilterSelector(
+                    filter=qdrant.Filter(
+                        must=[
+                            qdrant.HasIdCondition(has_id=[point_id(p) for p in failed])
+                        ]
+                    )
+                ),
+            )
+            collection_changed()
+        job["failed"] += len(failed)
+    finally:
+        importing.difference_update(img_path for _, img_path in chunk)
+
+
+def import_product(product_id: str) -> bool:
+    if product_id in products:
+        return False
+    products[product_id] = []
+    return True
+
+
+# повторный импорт того же файла перезаписывает точку: id задаётся путём
+catalog_import = CatalogImport(
+    DATA_DIR,
+    catalog_lock,
+    importing,
+    import_product,
+    index_import_chunk,
+    embedding_store.flush,
+)
+
+
+@app.post("/import/", dependencies=[Depends(require_reconciled)])
+async def import_catalog(file: UploadFile = File(...)):
+    """
+    Загружает tar (в т.ч. .tar.gz) или zip с папками товаров и ставит импорт
+    в фон. Прогресс — GET /import/{job_id}.
+    """
+    fd, archive_path = tempfile.mkstemp(suffix=".import")
+    with os.fdopen(fd, "wb") as out:
+        await run_in_threadpool(shutil.copyfileobj, file.file, out)
+    if not (zipfile.is_zipfile(archive_path) or tarfile.is_tarfile(archive_path)):
+        os.remove(archive_path)
+        raise HTTPException(400, "Expected a tar or zip archive")
+    # архив лежит на общем диске, распаковывает и индексирует его владелец
+    return await on_owner(start_import, archive_path)
+
+
+@owner_operation
+def start_import(archive_path: str) -> dict:
+    return catalog_import.start(archive_path)
+
+
+@owner_operation
+def import_job(job_id: str) -> dict:
+    if job_id not in catalog_import.jobs:
+        raise HTTPException(404, "Import job not found")
+    return catalog_import.jobs[job_id]
+
+
+@app.get("/import/{job_id}")
+async def import_status(job_id: str):
+    return await on_owner(import_job, job_id)
+
+
+@owner_operation
+def owner_stats() -> dict:
+    return {"batcher": batcher.stats(), "result_cache": result_cache.stats()}
+
+
+@app.get("/stats/")
+async def stats():
+    # очередь модели и кэш выдач — у владельца, пул и кэш запросов — у воркера
+    return {
+        **await on_owner(owner_stats),
+        "inference": inference.stats(),
+        "query_cache": query_cache.stats(),
+        "serving": {
+            "mode": SERVING_MODE,
+            "pid": os.getpid(),
+            "owner": serving.owner is None,
+        },
+    }
+
+
+def cache_metrics(name: str, cache: LRUCache, labels: dict) -> list[tuple]:
+    stats = cache.stats()
+    labels = {**labels, "cache": name}
+    return [
+        (f"image_search_cache_{key}", kind, help_text, [(suffix, labels, stats[key])])
+        for key, suffix, kind, help_text in (
+            ("hits", "_total", "counter", "Cache lookups that hit"),
+            ("misses", "_total", "counter", "Cache lookups that missed"),
+            ("evictions", "_total", "counter", "Entries evicted by size"),
+            ("hit_ratio", "", "gauge", "Hits per lookup since start"),
+            ("entries", "", "gauge", "Entries in the cache"),
+            ("bytes", "", "gauge", "Bytes held by the cache"),
+        )
+    ]
+
+
+def local_metrics(role: str) -> list[tuple]:
+    """Метрики процесса, принявшего HTTP-запрос: этапы, пул декодирования, кэш запросов."""
+    labels = {"role": role, "pid": os.getpid()}
+    return [
+        (
+            "image_search_stage_seconds",
+            "histogram",
+            "Time spent in each stage of the request path",
+            timers.samples(labels),
+        ),
+        (
+            "image_search_inference_pending",
+            "gauge",
+            "Requests holding an inference slot",
+            [("", labels, inference.pending)],
+        ),
+        *cache_metrics("query", query_cache, labels),
+    ]
+
+
+@owner_operation
+def owner_metrics() -> list[tuple]:
+    labels = {"role": "owner", "pid": os.getpid()}
+    points = client.get_collection(COLLECTION).points_count if client else 0
+    return [
+        *local_metrics("owner"),
+        (
+            "image_search_index_vectors",
+            "gauge",
+            "Points in the Qdrant collection",
+            [("", labels, points or 0)],
+        ),
+        (
+            "image_search_products",
+            "gauge",
+            "Products in the catalog",
+            [("", labels, len(products))],
+        ),
+        (
+            "image_search_batcher_queue_depth",
+            "gauge",
+            "Online requests waiting for the model",
+            [("", labels, batcher.queue.qsize())],
+        ),
+        (
+            "image_search_batches",
+            "counter",
+            "Forward passes of the online batcher by batch size",
+            [
+                ("_total", {**labels, "size": size}, count)
+                for size, count in sorted(batcher.batch_sizes.items())
+            ],
+        ),
+        *cache_metrics("result", result_cache, labels),
+    ]
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # в режиме shared модель и коллекция — у владельца, этапы HTTP — у каждого воркера
+    families = await on_owner(owner_metrics)
+    if serving.owner is not None:
+        families += local_metrics("frontend")
+    return render_metrics(families)
+
+
+def require_profiler():
+    if not PROFILER_ENABLED:
+        raise HTTPException(404, "Profiler is disabled")
+
+
+@owner_operation
+def profile_start(interval_ms: float, max_s: float) -> dict:
+    profiler.start(interval_ms, max_s)
+    return profiler.stats()
+
+
+@owner_operation
+def profile_stop() -> str:
+    return profiler.stop()
+
+
+@owner_operation
+def profile_state() -> dict:
+    return profiler.stats()
+
+
+async def on_profiled(fn, local: bool, *args):
+    """Профилируется владелец (модель и индекс) или, с local, сам воркер."""
+    if local:
+        return await run_in_threadpool(fn, *args)
+    return await on_owner(fn, *args)
+
+
+@app.post("/debug/profile/start", dependencies=[Depends(require_profiler)])
+async def start_profile(
+    interval_ms: float = PROFILER_INTERVAL_MS,
+    max_s: float = PROFILER_MAX_S,
+    local: bool = False,
+):
+    return await on_profiled(profile_start, local, interval_ms, max_s)
+
+
+@app.post(
+    "/debug/profile/stop",
+    dependencies=[Depends(require_profiler)],
+    response_class=PlainTextResponse,
+)
+async def stop_profile(local: bool = False):
+    """Collapsed stacks последнего сеанса, в т.ч. остановившегося по max_s."""
+    return await on_profiled(profile_stop, local)
+
+
+@app.get("/debug/profile", dependencies=[Depends(require_profiler)])
+async def profile_status(local: bool = False):
+    return await on_profiled(profile_state, local)
+
+
 # ──────────────────────────────────────────────────────────────────────────────
 # 6.2  Поиск ближайших товаров
 # ──────────────────────────────────────────────────────────────────────────────
-@app.post("/search/")
-async def search(file: UploadFile = File(...), k: int = 5):
-    contents = await file.read()
-    image = Image.open(BytesIO(contents)).convert("RGB")
-    query_vec = embed_image(image)[0].tolist()
+SEARCH_MAX_FETCH = int(os.getenv("SEARCH_MAX_FETCH", "10000"))
+
+
+def search_points(query_vecs: np.ndarray, k: int) -> list[list]:
+    """
+    Один batch-запрос к Qdrant на все векторы. Запросам, которым не хватило
+    k разных товаров, лимит удваивается, пока коллекция не кончится или
+    не упрётся в SEARCH_MAX_FETCH.
+    """
+    limit = min(k * SEARCH_OVERFETCH, SEARCH_MAX_FETCH)
+    results = [[] for _ in query_vecs]
+    pending = list(range(len(query_vecs)))
+    while pending:
+        responses = client.query_batch_points(
+            COLLECTION,
+            requests=[
+                qdrant.QueryRequest(
+                    query=query_vecs[i].tolist(),
+                    limit=limit,
+                    params=search_params(),
+                    with_payload=True,
+                )
+                for i in pending
+            ],
+        )
+        retry = []
+        for i, response in zip(pending, responses):
+            results[i] = points = response.points
+            distinct = len({p.payload["product_id"] for p in points})
+            if distinct < k and len(points) == limit and limit < SEARCH_MAX_FETCH:
+                retry.append(i)
+        pending = retry
+        limit = min(limit * 2, SEARCH_MAX_FETCH)
+    return results
 
-    # ищем с запасом, чтобы потом сгруппировать по product_id
-    limit = k * 10
-    hits = client.query_points(COLLECTION, query=query_vec, limit=limit)
 
-    if not hits:
+def product_matches(
+    points: list, k: int, aggregation: Aggregation, top_m: int
+) -> list[dict]:
+    # для cosine similarity: чем БОЛЬШЕ score, тем ближе
+    similarities = np.array([p.score for p in points], dtype="float32")
+    product_ids, positions = np.unique(
+        [p.payload["product_id"] for p in points], return_inverse=True
+    )
+    return match_products(
+        similarities,
+        positions,
+        k,
+        aggregation,
+        top_m,
+        lambda position: str(product_ids[position]),
+        lambda hit: str(Path(points[hit].payload["image_path"]).relative_to(DATA_DIR)),
+    )
+
+
+@owner_operation
+def find_matches(
+    query_vecs: np.ndarray, k: int, aggregation: Aggregation, top_m: int
+) -> list[list[dict] | None]:
+    """
+    Выдача по товарам на каждый вектор, готовые берутся из кэша; None — в
+    коллекции пусто. Версия в ключе: выдача, посчитанная во время записи,
+    не всплывёт.
+    """
+    keys = [
+        (
+            hashlib.blake2b(vec.tobytes(), digest_size=16).digest(),
+            k,
+            aggregation,
+            top_m,
+            collection_version,
+        )
+        for vec in query_vecs
+    ]
+    matches = [result_cache.get(key) for key in keys]
+    missing = [row for row, found in enumerate(matches) if found is None]
+    if missing:
+        with timers.time("index_search"):
+            hits = search_points(query_vecs[missing], k)
+        for row, points in zip(missing, hits):
+            if points:
+                with timers.time("grouping"):
+                    matches[row] = product_matches(points, k, aggregation, top_m)
+                result_cache.put(keys[row], matches[row], len(json.dumps(matches[row])))
+    return matches
+
+
+@app.post("/search/", dependencies=[Depends(require_search)])
+async def search(
+    file: UploadFile = File(...),
+    k: int = 5,
+    aggregation: Aggregation = SEARCH_AGGREGATION,
+    top_m: int = SEARCH_TOP_M,
+):
+    with timers.time("read"):
+        contents = await file.read()
+    query_vec = await embed_query(contents)
+    [matches] = await on_owner(find_matches, query_vec, k, aggregation, top_m)
+    if matches is None:
         raise HTTPException(400, "Index is empty")
+    return {"matches": matches}
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 6.3  Пакетный поиск
+# ──────────────────────────────────────────────────────────────────────────────
+SEARCH_BATCH_SIZE = int(os.getenv("SEARCH_BATCH_SIZE", "64"))
+
+
+@app.post("/search/batch", dependencies=[Depends(require_search)])
+async def search_batch(
+    files: list[UploadFile] = File(...),
+    k: int = 5,
+    aggregation: Aggregation = SEARCH_AGGREGATION,
+    top_m: int = SEARCH_TOP_M,
+):
+    """
+    Поиск по пачке картинок. Файлы режутся на чанки по SEARCH_BATCH_SIZE:
+    чанк — один forward модели и один query_batch_points.
+    Ответ — NDJSON, строка на файл в порядке загрузки, отдаётся по мере
+    готовности чанков; эмбеддинги следующего чанка считаются, пока ищем
+    по текущему.
+    """
+    names = [file.filename for file in files]
+    with timers.time("read"):
+        contents = [await file.read() for file in files]
+    chunks = [
+        range(start, min(start + SEARCH_BATCH_SIZE, len(files)))
+        for start in range(0, len(files), SEARCH_BATCH_SIZE)
+    ]
+    # слот занимаем до ответа, чтобы 503 пришёл статусом, а не посреди потока
+    stack = AsyncExitStack()
+    await stack.enter_async_context(inference.slot())
 
-    grouped: dict[str, list[tuple[float, str]]] = defaultdict(list)
-    for p in hits.points:
-        dist = p.score  # для cosine similarity: чем БОЛЬШЕ, тем ближе
-        pid = p.payload["product_id"]
-        img = p.payload["image_path"]
-        grouped[pid].append((dist, img))
+    def embed_chunk(chunk: range) -> asyncio.Future:
+        return asyncio.ensure_future(embed_queries([contents[i] for i in chunk]))
 
-    # сортируем товары по максимальной близости (‑score↓)
-    ranked = sorted(
-        grouped.items(), key=lambda x: max(d for d, _ in x[1]), reverse=True
+    async def stream():
+        pending = embed_chunk(chunks[0])
+        try:
+            for n, chunk in enumerate(chunks):
+                ok, vectors = await pending
+                if n + 1 < len(chunks):
+                    pending = embed_chunk(chunks[n + 1])
+                errors = dict.fromkeys(range(len(chunk)), "Invalid image")
+                found = {}
+                if ok:
+                    try:
+                        hits = await on_owner(
+                            find_matches, vectors, k, aggregation, top_m
+                        )
+                        found = dict(zip(ok, hits))
+                    except HTTPException as e:
+                        # владелец недоступен: заголовки уже ушли, ошибка — в строки
+                        errors.update(dict.fromkeys(ok, e.detail))
+                for row, i in enumerate(chunk):
+                    line = {"index": i, "filename": names[i]}
+                    if row not in found:
+                        line["error"] = errors[row]
+                    elif found[row] is None:
+                        line["error"] = "Index is empty"
+                    else:
+                        line["matches"] = found[row]
+                    yield json.dumps(line) + "\n"
+        finally:
+            pending.cancel()
+
+    return SlotStreamingResponse(stream(), stack, media_type="application/x-ndjson")
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# 6.4  Сжатие векторов: память и recall
+# ──────────────────────────────────────────────────────────────────────────────
+BYTES_PER_DIM = {"float32": 4, "float16": 2}
+QUANTIZED_BYTES = {"none": 0, "int8": VECTOR_SIZE, "pq": VECTOR_SIZE * 4 // 64}
+
+
+def vector_memory(points: int, datatype: str, quantization: str, on_disk: bool):
+    """
+    Оценка памяти под векторы без HNSW-графа и payload. Оригиналы на диске
+    читаются через page cache и в ram_bytes не входят.
+    """
+    original = points * VECTOR_SIZE * BYTES_PER_DIM[datatype]
+    quantized = points * QUANTIZED_BYTES[quantization]
+    return {
+        "ram_bytes": quantized + (0 if on_disk else original),
+        "disk_bytes": original if on_disk else 0,
+    }
+
+
+def recall_at(found: list[list], truth: list[list]) -> float:
+    return float(np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)]))
+
+
+@owner_operation
+def compression_report(k: int, queries: int) -> dict:
+    """
+    recall@k текущей коллекции относительно точного перебора по оригиналам:
+    только по квантованным векторам и с пересчётом (rescore), как ищет сервис.
+    Память — для текущего режима и оценкой для остальных. recall остальных
+    режимов не меряется: для этого пришлось бы копировать весь каталог в
+    коллекцию с другим сжатием и ждать, пока Qdrant её проквантует, поэтому
+    у них "recall": null.
+    """
+    points = client.get_collection(COLLECTION).points_count or 0
+    sample, _ = client.scroll(
+        COLLECTION, limit=queries, with_payload=False, with_vectors=True
     )
+    if not points or not sample:
+        raise HTTPException(400, "Index is empty")
 
-    results = []
-    for pid, items in ranked[:k]:
-        # берём до 5 лучших фото внутри товара
-        top_imgs = sorted(items, key=lambda x: x[0], reverse=True)[:5]
-        results.append(
-            {
-                "product_id": pid,
-                "photos": [str(Path(p).relative_to(DATA_DIR)) for _, p in top_imgs],
-            }
+    def top_ids(params) -> list[list]:
+        responses = client.query_batch_points(
+            COLLECTION,
+            requests=[
+                qdrant.QueryRequest(query=p.vector, limit=k, params=params)
+                for p in sample
+            ],
+        )
+        return [[p.id for p in response.points] for response in responses]
+
+    truth = top_ids(
+        qdrant.SearchParams(
+            exact=True, quantization=qdrant.QuantizationSearchParams(ignore=True)
         )
+    )
+    current = {
+        "datatype": QDRANT_DATATYPE,
+        "quantization": QDRANT_QUANTIZATION,
+        "on_disk": QDRANT_ON_DISK,
+        "oversampling": QDRANT_OVERSAMPLING,
+        **vector_memory(points, QDRANT_DATATYPE, QDRANT_QUANTIZATION, QDRANT_ON_DISK),
+        "recall": recall_at(top_ids(search_params()), truth),
+    }
+    if QDRANT_QUANTIZATION != "none":
+        current["recall_without_rescore"] = recall_at(
+            top_ids(
+                qdrant.SearchParams(
+                    quantization=qdrant.QuantizationSearchParams(rescore=False)
+                )
+            ),
+            truth,
+        )
+    current_mode = f"{QDRANT_DATATYPE}+{QDRANT_QUANTIZATION}"
+    return {
+        "points": points,
+        "k": k,
+        "queries": len(sample),
+        "current": current,
+        "estimated": {
+            f"{datatype}+{quantization}": {
+                **vector_memory(points, datatype, quantization, QDRANT_ON_DISK),
+                "recall": (
+                    current["recall"]
+                    if f"{datatype}+{quantization}" == current_mode
+                    else None
+                ),
+            }
+            for datatype in BYTES_PER_DIM
+            for quantization in QUANTIZED_BYTES
+        },
+    }
+
 
-    return {"matches": results}
+@app.get("/index/compression", dependencies=[Depends(require_search)])
+async def index_compression(k: int = 10, queries: int = 100):
+    return await on_owner(compression_report, k, queries)
@@ -1,91 +1,1440 @@
+import asyncio
+import hashlib
+import json
 import os
 import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import uuid
+import zipfile
 
 import numpy as np
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import BackgroundTasks, Depends, FastAPI, UploadFile, File, HTTPException
+from fastapi import Query
 from PIL import Image
 from tqdm import tqdm
 import torch
-from transformers import CLIPProcessor, CLIPModel
+from transformers import CLIPImageProcessor, CLIPModel
 import faiss
-from io import BytesIO
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+)
 from fastapi.staticfiles import StaticFiles
-from collections import defaultdict
+from starlette.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
 from pathlib import Path
 
+from common.caching import LRUCache
+from common import encoders
+from common.embeddings import EmbeddingStore
+from common.encoders import ENCODER_BACKEND
+from common.grouping import (
+    SEARCH_AGGREGATION,
+    SEARCH_OVERFETCH,
+    SEARCH_TOP_M,
+    Aggregation,
+    match_products,
+)
+from common.faiss_index import (
+    configure_index,
+    copy_mapped,
+    make_index,
+    open_mapped,
+    read_mapped,
+    remove_vectors,
+)
+from common.image_table import ImageTable
+from common.importer import CatalogImport
+from common.inference import BatchScheduler, InferenceExecutor, SlotStreamingResponse
+from common.metrics import (
+    STAGE_BUCKETS_S,
+    SamplingProfiler,
+    StageTimers,
+    render_metrics,
+)
+from common.preprocess import FastPreprocess, decode_batches
+from common.queries import QueryEmbedder
+from common.rpc import OwnerClient, private_dir
+from common.serving import (
+    OWNER_POLL_S,
+    SERVING_AUTHKEY,
+    SERVING_MODE,
+    Readiness,
+    Serving,
+)
+from common.sharding import jump_hash, merge_top_k
+from common.thumbnails import (
+    THUMBNAIL_MAX_AGE_S,
+    THUMBNAIL_SIZE,
+    THUMBNAILS_DIR,
+    Thumbnails,
+)
+from common.watch import WATCH_MODE, watch_catalog
+
 
 # Настройка модели CLIP
+MODEL_NAME = "openai/clip-vit-base-patch32"
+PREPROCESS_VERSION = 2  # увеличить при любом изменении препроцессинга
 device = "cuda" if torch.cuda.is_available() else "cpu"
-clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device)
-clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+clip_model = None  # веса грузит load_model(), при старте — в фоне
+# препроцессингу нужен только конфиг процессора, без весов
+clip_processor = CLIPImageProcessor.from_pretrained(MODEL_NAME)
+# векторы разных бэкендов чуть расходятся, поэтому кэш и снапшоты у них свои
+ENCODER_ID = (
+    MODEL_NAME if ENCODER_BACKEND == "eager" else f"{MODEL_NAME}+{ENCODER_BACKEND}"
+)
 
 # Хранилища
 DATA_DIR = "./products"
 os.makedirs(DATA_DIR, exist_ok=True)
 
-products = {}  # product_id: List[image_paths]
-product_id_map = []  # Индексы в FAISS -> product_id
-reverse_photo_map = []
-index = faiss.IndexFlatL2(512)  # FAISS index
+
+images = ImageTable(DATA_DIR)  # товары и фото; id вектора в FAISS = строка таблицы
+tombstones = set()  # id удалённых, но ещё не вычищенных из FAISS векторов
+
+# Тип индекса — строка index_factory: Flat, HNSW32, IVF1024,Flat, IVF1024,PQ64…
+# Векторы L2-нормированы, поэтому метрика — скалярное произведение (= косинус).
+FAISS_INDEX = os.getenv("FAISS_INDEX", "Flat")
+FAISS_TRAIN_SIZE = int(os.getenv("FAISS_TRAIN_SIZE", "100000"))
+# Сжатые индексы (SQfp16, SQ8, PQ64…) врут в близостях: с FAISS_RERANK=N берём
+# в N раз больше кандидатов и пересчитываем близости по float32-векторам из
+# кэша эмбеддингов (memmap на диске, в RAM только прочитанные страницы).
+FAISS_RERANK = int(os.getenv("FAISS_RERANK", "0"))
+# FAISS_NPROBE и FAISS_EF_SEARCH по умолчанию — в common.faiss_index
+
+index_spec = FAISS_INDEX  # фактический тип: Flat, если обучить не вышло
+index = make_index(index_spec, 512)  # FAISS index
+untrained = []  # (ids, векторы), пришедшие до обучения IVF/PQ
+index_lock = threading.Lock()
+TOMBSTONE_COMPACT_THRESHOLD = int(os.getenv("TOMBSTONE_COMPACT_THRESHOLD", "1000"))
+
+EMBEDDINGS_DIR = os.getenv("EMBEDDINGS_DIR", "./embeddings")
+
+
+# Кэш эмбеддингов на диске
+embedding_store = EmbeddingStore(EMBEDDINGS_DIR, ENCODER_ID, 512, PREPROCESS_VERSION)
+
+
+# Быстрый препроцессинг: те же шаги, что у CLIPProcessor, без его обвязки
+fast_preprocess = FastPreprocess.from_clip_processor(clip_processor)
+open_image = fast_preprocess.open
+preprocess_image = fast_preprocess
+
+
+# Бэкенд энкодера
+class ImageTower(torch.nn.Module):
+    """Картиночная часть CLIP: pixel_values -> признаки, без нормировки."""
+
+    def __init__(self, model: CLIPModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.model.get_image_features(pixel_values=pixel_values)
+
+
+def make_encoder(tower: torch.nn.Module, backend: str):
+    return encoders.make_encoder(
+        tower, backend, MODEL_NAME, device, fast_preprocess.crop_size
+    )
+
+
+image_encoder = None  # см. load_model
+
+
+def load_model():
+    global clip_model, image_encoder
+    started = time.perf_counter()
+    clip_model = CLIPModel.from_pretrained(MODEL_NAME).to(device).eval()
+    image_encoder = make_encoder(ImageTower(clip_model), ENCODER_BACKEND)
+    print(f"Модель {ENCODER_ID} загружена за {time.perf_counter() - started:.1f} с")
+
+
+# Операции над моделью и индексом. В режиме shared (SERVING_MODE, см. common.serving)
+# их выполняет один процесс-владелец, остальные воркеры зовут его по сокету.
+owner_operations = {}  # имя -> функция
+
+
+def owner_operation(fn):
+    owner_operations[fn.__name__] = fn
+    return fn
+
+
+async def on_owner(fn, *args):
+    """Выполняет операцию в пуле потоков: у себя или у владельца, если он не мы."""
+    if serving.owner is None:
+        return await run_in_threadpool(fn, *args)
+    try:
+        return await run_in_threadpool(serving.owner.call, fn.__name__, *args)
+    except (OSError, EOFError) as e:  # владелец перезапускается
+        raise HTTPException(
+            status_code=503,
+            detail="Index owner is unavailable",
+            headers={"Retry-After": "1"},
+        ) from e
+
+
+# Метрики горячего пути и сэмплирующий профайлер
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "10"))
+PROFILER_MAX_S = float(os.getenv("PROFILER_MAX_S", "300"))
+
+timers = StageTimers(STAGE_BUCKETS_S)
+profiler = SamplingProfiler()
 
 
 # Функция генерации эмбеддинга
+@owner_operation
+def embed_batch(pixel_values: torch.Tensor) -> np.ndarray:
+    with timers.time("forward"), torch.no_grad():
+        embedding = image_encoder(pixel_values.to(device)).float()
+        embedding /= embedding.norm(p=2, dim=-1, keepdim=True)
+        return embedding.cpu().numpy().astype("float32")
+
+
 def embed_image(image: Image.Image) -> np.ndarray:
-    inputs = clip_processor(images=image, return_tensors="pt").to(device)
-    with torch.no_grad():
-        embedding = clip_model.get_image_features(**inputs)
-    embedding /= embedding.norm(p=2, dim=-1, keepdim=True)
-    return embedding.cpu().numpy().astype("float32")
+    return embed_batch(preprocess_image(image).unsqueeze(0))
+
+
+# Микробатчинг онлайн-запросов
+SEARCH_MAX_BATCH = int(os.getenv("SEARCH_MAX_BATCH", "16"))
+SEARCH_MAX_WAIT_MS = float(os.getenv("SEARCH_MAX_WAIT_MS", "5"))
+
+batcher = BatchScheduler(embed_batch, SEARCH_MAX_BATCH, SEARCH_MAX_WAIT_MS, timers)
+
+
+# Инференс вне event loop
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", "4"))
+INFERENCE_MAX_PENDING = int(os.getenv("INFERENCE_MAX_PENDING", "64"))
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", "0"))  # 0 — решает torch
+if TORCH_THREADS:
+    torch.set_num_threads(TORCH_THREADS)
+
+inference = InferenceExecutor(INFERENCE_THREADS, INFERENCE_MAX_PENDING)
+
+
+# Кэши эмбеддингов запросов и готовых выдач
+QUERY_CACHE_MB = float(os.getenv("QUERY_CACHE_MB", "64"))
+QUERY_CACHE_TTL_S = float(os.getenv("QUERY_CACHE_TTL_S", "3600"))
+QUERY_CACHE_PHASH = os.getenv("QUERY_CACHE_PHASH", "0") == "1"
+RESULT_CACHE_MB = float(os.getenv("RESULT_CACHE_MB", "32"))
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", "300"))
+
+query_cache = LRUCache(QUERY_CACHE_MB, QUERY_CACHE_TTL_S)  # sha256 байт -> вектор
+result_cache = LRUCache(RESULT_CACHE_MB, RESULT_CACHE_TTL_S)  # запрос -> выдача
+index_version = 0  # растёт при каждой мутации индекса, входит в ключ выдачи
+
+
+def index_changed():
+    global index_version
+    index_version += 1
+    result_cache.clear()
+
+
+def load_image(source) -> torch.Tensor:
+    return preprocess_image(open_image(source))
+
+
+@owner_operation
+def embed_pixels(pixel_values: torch.Tensor) -> np.ndarray:
+    return batcher.submit(pixel_values).result()
+
+
+async def embed_online(pixel_values: torch.Tensor) -> np.ndarray:
+    """Через микробатчер; в режиме shared в батч попадают запросы всех воркеров."""
+    if serving.owner is None:
+        return await batcher.embed(pixel_values)
+    return await on_owner(embed_pixels, pixel_values)
+
+
+query_embedder = QueryEmbedder(
+    fast_preprocess, timers, inference, query_cache, embed_online, QUERY_CACHE_PHASH
+)
+decode_query = query_embedder.decode
+try_load_image = query_embedder.try_decode
+embed_query = query_embedder.embed
+
+
+# Пачка запросов: декодирование параллельно в пуле, эмбеддинги одним forward'ом
+async def embed_queries(contents: list[bytes]) -> tuple[list[int], np.ndarray]:
+    tensors = await asyncio.gather(
+        *(inference.run(try_load_image, c) for c in contents)
+    )
+    ok = [i for i, tensor in enumerate(tensors) if tensor is not None]
+    if not ok:
+        return ok, np.empty((0, 512), dtype="float32")
+    pixel_values = torch.stack([tensors[i] for i in ok])
+    if serving.owner is None:
+        return ok, await inference.run(embed_batch, pixel_values)
+    return ok, await on_owner(embed_batch, pixel_values)
+
+
+# Эмбеддинг файла: из кэша, а при промахе — через модель
+@owner_operation
+def file_embedding(image_path: str) -> np.ndarray:
+    digest = embedding_store.digest(image_path)
+    embedding = embedding_store.get(digest)
+    if embedding is None:
+        embedding = embed_pixels(load_image(image_path))
+        embedding_store.put(digest, embedding)
+    return embedding
+
+
+# Миниатюры для UI: генерируются при индексации, иначе — при первом запросе
+thumbnails = Thumbnails(DATA_DIR, THUMBNAILS_DIR, THUMBNAIL_SIZE, open_image)
+thumbnail_fresh = thumbnails.fresh
+save_thumbnail = thumbnails.save
+ensure_thumbnail = thumbnails.ensure
+remove_thumbnail = thumbnails.remove
+
+
+# Пайплайн индексации: декодирование в пуле потоков, инференс батчами
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "32"))
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", str(os.cpu_count() or 1)))
+
+
+def load_for_index(image_path: str) -> torch.Tensor | None:
+    try:
+        image = open_image(image_path)
+        if not thumbnail_fresh(image_path):
+            save_thumbnail(image_path, image)  # фото уже декодировано
+        return preprocess_image(image)
+    except Exception as e:
+        print(f"Ошибка при обработке {image_path}: {e}")
+        return None
+
+
+def embed_files(paths: list[str]):
+    """
+    Генератор (позиции в paths, эмбеддинги) по мере готовности батчей.
+    Пул из INDEX_WORKERS потоков декодирует и препроцессит картинки
+    параллельно и на пару батчей вперёд, модель видит батчи INDEX_BATCH_SIZE.
+    """
+    for positions, pixel_values in decode_batches(
+        paths, load_for_index, INDEX_BATCH_SIZE, INDEX_WORKERS
+    ):
+        yield positions, embed_batch(pixel_values)
+
+
+def index_images(items: list[tuple[str, str]], sink) -> int:
+    """
+    Индексирует (product_id, image_path): векторы из кэша сразу уходят в sink,
+    промахи считаются через embed_files и докладываются в кэш.
+    sink(batch, vectors) вызывается по мере готовности батчей.
+    """
+    started = time.perf_counter()
+    progress = tqdm(total=len(items), unit="img")
+
+    hashed, digests = [], []
+    for product_id, image_path in items:
+        try:
+            digests.append(embedding_store.digest(image_path))
+            hashed.append((product_id, image_path))
+        except OSError as e:
+            print(f"Ошибка при обработке {image_path}: {e}")
+
+    found, cached = embedding_store.get_many(digests)
+    hits = [item for item, hit in zip(hashed, found) if hit]
+    for start in range(0, len(hits), INDEX_BATCH_SIZE):
+        sink(
+            hits[start : start + INDEX_BATCH_SIZE],
+            cached[start : start + INDEX_BATCH_SIZE],
+        )
+        progress.update(len(hits[start : start + INDEX_BATCH_SIZE]))
+
+    misses = [(item, d) for item, d, hit in zip(hashed, digests, found) if not hit]
+    done = len(hits)
+    for positions, vectors in embed_files(
+        [image_path for (_, image_path), _ in misses]
+    ):
+        embedding_store.put_many([misses[i][1] for i in positions], vectors)
+        sink([misses[i][0] for i in positions], vectors)
+        progress.update(len(positions))
+        done += len(positions)
+
+    progress.close()
+    elapsed = time.perf_counter() - started
+    print(
+        f"Проиндексировано {done} изображений за {elapsed:.1f} с ({done / max(elapsed, 1e-9):.1f} img/s)"
+    )
+    return done
+
+
+# Добавление векторов со стабильными id
+def add_to_index(batch: list[tuple[str, str]], embeddings: np.ndarray):
+    vector_rows = embedding_store.rows_for([image_path for _, image_path in batch])
+    with index_lock:
+        ensure_writable()
+        ids = images.append(batch, vector_rows)
+        if index.is_trained:
+            index.add_with_ids(embeddings, ids)
+        else:
+            untrained.append((ids, embeddings))
+    index_changed()
+    snapshot_dirty.set()
+
+
+# Удаление: только помечаем id, из FAISS их вычищает compact_index
+def remove_from_index(ids: np.ndarray):
+    if not len(ids):
+        return
+    with index_lock:
+        images.remove(ids)
+        tombstones.update(ids.tolist())
+    index_changed()
+    snapshot_dirty.set()
+
+
+def remove_product(product_id: str):
+    with index_lock:
+        ids = images.drop_product(product_id)
+        tombstones.update(ids.tolist())
+    index_changed()
+    snapshot_dirty.set()
+
+
+@owner_operation
+def compact_index(force: bool = False):
+    global index
+    with index_lock:
+        if not tombstones:
+            return
+        if len(tombstones) < TOMBSTONE_COMPACT_THRESHOLD and not force:
+            return
+        ensure_writable()
+        removed = np.fromiter(tombstones, dtype="int64")
+        index = remove_vectors(index, removed, index_spec)
+        tombstones.clear()
+    snapshot_dirty.set()
+
+
+# Обучение IVF/PQ на векторах, накопленных за стартовую индексацию
+def train_index():
+    global index, index_spec
+    with index_lock:
+        if index.is_trained:
+            return
+        ids = np.concatenate([i for i, _ in untrained] or [np.empty(0, "int64")])
+        vectors = np.concatenate([v for _, v in untrained] or [np.empty((0, 512))])
+        rng = np.random.default_rng(0)
+        sample = rng.permutation(len(vectors))[:FAISS_TRAIN_SIZE]
+        try:
+            index.train(np.ascontiguousarray(vectors[sample], dtype="float32"))
+        except RuntimeError as e:
+            print(f"Не удалось обучить {index_spec} на {len(vectors)} векторах: {e}")
+            print("Используем Flat до следующей пересборки")
+            index_spec = "Flat"
+            index = new_index(index_spec)
+        if len(ids):
+            index.add_with_ids(vectors, ids)
+        untrained.clear()
+    index_changed()
+    snapshot_dirty.set()  # снапшоты до обучения не пишутся
+
+
+# Векторы всех живых фото из кэша эмбеддингов (эталон для recall)
+def live_vectors() -> tuple[np.ndarray, np.ndarray]:
+    with index_lock:
+        live = [(i, images.path(i)) for i in images.live_ids()]
+    ids, digests = [], []
+    for image_id, image_path in live:
+        try:
+            digests.append(embedding_store.digest(image_path))
+            ids.append(image_id)
+        except OSError:
+            continue
+    found, vectors = embedding_store.get_many(digests)
+    return np.array(ids, dtype="int64")[found], vectors
+
+
+@owner_operation
+def recall_report(
+    k: int, queries: int, nprobe: int | None = None, ef_search: int | None = None
+) -> dict:
+    """
+    recall@k текущего индекса относительно точного перебора (Flat IP);
+    запросы — случайные фото каталога.
+    """
+    params = search_params(nprobe, ef_search)
+    ids, vectors = live_vectors()
+    if not len(ids):
+        raise HTTPException(status_code=400, detail="Index is empty")
+    exact = faiss.IndexIDMap2(faiss.IndexFlatIP(512))
+    exact.add_with_ids(vectors, ids)
+    rng = np.random.default_rng(0)
+    sample = vectors[rng.permutation(len(ids))[:queries]]
+
+    started = time.perf_counter()
+    _, truth = exact.search(sample, k)
+    exact_ms = (time.perf_counter() - started) * 1000 / len(sample)
+
+    started = time.perf_counter()
+    with index_lock:
+        fetch = k * max(FAISS_RERANK, 1) + len(tombstones)
+        similarities, approx = index.search(sample, fetch, params=params)
+        dead = set(tombstones)
+    if FAISS_RERANK:
+        for row, query in enumerate(sample):
+            live = approx[row] >= 0
+            similarities[row, live] = rescore(
+                query, approx[row, live], similarities[row, live]
+            )
+            order = np.argsort(-np.where(live, similarities[row], -np.inf))
+            approx[row] = approx[row, order]
+    approx_ms = (time.perf_counter() - started) * 1000 / len(sample)
+
+    hits = total = 0
+    for found, expected in zip(approx, truth):
+        found = [i for i in found if i >= 0 and i not in dead][:k]
+        expected = expected[expected >= 0]
+        hits += len(set(found) & set(expected))
+        total += len(expected)
+    return {
+        "index": index_spec,
+        "rerank": FAISS_RERANK,
+        "k": k,
+        "queries": len(sample),
+        "recall": hits / total,
+        "approx_ms_per_query": approx_ms,
+        "exact_ms_per_query": exact_ms,
+    }
+
+
+# Сравнение режимов сжатия на векторах текущего каталога
+COMPRESSION_MODES = ["Flat", "SQfp16", "SQ8", "PQ64"]
+
+
+def recall_at(found: np.ndarray, truth: np.ndarray) -> float:
+    return float(np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)]))
+
+
+@owner_operation
+def compression_report(k: int, queries: int, modes: list[str], rerank: int) -> dict:
+    """
+    Для каждого типа индекса из modes строит временный индекс по векторам
+    каталога и меряет размер, recall@k относительно точного перебора и
+    recall@k после пересчёта k * rerank кандидатов по float32-векторам.
+    Рабочий индекс не трогает.
+    """
+    _, vectors = live_vectors()
+    if not len(vectors):
+        raise HTTPException(status_code=400, detail="Index is empty")
+    rng = np.random.default_rng(0)
+    sample = vectors[rng.permutation(len(vectors))[:queries]]
+    train = vectors[rng.permutation(len(vectors))[:FAISS_TRAIN_SIZE]]
+    exact = faiss.IndexFlatIP(512)
+    exact.add(vectors)
+    _, truth = exact.search(sample, k)
+
+    report = {
+        "vectors": len(vectors),
+        "k": k,
+        "queries": len(sample),
+        "rerank": rerank,
+        "float32_bytes": vectors.nbytes,
+        "modes": {},
+    }
+    for spec in modes:
+        try:
+            candidate = make_index(spec, 512)
+            candidate.train(train)
+            candidate.add_with_ids(vectors, np.arange(len(vectors)))
+        except RuntimeError as e:  # например, PQ не на чем обучить
+            report["modes"][spec] = {"error": str(e).strip().splitlines()[-1]}
+            continue
+        size = faiss.serialize_index(candidate).nbytes
+        started = time.perf_counter()
+        _, found = candidate.search(sample, k * max(rerank, 1))
+        search_ms = (time.perf_counter() - started) * 1000 / len(sample)
+        try:
+            code_size = candidate.sa_code_size()  # без учёта кодбуков и графа
+        except RuntimeError:
+            code_size = None
+        result = {
+            "bytes": size,
+            "bytes_per_vector": size / len(vectors),
+            "code_bytes_per_vector": code_size,
+            "recall": recall_at(found[:, :k], truth),
+            "ms_per_query": search_ms,
+        }
+        if rerank:
+            reranked = []
+            for query, candidates in zip(sample, found):
+                candidates = candidates[candidates >= 0]
+                scores = vectors[candidates] @ query
+                reranked.append(candidates[np.argsort(-scores)[:k]])
+            result["recall_reranked"] = recall_at(reranked, truth)
+        report["modes"][spec] = result
+    return report
 
 
 # Стартовая индексация
 def build_index_from_folder():
-    global index, product_id_map
-    index.reset()
-    product_id_map.clear()
-    products.clear()
+    global index, index_spec, index_mmapped, images
+    with index_lock:
+        index_spec = FAISS_INDEX
+        index = new_index(index_spec)
+        index_mmapped = None
+        untrained.clear()
+        images = ImageTable(DATA_DIR)
+        tombstones.clear()
+    index_changed()
 
-    for product_id in tqdm(os.listdir(DATA_DIR)):
+    items = []
+    for product_id in os.listdir(DATA_DIR):
         product_dir = os.path.join(DATA_DIR, product_id)
         if not os.path.isdir(product_dir):
             continue
-        products[product_id] = []
+        with index_lock:
+            images.add_product(product_id)
         for image_file in os.listdir(product_dir):
-            image_path = os.path.join(product_dir, image_file)
+            items.append((product_id, os.path.join(product_dir, image_file)))
+
+    index_images(items, add_to_index)
+    train_index()
+
+    with index_lock:
+        paths = images.paths()
+    embedding_store.retain_files(paths)
+    embedding_store.flush()
+
+
+def sync_index_with_folder():
+    """
+    Доводит загруженный из снапшота индекс до состояния папки: убирает
+    пропавшие и изменённые с прошлого раза фото, индексирует новые.
+    """
+    on_disk = {}
+    for product_id in os.listdir(DATA_DIR):
+        product_dir = os.path.join(DATA_DIR, product_id)
+        if not os.path.isdir(product_dir):
+            continue
+        with index_lock:
+            images.add_product(product_id)
+        for image_file in os.listdir(product_dir):
+            on_disk[os.path.join(product_dir, image_file)] = product_id
+
+    with index_lock:
+        indexed = {images.path(i): i for i in images.live_ids()}
+        products = images.products()
+    stale = {
+        p: i
+        for p, i in indexed.items()
+        if p not in on_disk or not embedding_store.is_fresh(p)
+    }
+    remove_from_index(np.fromiter(stale.values(), dtype="int64", count=len(stale)))
+    for product_id in products:
+        if not os.path.isdir(os.path.join(DATA_DIR, product_id)):
+            remove_product(product_id)
+
+    # снапшот прошлых версий мог записаться, пока IVF/PQ ждал обучения:
+    # строки в таблице есть, а векторов в индексе нет — берём их из кэша
+    with index_lock:
+        lost = images.live_ids() if index.ntotal == 0 else np.empty(0, "int64")
+    if len(lost):
+        vectors = stored_vectors(lost)
+        with index_lock:
+            ensure_writable()
+            if index.is_trained:
+                index.add_with_ids(vectors, lost)
+            else:
+                untrained.append((lost, vectors))
+        print(f"Векторов не было в снапшоте: {len(lost)}, восстановлены из кэша")
+
+    new = [(pid, p) for p, pid in on_disk.items() if p not in indexed or p in stale]
+    print(f"Синхронизация со снапшотом: удалено {len(stale)}, к индексации {len(new)}")
+    if new:
+        index_images(new, add_to_index)
+    train_index()
+    compact_index()
+
+    embedding_store.retain_files(on_disk)
+    embedding_store.flush()
+
+
+# Наблюдение за папкой каталога: её пишут и другие процессы (общий том)
+WATCH_BATCH = int(os.getenv("WATCH_BATCH", "256"))  # фото на порцию индексации
+
+catalog_lock = threading.Lock()  # сверка с папкой против правок каталога через API
+importing: set[str] = set()  # распакованы импортом, но ещё не проиндексированы
+
+
+def live_paths(product_ids) -> set[str]:
+    """Пути живых фото товаров: один проход по таблице на все товары."""
+    with index_lock:
+        positions = [
+            images.product_pos[p] for p in product_ids if p in images.product_pos
+        ]
+        ids = np.flatnonzero(np.isin(images.product[: images.n], positions))
+        return {images.path(i) for i in ids}
+
+
+def reconcile_products(product_ids: set[str]):
+    """
+    Доводит индекс до папки для перечисленных товаров: пропавшие и изменённые
+    фото убирает, новые и изменённые индексирует порциями по WATCH_BATCH.
+    Между порциями catalog_lock отпускается, чтобы не держать API, поэтому
+    перед каждой порцией отсеиваем то, что успели проиндексировать ручки.
+    """
+    with catalog_lock:
+        stale, changed, dropped = [], [], 0
+        for product_id in sorted(product_ids):
+            product_dir = os.path.join(DATA_DIR, product_id)
+            if not os.path.isdir(product_dir):
+                with index_lock:
+                    known = images.has_product(product_id)
+                    rows = len(images.rows(product_id)) if known else 0
+                if known:
+                    dropped += rows
+                    remove_product(product_id)
+                    shutil.rmtree(
+                        os.path.join(THUMBNAILS_DIR, product_id), ignore_errors=True
+                    )
+                continue
+            with index_lock:
+                images.add_product(product_id)
+                indexed = {images.path(i): i for i in images.rows(product_id)}
+            on_disk = {
+                os.path.join(product_dir, name)
+                for name in os.listdir(product_dir)
+                if not name.startswith(".")
+            }
+            for image_path, i in indexed.items():
+                if image_path in importing:
+                    continue
+                if image_path not in on_disk:
+                    stale.append(i)
+                    remove_thumbnail(image_path)
+                elif not embedding_store.is_fresh(image_path):
+                    stale.append(i)
+                    changed.append((product_id, image_path))
+            changed.extend(
+                (product_id, image_path)
+                for image_path in sorted(on_disk - indexed.keys() - importing)
+            )
+        remove_from_index(np.array(stale, dtype="int64"))
+
+    added = 0
+    for start in range(0, len(changed), WATCH_BATCH):
+        with catalog_lock:
+            batch = changed[start : start + WATCH_BATCH]
+            done = live_paths({product_id for product_id, _ in batch})
+            with index_lock:
+                known = {pid for pid, _ in batch if images.has_product(pid)}
+            batch = [
+                (product_id, image_path)
+                for product_id, image_path in batch
+                if image_path not in done
+                and image_path not in importing
+                and product_id in known
+                and os.path.isfile(image_path)
+            ]
+            if batch:
+                added += index_images(batch, add_to_index)
+    train_index()
+    compact_index()
+    embedding_store.flush()
+    print(
+        f"Сверка с папкой: товаров {len(product_ids)}, "
+        f"удалено {dropped + len(stale)}, проиндексировано {added}"
+    )
+
+
+# Снапшоты индекса на диске
+SNAPSHOT_DIR = Path(os.getenv("INDEX_SNAPSHOT_DIR", "./index_snapshots"))
+SNAPSHOT_DEBOUNCE_S = float(os.getenv("SNAPSHOT_DEBOUNCE_S", "5"))
+SNAPSHOTS_KEPT = 2  # предыдущий может быть ещё открыт через mmap другим воркером
+SNAPSHOT_FORMAT = 4  # увеличить при изменении состава файлов снапшота
+snapshot_lock = threading.Lock()  # снапшоты пишут фоновый поток и остановка
+index_mmapped = None  # открытый файл снапшота, если index — его mmap (только чтение)
+snapshot_dirty = threading.Event()
+
+
+def ensure_writable():
+    """
+    Вызывается под index_lock перед мутацией: mmap-индекс только для чтения,
+    поэтому при первой записи читаем его в память из открытого файла снапшота.
+    """
+    global index, index_mmapped
+    if index_mmapped is not None:
+        index = read_mapped(index_mmapped)
+        index_mmapped = None
+
+
+def write_snapshot():
+    """
+    Снапшот пишется в отдельный каталог и публикуется атомарной заменой
+    файла CURRENT: читатель видит либо старый, либо новый снапшот целиком.
+    Под index_lock индекс и таблица только копируются в память, на диск
+    они пишутся после, чтобы поиск и мутации не ждали записи.
+    """
+    with snapshot_lock:
+        if isinstance(index, ShardedIndex) and index.closed:
+            return  # остановка: шарды уже погашены, снапшот записан в on_shutdown
+        mmapped = save_shards = None
+        with index_lock:
+            if not index.is_trained:
+                # векторы до обучения лежат в untrained, в снапшот они не
+                # попадут; train_index снова выставит snapshot_dirty
+                return
+            if isinstance(index, ShardedIndex):
+                save_shards = index.saver()  # шарды пишут свои части сами
+            elif index_mmapped is not None:
+                # не менялся с загрузки: копируем файл, serialize_index записал
+                # бы IVF-списки ссылкой на него, а старый снапшот удалят
+                mmapped = index_mmapped  # открытый файл переживёт удаление
+            else:
+                data = faiss.serialize_index(index)
+            save_images = images.saver()
+            meta = {
+                "format": SNAPSHOT_FORMAT,
+                "model": ENCODER_ID,
+                "preprocess_version": PREPROCESS_VERSION,
+                "requested_index": FAISS_INDEX,
+                "index_spec": index_spec,
+                "shards": index.count if isinstance(index, ShardedIndex) else 0,
+                "tombstones": sorted(tombstones),
+            }
+        SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = SNAPSHOT_DIR / f".tmp-{uuid.uuid4().hex}"
+        tmp.mkdir()
+        if save_shards is not None:
+            save_shards(tmp)
+        elif mmapped is not None:
+            copy_mapped(mmapped, str(tmp / "index.faiss"))
+        else:
+            data.tofile(tmp / "index.faiss")
+        save_images(tmp)
+        (tmp / "meta.json").write_text(json.dumps(meta))
+
+        name = str(time.time_ns())
+        os.rename(tmp, SNAPSHOT_DIR / name)
+        (SNAPSHOT_DIR / "CURRENT.tmp").write_text(name)
+        os.replace(SNAPSHOT_DIR / "CURRENT.tmp", SNAPSHOT_DIR / "CURRENT")
+    # stat-кэш должен соответствовать снапшоту, иначе sync сочтёт фото изменёнными
+    embedding_store.flush()
+
+    old = sorted(p for p in SNAPSHOT_DIR.iterdir() if p.name.isdigit())
+    for snapshot in old[:-SNAPSHOTS_KEPT]:
+        shutil.rmtree(snapshot, ignore_errors=True)
+
+
+def load_snapshot() -> bool:
+    global index, index_spec, index_mmapped, images
+    current = SNAPSHOT_DIR / "CURRENT"
+    if not current.exists():
+        return False
+    snapshot = SNAPSHOT_DIR / current.read_text().strip()
+    meta = json.loads((snapshot / "meta.json").read_text())
+    if (
+        meta.get("format") != SNAPSHOT_FORMAT
+        or meta["model"] != ENCODER_ID
+        or meta["preprocess_version"] != PREPROCESS_VERSION
+        or meta["requested_index"] != FAISS_INDEX
+        or bool(meta.get("shards")) != bool(INDEX_SHARDS)
+    ):
+        print("Снапшот собран с другими настройками, индекс будет пересобран")
+        return False
+
+    if meta.get("shards"):
+        # число шардов берём из снапшота, к INDEX_SHARDS приводит warm_up
+        index.load(snapshot, meta["index_spec"], meta["shards"])
+        loaded, mmapped = index, None
+    else:
+        loaded, mmapped = open_mapped(
+            str(snapshot / "index.faiss"), meta["index_spec"]
+        )
+    table = ImageTable.load(snapshot, DATA_DIR)
+
+    with index_lock:
+        index, index_spec = loaded, meta["index_spec"]
+        index_mmapped = mmapped
+        untrained.clear()
+        images = table
+        tombstones.clear()
+        tombstones.update(meta["tombstones"])
+        vectors = len(images)
+    print(f"Индекс загружен из снапшота {snapshot}: {vectors} векторов")
+    return True
+
+
+def snapshot_writer():
+    while True:
+        snapshot_dirty.wait()
+        time.sleep(SNAPSHOT_DEBOUNCE_S)  # серия мутаций -> один снапшот
+        snapshot_dirty.clear()
+        try:
+            write_snapshot()
+        except Exception as e:
+            print(f"Ошибка записи снапшота: {e}")
+
+
+# Шардирование: векторы раскладываются по локальным процессам-шардам по хэшу
+# product_id, поиск рассылается всем шардам параллельно. Метаданные (товары,
+# пути, удалённые) остаются у владельца, шард хранит только FAISS-индекс.
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "0"))  # 0 — индекс в этом процессе
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "")  # пусто — SERVING_DIR
+SHARD_THREADS = int(os.getenv("SHARD_THREADS", "0"))  # 0 — ядра поровну на шарды
+SHARD_START_TIMEOUT_S = float(os.getenv("SHARD_START_TIMEOUT_S", "120"))
+
+
+class IndexShard:
+    """Процесс шарда и клиент к нему (по соединению на поток вызывающего)."""
+
+    def __init__(self, number: int, threads: int):
+        self.number = number
+        self.address = os.path.join(
+            SHARD_SOCKET_DIR or SERVING_DIR, f"{os.getpid()}-{number}.sock"
+        )
+        authkey = serving.authkey()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "common.shard",
+                str(number),
+                self.address,
+                str(threads),
+                str(os.getpid()),
+            ],
+            # пакет common лежит рядом с сервисом, а cwd у шарда может быть другим
+            # ключ — через окружение: в argv его видят все пользователи машины
+            env=dict(
+                os.environ,
+                PYTHONPATH=os.pathsep.join(sys.path),
+                SERVING_AUTHKEY=authkey.decode(),
+            ),
+        )
+        self.client = OwnerClient(self.address, authkey, f"Index shard {number}")
+        deadline = time.monotonic() + SHARD_START_TIMEOUT_S
+        while True:
             try:
-                image = Image.open(image_path).convert("RGB")
-                embedding = embed_image(image)
-                index.add(embedding)
-                reverse_photo_map.append(image_path)
-                product_id_map.append(product_id)
-                products[product_id].append(image_path)
+                self.client.call("shard_ping")
+                return
+            except (OSError, EOFError):
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"Index shard {number} exited on start")
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f"Index shard {number} did not start")
+                time.sleep(0.2)
+
+    def call(self, name: str, *args):
+        try:
+            return self.client.call(name, *args)
+        except (OSError, EOFError):
+            raise HTTPException(
+                status_code=503,
+                detail=f"Index shard {self.number} is unavailable",
+                headers={"Retry-After": "5"},
+            )
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class ShardedIndex:
+    """
+    FAISS-индекс, разложенный по INDEX_SHARDS процессам: товар живёт в шарде
+    jump_hash(product_id), векторы id маршрутизируются по товару из images.
+    Повторяет ту часть интерфейса faiss.Index, которой пользуется сервис,
+    и вызывается под index_lock. Поиск спрашивает top-k у всех шардов
+    параллельно и сливает ответы по близости — это точный top-k по индексу.
+    template — пустой (и обученный, если это IVF/PQ) индекс: из него
+    инициализируются новые и перезапущенные шарды.
+    Раскладку (shards, sizes, count, copying, template) защищает index_lock:
+    её читают поиск и /index/shards. Долгое — запуск процессов и заливка
+    векторов при перебалансировке — идёт без блокировки, а результат
+    записывается в раскладку под ней.
+    """
+
+    def __init__(self, spec: str, count: int):
+        self.template = make_index(spec, 512)
+        self.shards: list[IndexShard] = []  # первые count — в раскладке
+        self.sizes: list[int] = []  # векторов в шарде, включая удалённые
+        self.count = 0
+        self.copying = False  # идёт перебалансировка: товар бывает в двух шардах
+        self.closed = False
+        self.pool = ThreadPoolExecutor(thread_name_prefix="shards")
+        self.grow(count)
+        self.count = count
+
+    @property
+    def ntotal(self) -> int:
+        return sum(self.sizes[: self.count])
+
+    @property
+    def is_trained(self) -> bool:
+        return self.template.is_trained
+
+    def threads(self, count: int) -> int:
+        return SHARD_THREADS or max((os.cpu_count() or 1) // count, 1)
+
+    def spawn(self, number: int, count: int) -> IndexShard:
+        shard = IndexShard(number, self.threads(count))
+        shard.call("shard_init", index_spec, faiss.serialize_index(self.template))
+        return shard
+
+    def grow(self, count: int):
+        """
+        Поднимает шарды до count штук; в раскладку они входят в rebalance.
+        Процессы стартуют без index_lock, берёт его сам grow.
+        """
+        private_dir(SHARD_SOCKET_DIR or SERVING_DIR)
+        numbers = range(len(self.shards), count)
+        spawned = list(self.pool.map(lambda n: self.spawn(n, count), numbers))
+        with index_lock:
+            self.shards += spawned
+            self.sizes += [0] * len(spawned)
+
+    def shrink(self, count: int):
+        for shard in self.shards[count:]:
+            shard.stop()
+        del self.shards[count:], self.sizes[count:]
+
+    def replace(self, shard: IndexShard):
+        self.shards[shard.number].stop()
+        self.shards[shard.number] = shard
+        self.sizes[shard.number] = 0
+
+    def close(self):
+        with index_lock:
+            self.closed = True
+            self.shrink(0)
+
+    def broadcast(self, name: str, *args) -> list:
+        return list(self.pool.map(lambda shard: shard.call(name, *args), self.shards))
+
+    def shard_of(self, ids: np.ndarray, count: int | None = None) -> np.ndarray:
+        """Номера шардов живых id: по товару, без обращения к шардам."""
+        positions, inverse = np.unique(images.product[ids], return_inverse=True)
+        buckets = count or self.count
+        owners = [jump_hash(images.product_ids[p], buckets) for p in positions]
+        return np.array(owners, dtype="int64")[inverse]
+
+    def add_to(self, number: int, vectors: np.ndarray, ids: np.ndarray):
+        if len(ids):
+            self.shards[number].call("shard_add", vectors, ids)
+            self.sizes[number] += len(ids)
+
+    def copy_to(self, number: int, vectors: np.ndarray, ids: np.ndarray):
+        """add_to без index_lock (перебалансировка): под ним — только счётчик."""
+        if len(ids):
+            self.shards[number].call("shard_add", vectors, ids)
+            with index_lock:
+                self.sizes[number] += len(ids)
+
+    def add_with_ids(self, vectors: np.ndarray, ids: np.ndarray):
+        owners = self.shard_of(ids)
+        list(
+            self.pool.map(
+                lambda n: self.add_to(n, vectors[owners == n], ids[owners == n]),
+                np.unique(owners),
+            )
+        )
+
+    def remove_ids(self, ids: np.ndarray) -> int:
+        # у удалённых id товара уже нет, поэтому просим все шарды
+        removed = self.broadcast("shard_remove", ids)
+        for number, count in enumerate(removed):
+            self.sizes[number] -= count
+        return sum(removed)
+
+    def remove_from(self, number: int, ids: np.ndarray):
+        if len(ids):
+            self.sizes[number] -= self.shards[number].call("shard_remove", ids)
+
+    def search(self, queries: np.ndarray, k: int, params=None):
+        nprobe = getattr(params, "nprobe", None)
+        ef_search = getattr(params, "efSearch", None)
+        parts = list(
+            self.pool.map(
+                lambda shard: shard.call("shard_search", queries, k, nprobe, ef_search),
+                self.shards[: self.count],
+            )
+        )
+        return merge_top_k(parts, k, dedupe=self.copying)
+
+    def train(self, vectors: np.ndarray):
+        # обучаем один шаблон, чтобы у всех шардов были общие центроиды и кодбуки
+        self.template.train(vectors)
+        self.reset(index_spec, self.template)
+
+    def reset(self, spec: str, template: faiss.Index | None = None):
+        self.template = template or make_index(spec, 512)
+        self.broadcast("shard_init", spec, faiss.serialize_index(self.template))
+        self.sizes = [0] * len(self.shards)
+
+    def saver(self):
+        """
+        Под index_lock шарды снимают копии своих индексов в память; файлы
+        пишет возвращённый save(directory), уже без блокировки.
+        """
+        template = faiss.serialize_index(self.template)
+        shards = self.shards[: self.count]
+        list(self.pool.map(lambda shard: shard.call("shard_freeze"), shards))
+
+        def save(directory: Path):
+            template.tofile(directory / "template.faiss")
+            list(
+                self.pool.map(
+                    lambda shard: shard.call(
+                        "shard_save", str(directory / f"index-{shard.number}.faiss")
+                    ),
+                    shards,
+                )
+            )
+
+        return save
+
+    def load(self, directory: Path, spec: str, count: int):
+        """
+        Шарды открывают свои части снапшота через mmap. Если шардов поднято
+        больше, лишние остаются пустыми — их заполнит rebalance_shards.
+        """
+        if count > len(self.shards):
+            self.grow(count)
+        loaded = faiss.read_index(str(directory / "template.faiss"))
+        configure_index(loaded)
+        template = faiss.serialize_index(loaded)
+
+        def load_shard(shard: IndexShard) -> int:
+            if shard.number >= count:
+                shard.call("shard_init", spec, template)
+                return 0
+            path = str(directory / f"index-{shard.number}.faiss")
+            return shard.call("shard_load", path, spec)
+
+        sizes = list(self.pool.map(load_shard, self.shards))
+        with index_lock:
+            self.template, self.count, self.sizes = loaded, count, sizes
+
+
+def new_index(spec: str):
+    """Пустой индекс: у шардированного сбрасываются те же процессы-шарды."""
+    if isinstance(index, ShardedIndex):
+        index.reset(spec)
+        return index
+    return make_index(spec, 512)
+
+
+def stored_vectors(ids: np.ndarray) -> np.ndarray:
+    """
+    Векторы id из кэша эмбеддингов; чего там нет — считаем по файлу моделью.
+    Зовётся без index_lock: таблицу читает под ним сама, а модель может
+    считать долго, и поиск всё это время не должен стоять.
+    """
+    with index_lock:
+        rows = images.vector_row[ids]
+        missing = {i: images.path(ids[i]) for i in np.flatnonzero(rows < 0)}
+    vectors = np.empty((len(ids), 512), dtype="float32")
+    known = rows >= 0
+    vectors[known] = embedding_store.vectors(rows[known])
+    for i, image_path in missing.items():
+        vectors[i] = file_embedding(image_path)[0]
+    return vectors
+
+
+def start_shards():
+    global index
+    sharded = ShardedIndex(FAISS_INDEX, INDEX_SHARDS)
+    with index_lock:
+        index = sharded
+    print(f"Индекс разложен по {INDEX_SHARDS} шардам")
+    threading.Thread(target=watch_shards, name="shards", daemon=True).start()
+
+
+def watch_shards():
+    """Упавший шард поднимается заново и заполняется векторами своих товаров."""
+    while not index.closed:
+        time.sleep(OWNER_POLL_S)
+        for shard in index.shards[: index.count]:
+            if shard.alive() or index.closed:
+                continue
+            print(f"Шард {shard.number} упал, перезапускаем")
+            try:
+                restore_shard(shard.number)
             except Exception as e:
-                print(f"Ошибка при обработке {image_path}: {e}")
+                print(f"Не удалось перезапустить шард {shard.number}: {e}")
+
+
+def drop_tombstones():
+    """
+    Под index_lock, когда шард заменён или остановлен: вместе с ним пропали
+    и его удалённые векторы, а чьи они, по tombstones уже не понять. Чтобы
+    ntotal - len(tombstones) снова считал живые, вычищаем удалённые из
+    оставшихся шардов сразу.
+    """
+    if tombstones:
+        index.remove_ids(np.fromiter(tombstones, dtype="int64"))
+        tombstones.clear()
+
+
+def shard_ids(number: int) -> np.ndarray:
+    """Живые id шарда number в текущей раскладке; под index_lock."""
+    ids = images.live_ids()
+    return ids[index.shard_of(ids) == number]
+
+
+def restore_shard(number: int):
+    shard = index.spawn(number, index.count)
+    # catalog_lock: перебалансировка не должна идти, пока шард пуст, иначе
+    # скопированные в него векторы пропадут вместе со старым процессом
+    with catalog_lock:
+        with index_lock:
+            ids = shard_ids(number) if index.is_trained else np.empty(0, "int64")
+        vectors = stored_vectors(ids)
+        with index_lock:
+            index.replace(shard)
+            drop_tombstones()
+            # пока векторы читались, фото могли удалиться или добавиться
+            # (добавленные ушли в упавший процесс и пропали вместе с ним)
+            live = shard_ids(number) if index.is_trained else ids
+            kept = np.isin(ids, live)
+            index.add_to(number, vectors[kept], ids[kept])
+            late = live[~np.isin(live, ids)]
+        if len(late):
+            vectors = stored_vectors(late)
+            with index_lock:
+                kept = np.isin(late, shard_ids(number))
+                index.add_to(number, vectors[kept], late[kept])
+    index_changed()
+    snapshot_dirty.set()  # запись снапшота могла упасть, пока шарда не было
+    print(f"Шард {number} восстановлен: {index.sizes[number]} векторов")
+
+
+def switch_layout(
+    count: int, copied: np.ndarray, copied_owners: np.ndarray, late_vectors: dict
+) -> int | None:
+    """
+    Под index_lock переключает раскладку на count шардов после копирования:
+    доливает добавленное за это время, убирает копии удалённых и старые
+    копии переехавших, возвращает число переехавших векторов. Если векторов
+    добавленного ещё нет в late_vectors, раскладку не трогает: дочитывает
+    их без блокировки (модель может считать долго) и возвращает None —
+    тогда вызвать ещё раз.
+    """
+    with index_lock:
+        ids = images.live_ids()
+        old, new = index.shard_of(ids), index.shard_of(ids, count)
+        moving = old != new
+        moved, sources, targets = ids[moving], old[moving], new[moving]
+        late = ~np.isin(moved, copied)
+        missing = [i for i in moved[late].tolist() if i not in late_vectors]
+        if not missing:
+            for number in np.unique(targets[late]):
+                chosen = moved[late & (targets == number)]
+                vectors = np.stack([late_vectors[i] for i in chosen.tolist()])
+                index.add_to(number, vectors, chosen)
+            for number in np.unique(copied_owners):
+                chosen = copied[copied_owners == number]
+                index.remove_from(number, chosen[~np.isin(chosen, ids)])
+            for number in np.unique(sources):
+                index.remove_from(number, moved[sources == number])
+            index.count = count
+            if count < len(index.shards):
+                index.shrink(count)
+                drop_tombstones()
+            return len(moved)
+    missing = np.array(missing, dtype="int64")
+    late_vectors.update(zip(missing.tolist(), stored_vectors(missing)))
+    return None
+
+
+@owner_operation
+def rebalance_shards(count: int) -> dict:
+    """
+    Меняет число шардов. Переезжают только товары, у которых сменился шард:
+    их векторы из кэша эмбеддингов заливаются в новые шарды, пока поиск идёт
+    по старой раскладке, затем под index_lock раскладка переключается,
+    доливается добавленное за это время, и копии в старых шардах удаляются.
+    """
+    if not isinstance(index, ShardedIndex):
+        raise HTTPException(
+            status_code=400, detail="Index is not sharded, set INDEX_SHARDS"
+        )
+    if count < 1:
+        raise HTTPException(status_code=400, detail="shards must be positive")
+    started = time.perf_counter()
+    with catalog_lock:
+        if not index.is_trained:
+            raise HTTPException(status_code=409, detail="Index is not trained yet")
+        previous = index.count
+        if count > len(index.shards):
+            index.grow(count)
+
+        with index_lock:
+            ids = images.live_ids()
+            owners = index.shard_of(ids, count)
+            moving = owners != index.shard_of(ids)
+            copied, copied_owners = ids[moving], owners[moving]
+            index.copying = True
+        try:
+            for number in np.unique(copied_owners):
+                chosen = copied[copied_owners == number]
+                index.copy_to(number, stored_vectors(chosen), chosen)
+
+            late_vectors = {}  # id -> вектор добавленного за время копирования
+            moved = None
+            while moved is None:
+                moved = switch_layout(count, copied, copied_owners, late_vectors)
+        finally:
+            with index_lock:
+                index.copying = False
+                vectors = list(index.sizes)
+    index_changed()
+    snapshot_dirty.set()
+    print(f"Шардов: {previous} -> {count}, перенесено {moved} векторов")
+    return {
+        "shards": count,
+        "moved": moved,
+        "vectors": vectors,
+        "seconds": time.perf_counter() - started,
+    }
 
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory=DATA_DIR), name="static")
 
 
+# Старт: HTTP поднимается сразу, модель и индекс готовятся в фоне
+readiness = Readiness()
+model_ready = readiness.model
+index_ready = readiness.index  # есть индекс, по которому можно искать
+reconciled = readiness.reconciled  # индекс сверен с папкой, каталог можно менять
+require_search = readiness.require_search
+require_reconciled = readiness.require_reconciled
+
+
+def warm_up():
+    """
+    Снапшот открывается первым и без модели: как только модель загрузится,
+    поиск работает по нему, а сверка с папкой идёт следом.
+    Без снапшота индекс строится с нуля, и поиск ждёт окончания сборки.
+    """
+    if WATCH_MODE != "off":
+        threading.Thread(
+            target=watch_catalog,
+            args=(DATA_DIR, reconciled, reconcile_products),
+            name="catalog-watcher",
+            daemon=True,
+        ).start()
+    try:
+        if INDEX_SHARDS:
+            start_shards()
+        from_snapshot = load_snapshot()
+        if from_snapshot:
+            index_ready.set()
+        load_model()
+        model_ready.set()
+        if from_snapshot:
+            sync_index_with_folder()
+            if INDEX_SHARDS and index.count != INDEX_SHARDS:
+                rebalance_shards(INDEX_SHARDS)
+        else:
+            build_index_from_folder()
+            index_ready.set()
+        reconciled.set()
+    except Exception as e:
+        readiness.error = repr(e)
+        print(f"Ошибка запуска: {e}")
+
+
+@owner_operation
+def startup_state() -> dict:
+    return readiness.state()
+
+
+# Режим обслуживания (SERVING_MODE): см. common.serving
+# сокеты, их блокировка и ключ лежат в папке, доступной только этому пользователю
+SERVING_DIR = os.getenv("SERVING_DIR", f"/tmp/image-search-{os.getuid()}")
+SERVING_SOCKET = os.getenv("SERVING_SOCKET", os.path.join(SERVING_DIR, "owner.sock"))
+serving = Serving(
+    SERVING_DIR,
+    SERVING_SOCKET,
+    owner_operations,
+    readiness,
+    warm_up,
+    "модели и индекса",
+    background=(snapshot_writer,),
+)
+
+
 @app.on_event("startup")
 def on_startup():
-    build_index_from_folder()
+    serving.start()
 
 
-# Ручка: добавить новый товар
-@app.post("/add_product/")
-def add_product():
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    state = startup_state()
+    ready = state["model"] and state["index"]
+    return JSONResponse(state, status_code=200 if ready else 503)
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    if snapshot_dirty.is_set():
+        write_snapshot()
+    if isinstance(index, ShardedIndex):
+        index.close()
+
+
+@owner_operation
+def create_product() -> str:
     product_id = str(uuid.uuid4())
     os.makedirs(os.path.join(DATA_DIR, product_id), exist_ok=True)
-    products[product_id] = []
-    return {"product_id": product_id}
+    with index_lock:
+        images.add_product(product_id)
+    snapshot_dirty.set()
+    return product_id
+
+
+# Ручка: добавить новый товар
+@app.post("/add_product/", dependencies=[Depends(require_reconciled)])
+async def add_product():
+    return {"product_id": await on_owner(create_product)}
+
+
+@owner_operation
+def has_product(product_id: str) -> bool:
+    with index_lock:
+        return images.has_product(product_id)
+
+
+@owner_operation
+def index_image(product_id: str, image_path: str):
+    with catalog_lock:
+        # наблюдатель за папкой мог успеть проиндексировать файл раньше
+        if image_path not in live_paths([product_id]):
+            add_to_index([(product_id, image_path)], file_embedding(image_path))
 
 
 # Ручка: добавить изображение к товару
-@app.post("/add_image/{product_id}")
+@app.post("/add_image/{product_id}", dependencies=[Depends(require_reconciled)])
 async def add_image(product_id: str, file: UploadFile = File(...)):
-    if product_id not in products:
+    if not await on_owner(has_product, product_id):
         raise HTTPException(status_code=404, detail="Product not found")
 
     product_path = os.path.join(DATA_DIR, product_id)
@@ -94,79 +1443,595 @@ async def add_image(product_id: str, file: UploadFile = File(...)):
     image_name = f"{uuid.uuid4().hex}_{file.filename}"
     image_path = os.path.join(product_path, image_name)
 
-    with open(image_path, "wb") as f:
-        f.write(await file.read())
+    contents = await file.read()
+    await run_in_threadpool(Path(image_path).write_bytes, contents)
 
-    image = Image.open(image_path).convert("RGB")
-    embedding = embed_image(image)
-    index.add(embedding)
-    reverse_photo_map.append(image_path)
-    product_id_map.append(product_id)
-    products[product_id].append(image_path)
+    async with inference.slot():
+        await inference.run(save_thumbnail, image_path)
+        await on_owner(index_image, product_id, image_path)
 
     return {"message": "Image added", "path": image_path}
 
 
-# Ручка: удалить изображение у товара
-@app.delete("/delete_image/{product_id}")
-def delete_image(product_id: str, filename: str):
-    if product_id not in products:
-        raise HTTPException(status_code=404, detail="Product not found")
-
+@owner_operation
+def drop_image(product_id: str, filename: str):
     image_path = os.path.join(DATA_DIR, product_id, filename)
-    if not os.path.exists(image_path):
-        raise HTTPException(status_code=404, detail="Image not found")
+    with catalog_lock:
+        if not has_product(product_id):
+            raise HTTPException(status_code=404, detail="Product not found")
+        if not os.path.exists(image_path):
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        os.remove(image_path)
+        remove_thumbnail(image_path)
+        with index_lock:
+            image_id = images.find(product_id, filename)
+        if image_id is not None:
+            remove_from_index(np.array([image_id]))
+
 
-    os.remove(image_path)
-    build_index_from_folder()  # простая реализация
+# Ручка: удалить изображение у товара
+@app.delete("/delete_image/{product_id}", dependencies=[Depends(require_reconciled)])
+async def delete_image(
+    product_id: str, filename: str, background_tasks: BackgroundTasks
+):
+    await on_owner(drop_image, product_id, filename)
+    background_tasks.add_task(on_owner, compact_index)
     return {"message": "Image deleted"}
 
 
+@owner_operation
+def drop_product(product_id: str):
+    with catalog_lock:
+        if not has_product(product_id):
+            raise HTTPException(status_code=404, detail="Product not found")
+        shutil.rmtree(os.path.join(DATA_DIR, product_id), ignore_errors=True)
+        shutil.rmtree(os.path.join(THUMBNAILS_DIR, product_id), ignore_errors=True)
+        remove_product(product_id)
+
+
 # Ручка: удалить товар полностью
-@app.delete("/delete_product/{product_id}")
-def delete_product(product_id: str):
-    if product_id not in products:
-        raise HTTPException(status_code=404, detail="Product not found")
-    shutil.rmtree(os.path.join(DATA_DIR, product_id))
-    build_index_from_folder()
+@app.delete("/delete_product/{product_id}", dependencies=[Depends(require_reconciled)])
+async def delete_product(product_id: str, background_tasks: BackgroundTasks):
+    await on_owner(drop_product, product_id)
+    background_tasks.add_task(on_owner, compact_index)
     return {"message": "Product deleted"}
 
 
-@app.post("/search/")
-async def search(file: UploadFile = File(...), k: int = 5):
-    contents = await file.read()
-    image = Image.open(BytesIO(contents)).convert("RGB")
-    query_embedding = embed_image(image)
+# Ручка: миниатюра фото для UI
+@app.get("/thumb/{photo:path}")
+async def thumb(photo: str):
+    """
+    photo — путь из выдачи поиска ("<product_id>/<имя>"). Миниатюры нет или
+    фото с тех пор изменилось — строим её сейчас и кладём к остальным.
+    """
+    image_path = os.path.normpath(os.path.join(DATA_DIR, photo))
+    inside = image_path.startswith(os.path.normpath(DATA_DIR) + os.sep)
+    if not inside or not os.path.isfile(image_path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    try:
+        target = await inference.run(ensure_thumbnail, image_path)
+    except OSError:
+        raise HTTPException(status_code=415, detail="Invalid image")
+    return FileResponse(
+        target,
+        media_type="image/jpeg",
+        headers={"Cache-Control": f"public, max-age={THUMBNAIL_MAX_AGE_S}"},
+    )
 
-    if index.ntotal == 0:
-        raise HTTPException(status_code=400, detail="Index is empty")
 
-    distances, indices = index.search(query_embedding, k)  # искать больше, чем k
-
-    # сгруппируем по product_id
-    grouped = defaultdict(list)
-
-    for dist, idx in zip(distances[0], indices[0]):
-        product_id = product_id_map[idx]
-        photo_path = reverse_photo_map[
-            idx
-        ]  # тебе нужно создать этот список при index.add()
-        grouped[product_id].append((dist, photo_path))
-
-    # сортируем по минимальной дистанции к каждому товару
-    ranked_products = sorted(grouped.items(), key=lambda x: min(d[0] for d in x[1]))
-
-    # отбираем top-k товаров
-    result = []
-    for product_id, items in ranked_products[:k]:
-        sorted_photos = sorted(items, key=lambda x: x[0])  # по расстоянию
-        result.append(
-            {
-                "product_id": product_id,
-                "photos": [
-                    str(Path(p.replace(f"{DATA_DIR}/", ""))) for _, p in sorted_photos
-                ],  # до 5 самых близких фоток
-            }
+# Массовый импорт каталога из tar/zip
+def index_import_chunk(job: dict, chunk: list[tuple[str, str]]):
+    indexed = set()
+
+    def sink(batch, vectors):
+        add_to_index(batch, vectors)
+        indexed.update(image_path for _, image_path in batch)
+        job["indexed"] += len(batch)
+
+    try:
+        index_images(chunk, sink)
+        # нечитаемые картинки не оставляем в каталоге
+        for _, image_path in chunk:
+            if image_path not in indexed:
+                os.remove(image_path)
+                job["failed"] += 1
+    finally:
+        importing.difference_update(image_path for _, image_path in chunk)
+
+
+def import_product(product_id: str) -> bool:
+    with index_lock:
+        if images.has_product(product_id):
+            return False
+        images.add_product(product_id)
+        return True
+
+
+def replace_imported(product_id: str, filename: str):
+    with index_lock:
+        replaced = images.find(product_id, filename)
+    if replaced is not None:
+        remove_from_index(np.array([replaced]))
+
+
+def finish_import():
+    train_index()
+    compact_index()
+    embedding_store.flush()
+
+
+catalog_import = CatalogImport(
+    DATA_DIR,
+    catalog_lock,
+    importing,
+    import_product,
+    index_import_chunk,
+    finish_import,
+    replace=replace_imported,
+)
+
+
+@app.post("/import/", dependencies=[Depends(require_reconciled)])
+async def import_catalog(file: UploadFile = File(...)):
+    """
+    Загружает tar (в т.ч. .tar.gz) или zip с папками товаров и ставит импорт
+    в фон. Прогресс — GET /import/{job_id}.
+    """
+    fd, archive_path = tempfile.mkstemp(suffix=".import")
+    with os.fdopen(fd, "wb") as out:
+        await run_in_threadpool(shutil.copyfileobj, file.file, out)
+    if not (zipfile.is_zipfile(archive_path) or tarfile.is_tarfile(archive_path)):
+        os.remove(archive_path)
+        raise HTTPException(status_code=400, detail="Expected a tar or zip archive")
+    # архив лежит на общем диске, распаковывает и индексирует его владелец
+    return await on_owner(start_import, archive_path)
+
+
+@owner_operation
+def start_import(archive_path: str) -> dict:
+    return catalog_import.start(archive_path)
+
+
+@owner_operation
+def import_job(job_id: str) -> dict:
+    if job_id not in catalog_import.jobs:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return catalog_import.jobs[job_id]
+
+
+@app.get("/import/{job_id}")
+async def import_status(job_id: str):
+    return await on_owner(import_job, job_id)
+
+
+@owner_operation
+def owner_stats() -> dict:
+    return {"batcher": batcher.stats(), "result_cache": result_cache.stats()}
+
+
+@app.get("/stats/")
+async def stats():
+    # очередь модели и кэш выдач — у владельца, пул и кэш запросов — у воркера
+    return {
+        **await on_owner(owner_stats),
+        "inference": inference.stats(),
+        "query_cache": query_cache.stats(),
+        "serving": {
+            "mode": SERVING_MODE,
+            "pid": os.getpid(),
+            "owner": serving.owner is None,
+        },
+    }
+
+
+def cache_metrics(name: str, cache: LRUCache, labels: dict) -> list[tuple]:
+    stats = cache.stats()
+    labels = {**labels, "cache": name}
+    return [
+        (f"image_search_cache_{key}", kind, help_text, [(suffix, labels, stats[key])])
+        for key, suffix, kind, help_text in (
+            ("hits", "_total", "counter", "Cache lookups that hit"),
+            ("misses", "_total", "counter", "Cache lookups that missed"),
+            ("evictions", "_total", "counter", "Entries evicted by size"),
+            ("hit_ratio", "", "gauge", "Hits per lookup since start"),
+            ("entries", "", "gauge", "Entries in the cache"),
+            ("bytes", "", "gauge", "Bytes held by the cache"),
         )
+    ]
+
+
+def local_metrics(role: str) -> list[tuple]:
+    """Метрики процесса, принявшего HTTP-запрос: этапы, пул декодирования, кэш запросов."""
+    labels = {"role": role, "pid": os.getpid()}
+    return [
+        (
+            "image_search_stage_seconds",
+            "histogram",
+            "Time spent in each stage of the request path",
+            timers.samples(labels),
+        ),
+        (
+            "image_search_inference_pending",
+            "gauge",
+            "Requests holding an inference slot",
+            [("", labels, inference.pending)],
+        ),
+        *cache_metrics("query", query_cache, labels),
+    ]
+
+
+@owner_operation
+def owner_metrics() -> list[tuple]:
+    labels = {"role": "owner", "pid": os.getpid()}
+    with index_lock:
+        vectors, deleted = index.ntotal, len(tombstones)
+        shards = index.sizes[: index.count] if isinstance(index, ShardedIndex) else []
+        products = len(images.product_pos)
+    return [
+        *local_metrics("owner"),
+        (
+            "image_search_index_vectors",
+            "gauge",
+            "Live vectors in the FAISS index",
+            [("", labels, vectors - deleted)],
+        ),
+        (
+            "image_search_index_tombstones",
+            "gauge",
+            "Deleted vectors not yet compacted out of the index",
+            [("", labels, deleted)],
+        ),
+        (
+            "image_search_shard_vectors",
+            "gauge",
+            "Vectors held by each index shard, deleted ones included",
+            [("", {**labels, "shard": n}, size) for n, size in enumerate(shards)],
+        ),
+        (
+            "image_search_products",
+            "gauge",
+            "Products in the catalog",
+            [("", labels, products)],
+        ),
+        (
+            "image_search_batcher_queue_depth",
+            "gauge",
+            "Online requests waiting for the model",
+            [("", labels, batcher.queue.qsize())],
+        ),
+        (
+            "image_search_batches",
+            "counter",
+            "Forward passes of the online batcher by batch size",
+            [
+                ("_total", {**labels, "size": size}, count)
+                for size, count in sorted(batcher.batch_sizes.items())
+            ],
+        ),
+        *cache_metrics("result", result_cache, labels),
+    ]
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # в режиме shared модель и индекс — у владельца, этапы HTTP — у каждого воркера
+    families = await on_owner(owner_metrics)
+    if serving.owner is not None:
+        families += local_metrics("frontend")
+    return render_metrics(families)
+
+
+def require_profiler():
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler is disabled")
+
+
+@owner_operation
+def profile_start(interval_ms: float, max_s: float) -> dict:
+    profiler.start(interval_ms, max_s)
+    return profiler.stats()
+
+
+@owner_operation
+def profile_stop() -> str:
+    return profiler.stop()
+
+
+@owner_operation
+def profile_state() -> dict:
+    return profiler.stats()
+
+
+async def on_profiled(fn, local: bool, *args):
+    """Профилируется владелец (модель и индекс) или, с local, сам воркер."""
+    if local:
+        return await run_in_threadpool(fn, *args)
+    return await on_owner(fn, *args)
+
+
+@app.post("/debug/profile/start", dependencies=[Depends(require_profiler)])
+async def start_profile(
+    interval_ms: float = PROFILER_INTERVAL_MS,
+    max_s: float = PROFILER_MAX_S,
+    local: bool = False,
+):
+    return await on_profiled(profile_start, local, interval_ms, max_s)
+
+
+@app.post(
+    "/debug/profile/stop",
+    dependencies=[Depends(require_profiler)],
+    response_class=PlainTextResponse,
+)
+async def stop_profile(local: bool = False):
+    """Collapsed stacks последнего сеанса, в т.ч. остановившегося по max_s."""
+    return await on_profiled(profile_stop, local)
+
+
+@app.get("/debug/profile", dependencies=[Depends(require_profiler)])
+async def profile_status(local: bool = False):
+    return await on_profiled(profile_state, local)
+
+
+def search_params(nprobe: int | None, ef_search: int | None):
+    # у шардированного индекса тип смотрим по пустому шаблону
+    layout = index.template if isinstance(index, ShardedIndex) else index
+    if nprobe is not None:
+        if faiss.try_extract_index_ivf(layout) is None:
+            raise HTTPException(400, f"nprobe is not supported by {index_spec}")
+        return faiss.SearchParametersIVF(nprobe=nprobe)
+    if ef_search is not None:
+        inner = faiss.downcast_index(getattr(layout, "index", layout))
+        if not isinstance(inner, faiss.IndexHNSW):
+            raise HTTPException(400, f"ef_search is not supported by {index_spec}")
+        return faiss.SearchParametersHNSW(efSearch=ef_search)
+    return None
+
+
+@owner_operation
+def check_search_params(nprobe: int | None, ef_search: int | None):
+    search_params(nprobe, ef_search)
+
+
+# Поиск: векторы с дозапросом, пока не наберётся k товаров
+def search_index(queries: np.ndarray, k: int, params=None) -> list[tuple]:
+    """
+    Ищет сразу по всем строкам queries, пока у каждого запроса не наберётся
+    k разных товаров: у товара бывает несколько почти одинаковых фото,
+    поэтому запросы, которым не хватило, повторяются с удвоенным fetch.
+    Возвращает по запросу (близости, id векторов, номера товаров) живых векторов.
+    """
+    with index_lock:
+        if index.ntotal == len(tombstones):
+            raise HTTPException(status_code=400, detail="Index is empty")
+        # с запасом на ещё не вычищенные удалённые векторы
+        fetch = k * SEARCH_OVERFETCH * max(FAISS_RERANK, 1) + len(tombstones)
+        fetch = min(fetch, index.ntotal)
+        results = [None] * len(queries)
+        pending = np.arange(len(queries))
+        while len(pending):
+            similarities, ids = index.search(queries[pending], fetch, params=params)
+            retry = []
+            for row, row_similarities, row_ids in zip(pending, similarities, ids):
+                live = images.is_live(row_ids)
+                row_ids = row_ids[live]
+                positions = images.product[row_ids]
+                results[row] = (row_similarities[live], row_ids, positions)
+                if fetch < index.ntotal and len(np.unique(positions)) < k:
+                    retry.append(row)
+            pending = np.array(retry, dtype="int64")
+            fetch = min(fetch * 2, index.ntotal)
+    if FAISS_RERANK:
+        results = [
+            (rescore(query, ids, similarities), ids, positions)
+            for query, (similarities, ids, positions) in zip(queries, results)
+        ]
+    return results
+
+
+def rescore(query: np.ndarray, ids: np.ndarray, similarities: np.ndarray):
+    """Точные близости по float32-векторам кэша; без вектора остаётся приближённая."""
+    with index_lock:
+        rows = images.vector_row[ids]
+    known = rows >= 0
+    exact = similarities.copy()
+    exact[known] = embedding_store.vectors(rows[known]) @ query
+    return exact
+
+
+@app.get("/index/recall", dependencies=[Depends(require_search)])
+async def index_recall(
+    k: int = 10,
+    queries: int = 100,
+    nprobe: int | None = None,
+    ef_search: int | None = None,
+):
+    return await on_owner(recall_report, k, queries, nprobe, ef_search)
+
+
+@app.get("/index/compression", dependencies=[Depends(require_search)])
+async def index_compression(
+    k: int = 10,
+    queries: int = 100,
+    modes: list[str] = Query(COMPRESSION_MODES),
+    rerank: int = max(FAISS_RERANK, 4),
+):
+    return await on_owner(compression_report, k, queries, modes, rerank)
+
+
+@owner_operation
+def shard_state() -> dict:
+    if not isinstance(index, ShardedIndex):
+        return {"shards": 0}
+    with index_lock:
+        return {
+            "shards": index.count,
+            "vectors": index.sizes[: index.count],
+            "pids": [shard.process.pid for shard in index.shards[: index.count]],
+        }
+
+
+@app.get("/index/shards")
+async def index_shards():
+    return await on_owner(shard_state)
+
+
+@app.post("/index/rebalance", dependencies=[Depends(require_reconciled)])
+async def index_rebalance(shards: int):
+    """
+    Меняет число шардов (INDEX_SHARDS) на лету: переезжают только товары,
+    чей шард сменился, поиск всё это время работает.
+    """
+    return await on_owner(rebalance_shards, shards)
+
+
+def product_matches(
+    similarities: np.ndarray,
+    ids: np.ndarray,
+    positions: np.ndarray,
+    k: int,
+    aggregation: Aggregation,
+    top_m: int,
+) -> list[dict]:
+    # имена товаров и пути читаются из таблицы, пока её не меняют
+    with index_lock:
+        return match_products(
+            similarities,
+            positions,
+            k,
+            aggregation,
+            top_m,
+            lambda position: images.product_ids[position],
+            lambda hit: images.rel_path(ids[hit]),
+        )
+
+
+@owner_operation
+def find_matches(
+    queries: np.ndarray,
+    k: int,
+    nprobe: int | None,
+    ef_search: int | None,
+    aggregation: Aggregation,
+    top_m: int,
+) -> list[list[dict]]:
+    """
+    Выдача по товарам на каждую строку queries, готовые берутся из кэша.
+    Версия индекса в ключе: выдача, посчитанная во время мутации, не всплывёт.
+    """
+    keys = [
+        (
+            hashlib.blake2b(query.tobytes(), digest_size=16).digest(),
+            k,
+            nprobe,
+            ef_search,
+            aggregation,
+            top_m,
+            index_version,
+        )
+        for query in queries
+    ]
+    matches = [result_cache.get(key) for key in keys]
+    missing = [row for row, found in enumerate(matches) if found is None]
+    if missing:
+        # FAISS держит index_lock, а его может надолго взять compact_index
+        params = search_params(nprobe, ef_search)
+        with timers.time("index_search"):
+            hits = search_index(queries[missing], k, params)
+        for row, found in zip(missing, hits):
+            with timers.time("grouping"):
+                matches[row] = product_matches(*found, k, aggregation, top_m)
+            result_cache.put(keys[row], matches[row], len(json.dumps(matches[row])))
+    return matches
+
+
+@app.post("/search/", dependencies=[Depends(require_search)])
+async def search(
+    file: UploadFile = File(...),
+    k: int = 5,
+    nprobe: int | None = None,
+    ef_search: int | None = None,
+    aggregation: Aggregation = SEARCH_AGGREGATION,
+    top_m: int = SEARCH_TOP_M,
+):
+    with timers.time("read"):
+        contents = await file.read()
+    if nprobe is not None or ef_search is not None:
+        await on_owner(check_search_params, nprobe, ef_search)
+    query_embedding = await embed_query(contents)
+    [matches] = await on_owner(
+        find_matches, query_embedding, k, nprobe, ef_search, aggregation, top_m
+    )
+    return {"matches": matches}
+
+
+SEARCH_BATCH_SIZE = int(os.getenv("SEARCH_BATCH_SIZE", "64"))
+
+
+@app.post("/search/batch", dependencies=[Depends(require_search)])
+async def search_batch(
+    files: list[UploadFile] = File(...),
+    k: int = 5,
+    nprobe: int | None = None,
+    ef_search: int | None = None,
+    aggregation: Aggregation = SEARCH_AGGREGATION,
+    top_m: int = SEARCH_TOP_M,
+):
+    """
+    Поиск по пачке картинок. Файлы режутся на чанки по SEARCH_BATCH_SIZE:
+    чанк — один forward модели и один многострочный index.search.
+    Ответ — NDJSON, строка на файл в порядке загрузки, отдаётся по мере
+    готовности чанков; эмбеддинги следующего чанка считаются, пока ищем
+    по текущему.
+    """
+    if nprobe is not None or ef_search is not None:
+        await on_owner(check_search_params, nprobe, ef_search)
+    names = [file.filename for file in files]
+    with timers.time("read"):
+        contents = [await file.read() for file in files]
+    chunks = [
+        range(start, min(start + SEARCH_BATCH_SIZE, len(files)))
+        for start in range(0, len(files), SEARCH_BATCH_SIZE)
+    ]
+    # слот занимаем до ответа, чтобы 503 пришёл статусом, а не посреди потока
+    stack = AsyncExitStack()
+    await stack.enter_async_context(inference.slot())
+
+    def embed_chunk(chunk: range) -> asyncio.Future:
+        return asyncio.ensure_future(embed_queries([contents[i] for i in chunk]))
+
+    async def stream():
+        pending = embed_chunk(chunks[0])
+        try:
+            for n, chunk in enumerate(chunks):
+                ok, vectors = await pending
+                if n + 1 < len(chunks):
+                    pending = embed_chunk(chunks[n + 1])
+                errors = dict.fromkeys(range(len(chunk)), "Invalid image")
+                found = []
+                if ok:
+                    try:
+                        found = await on_owner(
+                            find_matches,
+                            vectors,
+                            k,
+                            nprobe,
+                            ef_search,
+                            aggregation,
+                            top_m,
+                        )
+                    except HTTPException as e:
+                        errors.update(dict.fromkeys(ok, e.detail))
+                found = dict(zip(ok, found))
+                for row, i in enumerate(chunk):
+                    line = {"index": i, "filename": names[i]}
+                    if row in found:
+                        line["matches"] = found[row]
+                    else:
+                        line["error"] = errors[row]
+                    yield json.dumps(line) + "\n"
+        finally:
+            pending.cancel()
 
-    return {"matches": result}
+    return SlotStreamingResponse(stream(), stack, media_type="application/x-ndjson")
@@ -0,0 +1,51 @@
+from common.caching import LRUCache
+
+MB = 2**20
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(3 / MB, ttl_s=60)  # бюджет — 3 байта
+    for key in "abc":
+        cache.put(key, key.upper(), 1)
+    assert cache.get("a") == "A"  # a теперь свежее b
+    cache.put("d", "D", 1)
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["A", "C", "D"]
+    assert cache.evictions == 1
+
+
+def test_byte_budget():
+    cache = LRUCache(10 / MB, ttl_s=60)
+    cache.put("big", "x", 11)  # больше всего бюджета: не кладём и не вытесняем
+    assert cache.get("big") is None and cache.bytes == 0
+    cache.put("a", "a", 4)
+    cache.put("b", "b", 4)
+    cache.put("c", "c", 4)  # 12 > 10: уходит самая старая запись
+    assert cache.get("a") is None
+    assert cache.bytes == 8
+    cache.put("b", "B", 6)  # перезапись меняет размер, а не добавляет
+    assert cache.bytes == 10 and cache.get("b") == "B"
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["max_bytes"]) == (2, 10, 10)
+
+
+def test_expired_entry_is_a_miss():
+    cache = LRUCache(1, ttl_s=-1)  # всё истекает сразу
+    cache.put("a", "A", 1)
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0 and cache.bytes == 0
+
+
+def test_hit_and_miss_counters():
+    cache = LRUCache(1, ttl_s=60)
+    assert cache.stats()["hit_ratio"] == 0.0
+    cache.put("a", "A", 1)
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    cache.clear()
+    cache.get("a")
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (2, 2)
+    assert stats["hit_ratio"] == 0.5
+    assert stats["entries"] == 0 and stats["bytes"] == 0
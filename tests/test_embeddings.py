@@ -0,0 +1,100 @@
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+
+from common.embeddings import EmbeddingStore
+
+
+def make_store(tmp_path) -> EmbeddingStore:
+    return EmbeddingStore(str(tmp_path / "embeddings"), "org/model", 4, 1)
+
+
+def test_vectors_and_stat_cache_survive_reopen(tmp_path):
+    store = make_store(tmp_path)
+    photo = tmp_path / "a.jpg"
+    photo.write_bytes(b"image")
+    digest = store.digest(str(photo))
+    store.put(digest, np.arange(4, dtype="float32")[None])
+    store.flush()
+
+    reopened = make_store(tmp_path)
+    assert reopened.is_fresh(str(photo))
+    assert reopened.get(digest).tolist() == [[0.0, 1.0, 2.0, 3.0]]
+    assert reopened.rows_for([str(photo), str(tmp_path / "missing.jpg")]).tolist() == [
+        0,
+        -1,
+    ]
+
+
+def test_changed_file_is_not_fresh(tmp_path):
+    store = make_store(tmp_path)
+    photo = tmp_path / "a.jpg"
+    photo.write_bytes(b"image")
+    store.digest(str(photo))
+    photo.write_bytes(b"another image")
+    assert not store.is_fresh(str(photo))
+
+
+def test_flush_while_files_are_hashed(tmp_path):
+    store = make_store(tmp_path)
+    paths = []
+    for i in range(2000):
+        path = tmp_path / f"{i}.jpg"
+        path.write_bytes(os.urandom(16))
+        paths.append(str(path))
+    errors = []
+    done = threading.Event()
+
+    def hash_files(chunk):
+        try:
+            for path in chunk:
+                store.digest(path)
+        except Exception as e:
+            errors.append(e)
+
+    def flush():
+        try:
+            while not done.is_set():
+                store.flush()
+                store.retain_files(paths)
+        except Exception as e:
+            errors.append(e)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # чаще переключаем потоки, чтобы гонка всплыла
+    try:
+        flusher = threading.Thread(target=flush)
+        flusher.start()
+        hashers = [
+            threading.Thread(target=hash_files, args=(paths[i::4],)) for i in range(4)
+        ]
+        for thread in hashers:
+            thread.start()
+        for thread in hashers:
+            thread.join()
+        done.set()
+        flusher.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert errors == []
+    store.flush()
+    assert len(json.loads(store.files_path.read_text())) == len(paths)
+
+
+def test_torn_digest_line_is_dropped(tmp_path):
+    store = make_store(tmp_path)
+    store.put("a" * 64, np.full((1, 4), 1, dtype="float32"))
+    with open(store.digests_path, "a") as f:
+        f.write("b" * 10)  # запись digest'а оборвалась на середине
+
+    reopened = make_store(tmp_path)
+    reopened.put("c" * 64, np.full((1, 4), 3, dtype="float32"))
+
+    restarted = make_store(tmp_path)
+    assert restarted.get("a" * 64).tolist() == [[1.0] * 4]
+    assert restarted.get("c" * 64).tolist() == [[3.0] * 4]
+    assert restarted.digests_path.read_text() == "a" * 64 + "\n" + "c" * 64 + "\n"
@@ -0,0 +1,59 @@
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from common.faiss_index import make_index, open_mapped, read_mapped, remove_vectors
+
+DIM = 16
+
+
+def unit_vectors(n: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).normal(size=(n, DIM)).astype("float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+@pytest.mark.parametrize("spec", ["Flat", "IVF4,Flat", "HNSW16"])
+def test_ids_survive_removal(spec):
+    vectors = unit_vectors(200)
+    ids = np.arange(1000, 1200, dtype="int64")
+    index = make_index(spec, DIM)
+    index.train(vectors)
+    index.add_with_ids(vectors, ids)
+    if faiss.try_extract_index_ivf(index) is not None:
+        index.nprobe = 4  # все списки: поиск точный
+
+    removed = ids[::3]
+    index = remove_vectors(index, removed, spec)
+    assert index.ntotal == len(ids) - len(removed)
+
+    kept = ~np.isin(ids, removed)
+    _, found = index.search(vectors[kept], 1)
+    assert found[:, 0].tolist() == ids[kept].tolist()
+    _, found = index.search(vectors[~kept], 1)
+    assert not np.isin(found, removed).any()  # удалённые не всплывают
+
+
+@pytest.mark.parametrize("spec", ["Flat", "HNSW16", "IVF4,Flat", "IVF4,PQ4x4"])
+def test_snapshot_opens_mapped(tmp_path, spec):
+    vectors = unit_vectors(200)
+    ids = np.arange(200, dtype="int64")
+    index = make_index(spec, DIM)
+    index.train(vectors)
+    index.add_with_ids(vectors, ids)
+    path = str(tmp_path / "index.faiss")
+    faiss.write_index(index, path)
+
+    mapped, file = open_mapped(path, spec)
+    with file:
+        assert mapped.ntotal == len(ids)
+        _, expected = index.search(vectors[:5], 3)
+        _, found = mapped.search(vectors[:5], 3)
+        assert found.tolist() == expected.tolist()
+        # в память читается через открытый файл, даже если снапшот удалили
+        os.remove(path)
+        copy = read_mapped(file)
+        copy.add_with_ids(vectors[:1], np.array([500], dtype="int64"))
+        assert copy.ntotal == len(ids) + 1
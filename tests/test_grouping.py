@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from common.grouping import PHOTOS_PER_PRODUCT, group_hits, match_products
+
+# товар 0: 0.9, 0.2; товар 1: 0.8, 0.7, 0.6; товар 2: 0.5
+SIMILARITIES = np.array([0.9, 0.8, 0.2, 0.7, 0.5, 0.6], dtype="float32")
+POSITIONS = np.array([0, 1, 0, 1, 2, 1])
+
+
+@pytest.mark.parametrize(
+    "aggregation, top_m, expected",
+    [
+        ("max", 3, [(0, 0.9), (1, 0.8), (2, 0.5)]),
+        ("sum", 3, [(1, 2.1), (0, 1.1), (2, 0.5)]),
+        ("mean_top_m", 2, [(1, 0.75), (0, 0.55), (2, 0.5)]),
+    ],
+)
+def test_products_ranked_by_aggregation(aggregation, top_m, expected):
+    groups = group_hits(SIMILARITIES, POSITIONS, 3, aggregation, top_m)
+    assert [position for position, _, _ in groups] == [p for p, _ in expected]
+    assert [score for _, score, _ in groups] == pytest.approx([s for _, s in expected])
+
+
+def test_photos_sorted_within_product_and_capped():
+    groups = group_hits(SIMILARITIES, POSITIONS, 3)
+    assert [hits.tolist() for _, _, hits in groups] == [[0, 2], [1, 5, 3], [4]]
+
+    many = np.linspace(1, 0, PHOTOS_PER_PRODUCT + 3, dtype="float32")
+    [(_, _, hits)] = group_hits(many, np.zeros(len(many), dtype="int64"), 1)
+    assert hits.tolist() == list(range(PHOTOS_PER_PRODUCT))
+
+
+def test_top_k_and_empty():
+    assert [p for p, _, _ in group_hits(SIMILARITIES, POSITIONS, 1)] == [0]
+    assert group_hits(np.empty(0, "float32"), np.empty(0, "int64"), 5) == []
+
+
+def test_match_products_builds_response():
+    names = ["a", "b", "c"]
+    matches = match_products(
+        SIMILARITIES,
+        POSITIONS,
+        2,
+        "max",
+        3,
+        lambda position: names[position],
+        lambda hit: f"photo-{hit}.jpg",
+    )
+    assert matches == [
+        {
+            "product_id": "a",
+            "score": pytest.approx(0.9),
+            "photos": ["photo-0.jpg", "photo-2.jpg"],
+        },
+        {
+            "product_id": "b",
+            "score": pytest.approx(0.8),
+            "photos": ["photo-1.jpg", "photo-5.jpg", "photo-3.jpg"],
+        },
+    ]
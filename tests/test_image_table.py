@@ -0,0 +1,101 @@
+import numpy as np
+
+from common.image_table import ImageTable
+
+
+def table_with(*products: str, data_dir: str = "/data") -> ImageTable:
+    table = ImageTable(data_dir)
+    for product_id in products:
+        table.add_product(product_id)
+    return table
+
+
+def add(table: ImageTable, product_id: str, *names: str) -> np.ndarray:
+    batch = [(product_id, f"/data/{product_id}/{name}") for name in names]
+    return table.append(batch, np.full(len(batch), -1, dtype="int32"))
+
+
+def test_add_and_find():
+    table = table_with("p1", "p2")
+    table.add_product("p1")  # повторно — тот же товар
+    assert table.products() == ["p1", "p2"]
+    assert table.has_product("p2") and not table.has_product("p3")
+
+    assert add(table, "p1", "a.jpg", "b.jpg").tolist() == [0, 1]
+    assert add(table, "p2", "c.jpg").tolist() == [2]
+    assert len(table) == 3
+    assert table.find("p1", "b.jpg") == 1
+    assert table.find("p2", "a.jpg") is None
+    assert table.find("p3", "a.jpg") is None
+    assert table.rel_path(2) == "p2/c.jpg"
+    assert table.path(0) == "/data/p1/a.jpg"
+
+
+def test_remove_hides_rows():
+    table = table_with("p1", "p2")
+    add(table, "p1", "a.jpg", "b.jpg")
+    add(table, "p2", "c.jpg")
+    table.remove(np.array([0]))
+    assert table.rows("p1").tolist() == [1]
+    assert table.find("p1", "a.jpg") is None
+    assert table.live_ids().tolist() == [1, 2]
+    assert table.is_live(np.array([0, 1, -1])).tolist() == [False, True, False]
+    assert table.paths() == ["/data/p1/b.jpg", "/data/p2/c.jpg"]
+
+
+def test_drop_product():
+    table = table_with("p1", "p2")
+    add(table, "p1", "a.jpg")
+    add(table, "p2", "b.jpg", "c.jpg")
+    assert table.drop_product("p2").tolist() == [1, 2]
+    assert not table.has_product("p2")
+    assert table.rows("p2").size == 0
+    assert table.live_ids().tolist() == [0]
+
+
+def test_rows_across_resort():
+    table = table_with("p1", "p2")
+    for _ in range(2500):  # вперемешку, чтобы порядок по товару что-то значил
+        add(table, "p1", "a.jpg")
+        add(table, "p2", "b.jpg")
+    assert table.rows("p1").tolist() == list(range(0, 5000, 2))
+    assert table.sorted_n == 5000  # больше порога: построен порядок по товару
+
+    table.remove(np.array([0, 2]))
+    late = add(table, "p1", "late.jpg")  # хвост после сортировки
+    assert table.sorted_n == 5000
+    assert table.rows("p1").tolist() == [*range(4, 5000, 2), *late.tolist()]
+    assert table.find("p1", "late.jpg") == late[0]
+    assert table.rows("p2").tolist() == list(range(1, 5000, 2))
+
+
+def test_small_table_scans_without_sorting():
+    table = table_with("p1")
+    add(table, "p1", "a.jpg", "b.jpg")
+    assert table.rows("p1").tolist() == [0, 1]
+    assert table.sorted_n == 0
+
+
+def test_snapshot_round_trip(tmp_path):
+    table = table_with("p1", "p2")
+    add(table, "p1", "a.jpg")
+    table.append([("p2", "/data/p2/b.jpg")], np.array([7], dtype="int32"))
+    table.drop_product("p1")
+    table.saver()(tmp_path)
+
+    loaded = ImageTable.load(tmp_path, "/other")
+    assert len(loaded) == 2
+    assert loaded.products() == ["p2"]
+    assert loaded.live_ids().tolist() == [1]
+    assert loaded.vector_row.tolist() == [-1, 7]
+    assert loaded.path(1) == "/other/p2/b.jpg"
+    # memmap из снапшота только для чтения: запись копирует массивы
+    add(loaded, "p2", "c.jpg")
+    loaded.remove(np.array([1]))
+    assert loaded.rows("p2").tolist() == [2]
+
+
+def test_empty_snapshot(tmp_path):
+    table_with("p1").saver()(tmp_path)
+    loaded = ImageTable.load(tmp_path, "/data")
+    assert len(loaded) == 0 and loaded.has_product("p1")
@@ -0,0 +1,126 @@
+import io
+import tarfile
+import threading
+import zipfile
+
+from common.importer import CatalogImport, archive_entries, import_target
+
+
+def write_zip(path, files: dict[str, bytes]):
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+
+
+def write_tar(path, files: dict[str, bytes]):
+    with tarfile.open(path, "w:gz") as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+
+def test_import_target_layout():
+    assert import_target("p1/a.jpg") == ("p1", "a.jpg")
+    assert import_target("catalog/p1/a.JPG") == ("p1", "a.JPG")
+    assert import_target("a.jpg") is None  # без папки товара
+    assert import_target("p1/notes.txt") is None
+    assert import_target("p1/.hidden.jpg") is None
+    assert import_target("__MACOSX/p1/a.jpg") is None
+
+
+def test_archive_entries_zip_and_tar(tmp_path):
+    files = {"p1/a.jpg": b"a", "p2/b.png": b"bb"}
+    for name, write in [("x.zip", write_zip), ("x.tar.gz", write_tar)]:
+        path = str(tmp_path / name)
+        write(path, files)
+        assert {n: f.read() for n, f in archive_entries(path)} == files
+
+
+class Catalog:
+    """Хуки сервиса: товары в dict, порции индексируются сразу."""
+
+    def __init__(self):
+        self.products = {"p1"}
+        self.replaced = []
+        self.chunks = []
+        self.finished = False
+        self.importing = set()
+
+    def add_product(self, product_id: str) -> bool:
+        new = product_id not in self.products
+        self.products.add(product_id)
+        return new
+
+    def index_chunk(self, job: dict, chunk: list[tuple[str, str]]):
+        self.chunks.append(list(chunk))
+        job["indexed"] += len(chunk)
+        self.importing.difference_update(path for _, path in chunk)
+
+    def finish(self):
+        self.finished = True
+
+
+def test_run_extracts_and_indexes_in_chunks(tmp_path):
+    data_dir = tmp_path / "products"
+    archive = tmp_path / "upload.zip"
+    write_zip(
+        archive,
+        {
+            "p1/a.jpg": b"old",
+            "p1/notes.txt": b"",
+            "p2/b.jpg": b"b",
+            "p2/c.jpg": b"c",
+            "readme.txt": b"",
+        },
+    )
+    catalog = Catalog()
+    importer = CatalogImport(
+        str(data_dir),
+        threading.Lock(),
+        catalog.importing,
+        catalog.add_product,
+        catalog.index_chunk,
+        catalog.finish,
+        replace=lambda product_id, filename: catalog.replaced.append(filename),
+        chunk_size=2,
+    )
+    job = importer.start(str(archive))
+    importer.pool.shutdown(wait=True)
+
+    assert job["status"] == "done", job["error"]
+    assert job["products"] == 1  # p1 уже был в каталоге
+    assert job["extracted"] == 3
+    assert job["skipped"] == 2
+    assert job["indexed"] == 3
+    assert [len(chunk) for chunk in catalog.chunks] == [2, 1]
+    assert catalog.replaced == ["a.jpg", "b.jpg", "c.jpg"]
+    assert catalog.finished and not catalog.importing
+    assert (data_dir / "p2" / "c.jpg").read_bytes() == b"c"
+    assert not archive.exists()
+    assert importer.jobs[job["job_id"]] is job
+
+
+def test_failed_import_releases_paths(tmp_path):
+    archive = tmp_path / "upload.zip"
+    write_zip(archive, {"p1/a.jpg": b"a"})
+    catalog = Catalog()
+
+    def broken(job, chunk):
+        raise RuntimeError("index is gone")
+
+    importer = CatalogImport(
+        str(tmp_path / "products"),
+        threading.Lock(),
+        catalog.importing,
+        catalog.add_product,
+        broken,
+        catalog.finish,
+    )
+    job = importer.start(str(archive))
+    importer.pool.shutdown(wait=True)
+
+    assert job["status"] == "failed"
+    assert job["error"] == "index is gone"
+    assert not catalog.importing and not catalog.finished
+    assert job["finished_at"] is not None
@@ -0,0 +1,135 @@
+import asyncio
+import threading
+from contextlib import AsyncExitStack
+
+import numpy as np
+import pytest
+import torch
+
+from starlette.requests import ClientDisconnect
+
+from common.inference import BatchScheduler, InferenceExecutor, SlotStreamingResponse
+from common.metrics import STAGE_BUCKETS_S, StageTimers
+
+
+class GatedEmbed:
+    """embed_fn, который держит forward, пока тест не откроет gate."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.started = threading.Event()
+        self.batches = []
+
+    def __call__(self, pixel_values: torch.Tensor) -> np.ndarray:
+        self.started.set()
+        self.gate.wait(5)
+        self.batches.append(len(pixel_values))
+        return pixel_values.flatten(1).numpy()
+
+
+def tensor(value: float) -> torch.Tensor:
+    return torch.full((2,), value)
+
+
+def test_cancelled_request_does_not_stop_batcher():
+    embed = GatedEmbed()
+    batcher = BatchScheduler(
+        embed, max_batch=4, max_wait_ms=1, timers=StageTimers(STAGE_BUCKETS_S)
+    )
+
+    async def scenario():
+        first = asyncio.ensure_future(batcher.embed(tensor(1)))
+        await asyncio.get_running_loop().run_in_executor(None, embed.started.wait, 5)
+        # пока forward занят, второй запрос отменяется по таймауту
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(batcher.embed(tensor(2)), timeout=0.05)
+        embed.gate.set()
+        assert (await first).tolist() == [[1.0, 1.0]]
+        return await asyncio.wait_for(batcher.embed(tensor(3)), timeout=5)
+
+    assert asyncio.run(scenario()).tolist() == [[3.0, 3.0]]
+    assert embed.batches == [1, 1]  # отменённый запрос в forward не попал
+
+
+def test_failed_forward_is_reported_and_batcher_survives():
+    calls = []
+
+    def embed(pixel_values: torch.Tensor) -> np.ndarray:
+        calls.append(len(pixel_values))
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return pixel_values.flatten(1).numpy()
+
+    batcher = BatchScheduler(
+        embed, max_batch=4, max_wait_ms=1, timers=StageTimers(STAGE_BUCKETS_S)
+    )
+    with pytest.raises(RuntimeError, match="boom"):
+        batcher.submit(tensor(1)).result(timeout=5)
+    assert batcher.submit(tensor(2)).result(timeout=5).tolist() == [[2.0, 2.0]]
+
+
+def test_requests_are_batched_together():
+    embed = GatedEmbed()
+    batcher = BatchScheduler(
+        embed, max_batch=8, max_wait_ms=1, timers=StageTimers(STAGE_BUCKETS_S)
+    )
+    first = batcher.submit(tensor(0))
+    embed.started.wait(5)
+    rest = [batcher.submit(tensor(i)) for i in range(1, 4)]
+    embed.gate.set()
+    assert first.result(timeout=5).tolist() == [[0.0, 0.0]]
+    assert [f.result(timeout=5)[0, 0] for f in rest] == [1.0, 2.0, 3.0]
+    assert embed.batches == [1, 3]
+    assert batcher.stats()["batch_sizes"] == {1: 1, 3: 1}
+
+
+def test_stream_releases_slot_when_client_is_gone():
+    executor = InferenceExecutor(workers=1, max_pending=1)
+    started = []
+
+    async def body():
+        started.append(True)
+        yield "line\n"
+
+    async def send(message):
+        raise OSError("client disconnected")
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def scenario():
+        stack = AsyncExitStack()
+        await stack.enter_async_context(executor.slot())
+        assert executor.pending == 1
+        response = SlotStreamingResponse(body(), stack)
+        scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+        with pytest.raises(ClientDisconnect):
+            await response(scope, receive, send)
+
+    asyncio.run(scenario())
+    assert started == []  # генератор не запускался, а слот всё равно свободен
+    assert executor.pending == 0
+
+
+def test_stream_releases_slot_after_body():
+    executor = InferenceExecutor(workers=1, max_pending=1)
+    sent = []
+
+    async def body():
+        yield "line\n"
+
+    async def send(message):
+        sent.append(message)
+
+    async def receive():
+        await asyncio.sleep(5)
+
+    async def scenario():
+        stack = AsyncExitStack()
+        await stack.enter_async_context(executor.slot())
+        response = SlotStreamingResponse(body(), stack)
+        await response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send)
+
+    asyncio.run(scenario())
+    assert [m.get("body") for m in sent[1:]] == [b"line\n", b""]
+    assert executor.pending == 0
@@ -0,0 +1,53 @@
+from common.metrics import StageTimers, render_metrics
+
+
+def sample_lines(text: str, prefix: str) -> list[str]:
+    return [line for line in text.splitlines() if line.startswith(prefix)]
+
+
+def test_histogram_buckets_are_cumulative_and_inclusive():
+    timers = StageTimers((0.01, 0.1))
+    timers.observe("forward", 0.01)  # на границе: попадает в le="0.01"
+    timers.observe("forward", 0.05)
+    timers.observe("forward", 3.0)
+    text = render_metrics(
+        [
+            (
+                "image_search_stage_seconds",
+                "histogram",
+                "Stage latency",
+                timers.samples({"role": "owner"}),
+            )
+        ]
+    )
+    assert sample_lines(text, "image_search_stage_seconds") == [
+        'image_search_stage_seconds_bucket{role="owner",stage="forward",le="0.01"} 1.0',
+        'image_search_stage_seconds_bucket{role="owner",stage="forward",le="0.1"} 2.0',
+        'image_search_stage_seconds_bucket{role="owner",stage="forward",le="+Inf"} 3.0',
+        'image_search_stage_seconds_sum{role="owner",stage="forward"} 3.06',
+        'image_search_stage_seconds_count{role="owner",stage="forward"} 3.0',
+    ]
+    assert "# TYPE image_search_stage_seconds histogram" in text
+
+
+def test_counter_families_merge_with_total_suffix():
+    owner = (
+        "image_search_batches",
+        "counter",
+        "Forward passes",
+        [("_total", {"role": "owner", "size": 1}, 4)],
+    )
+    frontend = (
+        "image_search_batches",
+        "counter",
+        "Forward passes",
+        [("_total", {"role": "frontend", "size": 1}, 2)],
+    )
+    text = render_metrics([owner, frontend])
+    assert text.count("# TYPE image_search_batches counter") == 1
+    assert text.count("# HELP image_search_batches Forward passes") == 1
+    assert sample_lines(text, "image_search_batches") == [
+        'image_search_batches_total{role="owner",size="1"} 4.0',
+        'image_search_batches_total{role="frontend",size="1"} 2.0',
+    ]
+    assert text.endswith("\n")
@@ -0,0 +1,104 @@
+"""
+Быстрый препроцессинг против штатных процессоров моделей.
+
+Конфиги берутся без скачивания весов: CLIPImageProcessor() по умолчанию
+совпадает с процессором openai/clip-vit-base-patch32 (сервис FAISS), а
+конфиг open_clip для ViT-H-14 лежит в самом пакете (сервис Qdrant).
+"""
+
+import io
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from common.preprocess import JPEG_DRAFT_OVERSAMPLE, FastPreprocess, decode_batches
+
+# на полностью декодированной картинке расхождение — округление float32
+PARITY_TOLERANCE = 1e-5
+SIZES = [(640, 480), (480, 640), (500, 500), (301, 997), (1023, 257), (224, 224)]
+
+
+def photo(width: int, height: int, seed: int = 0) -> Image.Image:
+    # градиент с шумом: resize и JPEG ведут себя с ним как с фото
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) % 256], axis=-1)
+    noise = rng.integers(-12, 12, base.shape)
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype("uint8"))
+
+
+@pytest.fixture(scope="module")
+def clip_processor():
+    transformers = pytest.importorskip("transformers")
+    return transformers.CLIPImageProcessor()
+
+
+@pytest.fixture(scope="module")
+def open_clip_transform():
+    open_clip = pytest.importorskip("open_clip")
+    cfg = open_clip.transform.merge_preprocess_dict(
+        open_clip.transform.PreprocessCfg(
+            size=open_clip.get_model_config("ViT-H-14")["vision_cfg"]["image_size"]
+        ),
+        open_clip.get_pretrained_cfg("ViT-H-14", "laion2b_s32b_b79k"),
+    )
+    reference = open_clip.transform.image_transform_v2(
+        open_clip.transform.PreprocessCfg(**cfg), is_train=False
+    )
+    return FastPreprocess.from_open_clip(cfg), reference
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_matches_clip_processor(clip_processor, size):
+    fast = FastPreprocess.from_clip_processor(clip_processor)
+    image = photo(*size)
+    expected = clip_processor(images=image, return_tensors="pt")["pixel_values"][0]
+    actual = fast(image)
+    assert actual.shape == expected.shape
+    assert float((actual - expected).abs().max()) <= PARITY_TOLERANCE
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_matches_open_clip_transform(open_clip_transform, size):
+    fast, reference = open_clip_transform
+    image = photo(*size)
+    expected = reference(image)
+    actual = fast(image)
+    assert actual.shape == expected.shape
+    assert float((actual - expected).abs().max()) <= PARITY_TOLERANCE
+
+
+def test_draft_keeps_oversampled_resolution(clip_processor):
+    fast = FastPreprocess.from_clip_processor(clip_processor)
+    data = io.BytesIO()
+    photo(4032, 3024).save(data, format="JPEG", quality=90)
+    image = fast.open(io.BytesIO(data.getvalue()))
+    assert image.mode == "RGB"
+    assert min(image.size) >= fast.resize_to * JPEG_DRAFT_OVERSAMPLE
+    assert image.size[0] < 4032  # декодирован уменьшенным
+
+
+def test_small_jpeg_is_decoded_fully(clip_processor):
+    fast = FastPreprocess.from_clip_processor(clip_processor)
+    data = io.BytesIO()
+    photo(300, 200).save(data, format="JPEG", quality=90)
+    image = fast.open(io.BytesIO(data.getvalue()))
+    assert image.size == (300, 200)
+    reference = Image.open(io.BytesIO(data.getvalue())).convert("RGB")
+    assert np.array_equal(np.asarray(image), np.asarray(reference))
+
+
+def test_decode_batches_keep_order_and_skip_broken_files():
+    def load(path: str):
+        return None if path.startswith("bad") else torch.full((2,), float(path))
+
+    paths = ["0", "bad", "2", "3", "bad", "bad", "6"]
+    batches = list(decode_batches(paths, load, batch_size=2, workers=3))
+    assert [positions for positions, _ in batches] == [[0], [2, 3], [6]]
+    assert [tensor[:, 0].tolist() for _, tensor in batches] == [
+        [0.0],
+        [2.0, 3.0],
+        [6.0],
+    ]
@@ -0,0 +1,81 @@
+import asyncio
+from io import BytesIO
+
+import numpy as np
+import torch
+from PIL import Image
+
+from common.caching import LRUCache
+from common.inference import InferenceExecutor
+from common.metrics import STAGE_BUCKETS_S, StageTimers
+from common.preprocess import FastPreprocess
+from common.queries import QueryEmbedder, dhash
+
+
+def jpeg(image: Image.Image, quality: int = 95) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def gradient() -> Image.Image:
+    row = np.linspace(0, 255, 64, dtype="uint8")
+    return Image.fromarray(np.stack([np.tile(row, (64, 1))] * 3, axis=-1))
+
+
+def embedder(phash: bool) -> tuple[QueryEmbedder, list]:
+    calls = []
+
+    async def embed(tensor: torch.Tensor) -> np.ndarray:
+        calls.append(tensor.shape)
+        return np.ones(4, dtype="float32")
+
+    preprocess = FastPreprocess(32, 32, Image.BICUBIC, [0.5] * 3, [0.5] * 3)
+    queries = QueryEmbedder(
+        preprocess,
+        StageTimers(STAGE_BUCKETS_S),
+        InferenceExecutor(1, 4),
+        LRUCache(1, 60),
+        embed,
+        phash,
+    )
+    return queries, calls
+
+
+def test_dhash_survives_recompression():
+    image = gradient()
+    recompressed = Image.open(BytesIO(jpeg(image, quality=40)))
+    assert len(dhash(image)) == 16
+    assert dhash(image) == dhash(recompressed)
+    assert dhash(image) != dhash(image.transpose(Image.FLIP_LEFT_RIGHT))
+
+
+def test_same_bytes_embedded_once():
+    queries, calls = embedder(phash=False)
+    contents = jpeg(gradient())
+
+    async def scenario():
+        first = await queries.embed(contents)
+        second = await queries.embed(contents)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert second is first
+    assert calls == [torch.Size([3, 32, 32])]
+
+
+def test_phash_matches_recompressed_copy():
+    queries, calls = embedder(phash=True)
+
+    async def scenario():
+        await queries.embed(jpeg(gradient(), quality=95))
+        await queries.embed(jpeg(gradient(), quality=40))
+
+    asyncio.run(scenario())
+    assert len(calls) == 1
+
+
+def test_try_decode_skips_broken_bytes():
+    queries, _ = embedder(phash=False)
+    assert queries.try_decode(b"not an image") is None
+    assert queries.try_decode(jpeg(gradient())).shape == (3, 32, 32)
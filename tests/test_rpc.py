@@ -0,0 +1,45 @@
+import os
+import stat
+import threading
+from multiprocessing.connection import AuthenticationError, Client
+
+import pytest
+
+from common.rpc import OwnerClient, deployment_authkey, listen, private_dir, serve_owner
+
+
+def test_private_dir_is_closed_to_others(tmp_path):
+    path = tmp_path / "serving"
+    path.mkdir(mode=0o755)
+    private_dir(str(path))
+    assert stat.S_IMODE(path.stat().st_mode) == 0o700
+
+
+def test_workers_share_one_random_key(tmp_path):
+    keys = []
+    threads = [
+        threading.Thread(target=lambda: keys.append(deployment_authkey(str(tmp_path))))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(keys)) == 1 and len(keys[0]) == 64
+    assert stat.S_IMODE(os.stat(tmp_path / "authkey").st_mode) == 0o600
+    assert os.listdir(tmp_path) == ["authkey"]  # черновики не остаются
+    other = tmp_path / "other"
+    other.mkdir()
+    assert deployment_authkey(str(other)) != keys[0]  # у развёртывания свой ключ
+
+
+def test_socket_is_private_and_checks_the_key(tmp_path):
+    address = str(tmp_path / "owner.sock")
+    listener = listen(address, b"secret")
+    threading.Thread(
+        target=serve_owner, args=(listener, {"ping": lambda: "pong"}), daemon=True
+    ).start()
+    assert stat.S_IMODE(os.stat(address).st_mode) == 0o600
+    assert OwnerClient(address, b"secret").call("ping") == "pong"
+    with pytest.raises(AuthenticationError):
+        Client(address, authkey=b"guess")
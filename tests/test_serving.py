@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+from fastapi import HTTPException
+
+from common.serving import Readiness, Serving
+
+
+class LostOwner:
+    def call(self, name: str, *args):
+        raise EOFError
+
+
+def serving(tmp_path, readiness: Readiness, warm_up=lambda: None) -> Serving:
+    return Serving(
+        str(tmp_path / "serving"),
+        str(tmp_path / "serving" / "owner.sock"),
+        {},
+        readiness,
+        warm_up,
+        "модели",
+    )
+
+
+def test_gates_follow_state():
+    readiness = Readiness()
+    with pytest.raises(HTTPException) as e:
+        readiness.require_search()
+    assert e.value.status_code == 503
+    readiness.mirror(
+        {"model": True, "index": True, "reconciled": False, "error": None}
+    )
+    readiness.require_search()
+    with pytest.raises(HTTPException):
+        readiness.require_reconciled()
+    assert readiness.state() == {
+        "model": True,
+        "index": True,
+        "reconciled": False,
+        "error": None,
+    }
+
+
+def test_one_owner_per_socket(tmp_path):
+    first = serving(tmp_path, Readiness())
+    second = serving(tmp_path, Readiness())
+    assert first.claim()
+    assert not second.claim()
+    first.lock.close()  # владелец упал: ядро отпускает flock
+    assert second.claim()
+
+
+def test_takeover_closes_mirrored_gates(tmp_path):
+    readiness = Readiness()
+    readiness.mirror(
+        {"model": True, "index": True, "reconciled": True, "error": "old"}
+    )
+    warmed = threading.Event()
+    gates = []
+
+    def warm_up():
+        gates.append(readiness.state())
+        warmed.set()
+
+    follower = serving(tmp_path, readiness, warm_up)
+    follower.owner = LostOwner()
+    follower.follow()
+
+    assert warmed.wait(5)
+    assert follower.owner is None and follower.lock is not None
+    assert gates == [
+        {"model": False, "index": False, "reconciled": False, "error": None}
+    ]
@@ -0,0 +1,44 @@
+import numpy as np
+
+from common.sharding import jump_hash, merge_top_k
+
+PRODUCTS = [f"product-{i}" for i in range(2000)]
+
+
+def test_jump_hash_is_stable():
+    assert [jump_hash(p, 5) for p in PRODUCTS] == [jump_hash(p, 5) for p in PRODUCTS]
+    assert {jump_hash(p, 1) for p in PRODUCTS} == {0}
+    assert {jump_hash(p, 5) for p in PRODUCTS} == set(range(5))
+
+
+def test_growing_moves_keys_only_to_new_shard():
+    for buckets in (1, 2, 4, 7):
+        before = [jump_hash(p, buckets) for p in PRODUCTS]
+        after = [jump_hash(p, buckets + 1) for p in PRODUCTS]
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        assert all(a == buckets for _, a in moved)
+        # переезжает около 1/(n + 1) товаров
+        share = len(moved) / len(PRODUCTS)
+        assert abs(share - 1 / (buckets + 1)) < 0.05
+
+
+def test_merge_top_k_across_shards():
+    parts = [
+        (np.array([[0.9, 0.5, 0.1]]), np.array([[1, 2, 3]])),
+        (np.array([[0.8, 0.7, -3.4e38]]), np.array([[10, 11, -1]])),
+    ]
+    similarities, ids = merge_top_k(parts, 4)
+    assert ids.tolist() == [[1, 10, 11, 2]]
+    assert similarities.tolist() == [[0.9, 0.8, 0.7, 0.5]]
+
+
+def test_merge_keeps_one_copy_while_rebalancing():
+    # вектор 2 уже скопирован в новый шард, но ещё не удалён из старого
+    parts = [
+        (np.array([[0.9, 0.6]]), np.array([[1, 2]])),
+        (np.array([[0.6, 0.4]]), np.array([[2, 7]])),
+    ]
+    _, ids = merge_top_k(parts, 3, dedupe=True)
+    assert ids.tolist() == [[1, 2, 7]]
+    _, ids = merge_top_k(parts, 3)
+    assert ids.tolist() == [[1, 2, 2]]
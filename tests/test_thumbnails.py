@@ -0,0 +1,32 @@
+import os
+
+from PIL import Image
+
+from common.thumbnails import Thumbnails
+
+
+def make_thumbnails(tmp_path) -> Thumbnails:
+    data_dir, root = str(tmp_path / "products"), str(tmp_path / "thumbs")
+    return Thumbnails(data_dir, root, 32, Image.open)
+
+
+def test_thumbnail_mirrors_catalog_and_tracks_photo(tmp_path):
+    thumbnails = make_thumbnails(tmp_path)
+    photo = tmp_path / "products" / "p1" / "a.png"
+    photo.parent.mkdir(parents=True)
+    Image.new("RGB", (200, 100), "red").save(photo)
+
+    assert not thumbnails.fresh(str(photo))
+    target = thumbnails.ensure(str(photo))
+    assert target == str(tmp_path / "thumbs" / "p1" / "a.png.jpg")
+    with Image.open(target) as thumb:
+        assert thumb.size == (32, 16)
+    assert thumbnails.fresh(str(photo))
+
+    stat = os.stat(target)
+    os.utime(photo, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))  # фото сменилось
+    assert not thumbnails.fresh(str(photo))
+
+    thumbnails.remove(str(photo))
+    thumbnails.remove(str(photo))  # повторное удаление — не ошибка
+    assert not os.path.exists(target)
@@ -0,0 +1,77 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from common import watch
+
+
+@pytest.fixture(params=["inotify", "poll"])
+def watcher(request, tmp_path, monkeypatch):
+    """
+    Наблюдатель за tmp_path/products с короткими интервалами; отдаёт папку
+    и очередь пачек. Новые товары собираются рядом и въезжают целиком.
+    """
+    monkeypatch.setattr(watch, "WATCH_MODE", request.param)
+    monkeypatch.setattr(watch, "WATCH_DEBOUNCE_S", 0.1)
+    monkeypatch.setattr(watch, "WATCH_MAX_DELAY_S", 1)
+    monkeypatch.setattr(watch, "WATCH_SCAN_S", 0.2)
+    monkeypatch.setattr(watch, "WATCH_POLL_S", 0.05)
+    root = tmp_path / "products"
+    (root / "p1").mkdir(parents=True)
+    (root / "p1" / "a.jpg").write_bytes(b"a")
+    batches = queue.Queue()
+    reconciled, stop = threading.Event(), threading.Event()
+    reconciled.set()
+    thread = threading.Thread(
+        target=watch.watch_catalog,
+        args=(str(root), reconciled, lambda dirty: batches.put(set(dirty)), stop),
+        daemon=True,
+    )
+    thread.start()
+    time.sleep(0.3)  # первый обход и подписки — до изменений
+    yield root, batches
+    stop.set()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def changed(batches: queue.Queue) -> set:
+    """
+    Товары из пачек, пока поток не стихнет. Обход-подстраховка может
+    повторить то, что уже пришло из inotify, поэтому пачки объединяем.
+    """
+    products = batches.get(timeout=5)
+    while True:
+        try:
+            products |= batches.get(timeout=0.5)
+        except queue.Empty:
+            return products
+
+
+def add_product(root, product_id: str, name: str):
+    staging = root.parent / product_id
+    staging.mkdir()
+    (staging / name).write_bytes(b"x")
+    staging.rename(root / product_id)
+
+
+def test_create_modify_delete(watcher):
+    root, batches = watcher
+    add_product(root, "p2", "b.jpg")
+    assert changed(batches) == {"p2"}
+
+    (root / "p1" / "a.jpg").write_bytes(b"changed")
+    assert changed(batches) == {"p1"}
+
+    (root / "p2" / "b.jpg").unlink()
+    assert changed(batches) == {"p2"}
+
+
+def test_burst_is_one_batch(watcher):
+    root, batches = watcher
+    add_product(root, "p3", "x.jpg")
+    add_product(root, "p4", "x.jpg")
+    (root / "p1" / "a.jpg").unlink()
+    assert batches.get(timeout=5) == {"p1", "p3", "p4"}
@@ -3,9 +3,52 @@ import requests
 from PIL import Image
 from io import BytesIO
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from urllib.parse import quote
 
 API_URL = os.getenv("API_URL", "http://localhost:8000")
+# сколько миниатюр качаем одновременно: k=10 товаров по 3 фото — за один заход
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "32"))
+THUMB_CACHE_TTL_S = int(os.getenv("THUMB_CACHE_TTL_S", "600"))
+
+
+@st.cache_resource
+def http_session() -> requests.Session:
+    """Общий пул keep-alive соединений к API на все сессии UI."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=THUMB_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_data(ttl=THUMB_CACHE_TTL_S, max_entries=5000, show_spinner=False)
+def thumbnail(photo_path: str) -> bytes:
+    # ошибки не кэшируются: исключение пробрасывается наружу
+    response = http_session().get(f"{API_URL}/thumb/{quote(photo_path)}", timeout=30)
+    response.raise_for_status()
+    return response.content
+
+
+def fetch_thumbnails(photo_paths: list[str]) -> list:
+    """Миниатюры параллельно, в порядке photo_paths; на месте неудачных — исключение."""
+    ctx = get_script_run_ctx()
+
+    def fetch(photo_path: str):
+        try:
+            return thumbnail(photo_path)
+        except requests.RequestException as e:
+            return e
+
+    with ThreadPoolExecutor(
+        THUMB_WORKERS,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    ) as pool:
+        return list(pool.map(fetch, photo_paths))
+
 
 st.set_page_config(page_title="Product Matcher", layout="wide")
 st.title("🧠 Image Product Matcher")
@@ -30,7 +73,9 @@ with tab1:
         st.image(Image.open(BytesIO(uploaded_bytes)), caption="Запрос", width=300)
 
         files = {"file": (search_file.name, uploaded_bytes, search_file.type)}
-        response = requests.post(f"{API_URL}/search/", files=files, params={"k": k})
+        response = http_session().post(
+            f"{API_URL}/search/", files=files, params={"k": k}
+        )
 
         if response.status_code == 200:
             results = response.json().get("matches", [])
@@ -80,6 +125,10 @@ with tab1:
                 # Сборка всех карточек в одну строку
                 gallery_html = '<div class="product-gallery">'
 
+                # миниатюры всей выдачи качаем разом, а не по одной на фото
+                photo_paths = [p for m in results for p in m.get("photos", [])[:3]]
+                thumbnails = dict(zip(photo_paths, fetch_thumbnails(photo_paths)))
+
                 for match in results:
                     product_id = match["product_id"]
                     photos = match.get("photos", [])
@@ -88,24 +137,16 @@ with tab1:
 
                     cols = st.columns(min(3, len(photos)))
                     for i, photo_path in enumerate(photos[:3]):
-                        try:
-                            safe_path = quote(photo_path)
-                            url = f"{API_URL}/static/{safe_path}"
-                            response = requests.get(url)
-                            if response.status_code == 200:
-                                img = Image.open(BytesIO(response.content))
-                                with cols[i]:
-                                    st.image(
-                                        img,
-                                        caption=photo_path.split("/")[-1],
-                                        width=300,
-                                    )
-                            else:
-                                st.error(
-                                    f"Ошибка загрузки {url} ({response.status_code})"
-                                )
-                        except Exception as e:
-                            st.error(f"Ошибка: {e}")
+                        thumb = thumbnails[photo_path]
+                        if isinstance(thumb, Exception):
+                            st.error(f"Ошибка загрузки {photo_path}: {thumb}")
+                            continue
+                        with cols[i]:
+                            st.image(
+                                thumb,
+                                caption=photo_path.split("/")[-1],
+                                width=300,
+                            )
         else:
             st.error(f"Ошибка: {response.status_code} — {response.text}")
 
@@ -124,7 +165,9 @@ with tab2:
         files = {
             "file": (add_photo_file.name, add_photo_file.read(), add_photo_file.type)
         }
-        resp = requests.post(f"{API_URL}/add_image/{add_photo_product_id}", files=files)
+        resp = http_session().post(
+            f"{API_URL}/add_image/{add_photo_product_id}", files=files
+        )
         if resp.status_code == 200:
             st.success("Фото успешно добавлено")
         else:
@@ -137,7 +180,7 @@ with tab2:
 with tab3:
     st.header("➕ Создать новый товар")
     if st.button("Создать"):
-        resp = requests.post(f"{API_URL}/add_product/")
+        resp = http_session().post(f"{API_URL}/add_product/")
         if resp.status_code == 200:
             new_id = resp.json().get("product_id")
             st.success(f"Новый товар создан: `{new_id}`")
@@ -156,7 +199,7 @@ with tab4:
     del_photo_filename = st.text_input("Имя файла", key="del_img_filename")
 
     if st.button("Удалить изображение"):
-        resp = requests.delete(
+        resp = http_session().delete(
             f"{API_URL}/delete_image/{del_photo_pid}",
             params={"filename": del_photo_filename},
         )
@@ -169,7 +212,7 @@ with tab4:
     del_product_id = st.text_input("ID товара", key="del_product")
 
     if st.button("Удалить товар"):
-        resp = requests.delete(f"{API_URL}/delete_product/{del_product_id}")
+        resp = http_session().delete(f"{API_URL}/delete_product/{del_product_id}")
         if resp.status_code == 200:
             st.success("Товар удалён")
         else: